@@ -1,7 +1,7 @@
-import zmq
-import msgpack
 from datetime import datetime
 
+from cliente_dealer import Cliente
+
 CLIENT_TAG = "[cliente]"
 _original_print = print
 
@@ -18,21 +18,20 @@ def print(*args, **kwargs):  # noqa: A001 - shadowing built-in intencional
     return _original_print(f"{CLIENT_TAG} {first}", *rest, **kwargs)
 
 
-context = zmq.Context()
-socket = context.socket(zmq.REQ)
-socket.connect("tcp://broker:5555")
-
-# Relógio lógico
-logical_clock = 0
+conexao = Cliente("tcp://broker:5555")
 
-def update_logical_clock(received_clock):
-    global logical_clock
-    logical_clock = max(logical_clock, received_clock) + 1
 
-def increment_logical_clock():
-    global logical_clock
-    logical_clock += 1
-    return logical_clock 
+def requisitar(service, dados):
+    """Envia a requisição e mostra a resposta (o relógio lógico fica no Cliente)"""
+    try:
+        reply = conexao.requisitar(service, dados)
+    except Exception as e:
+        print(f"✗ Erro ao processar resposta: {e}")
+        return
+    if reply is None:
+        print("✗ Erro: Timeout ao aguardar resposta do servidor. Tente novamente.")
+    else:
+        print(formatar_resposta(reply))
 
 
 def log_io(direction: str, payload: dict):
@@ -114,48 +113,16 @@ while opcao not in ["7", "sair", "exit", "quit"]:
             if not login:
                 print("✗ Erro: Nome de usuário não pode estar vazio!")
             else:
-                increment_logical_clock()
-                request = {
-                    "opcao": "login",
-                    "data": {
-                        "user": login,
-                        "timestamp": timestamp,
-                        "clock": logical_clock
-                    }
-                }
-                try:
-                    socket.send(msgpack.packb(request))
-                    reply_bytes = socket.recv()
-                    reply = msgpack.unpackb(reply_bytes, raw=False)
-                    if reply.get("data", {}).get("clock") is not None:
-                        update_logical_clock(reply["data"]["clock"])
-                    print(formatar_resposta(reply))
-                except zmq.Again:
-                    print("✗ Erro: Timeout ao aguardar resposta do servidor. Tente novamente.")
-                except Exception as e:
-                    print(f"✗ Erro ao processar resposta: {e}")
+                requisitar("login", {
+                    "user": login,
+                    "timestamp": timestamp,
+                })
 
         case "2" | "users":
             print("\n--- Listando Usuários ---")
-            increment_logical_clock()
-            request = {
-                "opcao": "users",
-                "data": {
-                    "timestamp": timestamp,
-                    "clock": logical_clock
-                }
-            }
-            try:
-                socket.send(msgpack.packb(request))
-                reply_bytes = socket.recv()
-                reply = msgpack.unpackb(reply_bytes, raw=False)
-                if reply.get("data", {}).get("clock") is not None:
-                    update_logical_clock(reply["data"]["clock"])
-                print(formatar_resposta(reply))
-            except zmq.Again:
-                print("✗ Erro: Timeout ao aguardar resposta do servidor. Tente novamente.")
-            except Exception as e:
-                print(f"✗ Erro ao processar resposta: {e}")
+            requisitar("users", {
+                "timestamp": timestamp,
+            })
 
         case "3" | "channel":
             print("\n--- Criar/Entrar em Canal ---")
@@ -164,48 +131,16 @@ while opcao not in ["7", "sair", "exit", "quit"]:
             if not nome_canal:
                 print("✗ Erro: Nome do canal não pode estar vazio!")
             else:
-                increment_logical_clock()
-                request = {
-                    "opcao": "channel",
-                    "data": {
-                        "channel": nome_canal,
-                        "timestamp": timestamp,
-                        "clock": logical_clock
-                    }
-                }
-                try:
-                    socket.send(msgpack.packb(request))
-                    reply_bytes = socket.recv()
-                    reply = msgpack.unpackb(reply_bytes, raw=False)
-                    if reply.get("data", {}).get("clock") is not None:
-                        update_logical_clock(reply["data"]["clock"])
-                    print(formatar_resposta(reply))
-                except zmq.Again:
-                    print("✗ Erro: Timeout ao aguardar resposta do servidor. Tente novamente.")
-                except Exception as e:
-                    print(f"✗ Erro ao processar resposta: {e}")
+                requisitar("channel", {
+                    "channel": nome_canal,
+                    "timestamp": timestamp,
+                })
 
         case "4" | "channels":
             print("\n--- Listando Canais ---")
-            increment_logical_clock()
-            request = {
-                "opcao": "channels",
-                "data": {
-                    "timestamp": timestamp,
-                    "clock": logical_clock
-                }
-            }
-            try:
-                socket.send(msgpack.packb(request))
-                reply_bytes = socket.recv()
-                reply = msgpack.unpackb(reply_bytes, raw=False)
-                if reply.get("data", {}).get("clock") is not None:
-                    update_logical_clock(reply["data"]["clock"])
-                print(formatar_resposta(reply))
-            except zmq.Again:
-                print("✗ Erro: Timeout ao aguardar resposta do servidor. Tente novamente.")
-            except Exception as e:
-                print(f"✗ Erro ao processar resposta: {e}")
+            requisitar("channels", {
+                "timestamp": timestamp,
+            })
 
         case "5" | "publish":
             print("\n--- Publicar Mensagem em Canal ---")
@@ -216,28 +151,12 @@ while opcao not in ["7", "sair", "exit", "quit"]:
             if not user or not canal or not mensagem:
                 print("✗ Erro: Todos os campos são obrigatórios!")
             else:
-                increment_logical_clock()
-                request = {
-                    "service": "publish",
-                    "data": {
-                        "user": user,
-                        "channel": canal,
-                        "message": mensagem,
-                        "timestamp": timestamp,
-                        "clock": logical_clock
-                    }
-                }
-                try:
-                    socket.send(msgpack.packb(request))
-                    reply_bytes = socket.recv()
-                    reply = msgpack.unpackb(reply_bytes, raw=False)
-                    if reply.get("data", {}).get("clock") is not None:
-                        update_logical_clock(reply["data"]["clock"])
-                    print(formatar_resposta(reply))
-                except zmq.Again:
-                    print("✗ Erro: Timeout ao aguardar resposta do servidor. Tente novamente.")
-                except Exception as e:
-                    print(f"✗ Erro ao processar resposta: {e}")
+                requisitar("publish", {
+                    "user": user,
+                    "channel": canal,
+                    "message": mensagem,
+                    "timestamp": timestamp,
+                })
 
         case "6" | "message":
             print("\n--- Enviar Mensagem Privada ---")
@@ -248,28 +167,12 @@ while opcao not in ["7", "sair", "exit", "quit"]:
             if not src or not dst or not mensagem:
                 print("✗ Erro: Todos os campos são obrigatórios!")
             else:
-                increment_logical_clock()
-                request = {
-                    "service": "message",
-                    "data": {
-                        "src": src,
-                        "dst": dst,
-                        "message": mensagem,
-                        "timestamp": timestamp,
-                        "clock": logical_clock
-                    }
-                }
-                try:
-                    socket.send(msgpack.packb(request))
-                    reply_bytes = socket.recv()
-                    reply = msgpack.unpackb(reply_bytes, raw=False)
-                    if reply.get("data", {}).get("clock") is not None:
-                        update_logical_clock(reply["data"]["clock"])
-                    print(formatar_resposta(reply))
-                except zmq.Again:
-                    print("✗ Erro: Timeout ao aguardar resposta do servidor. Tente novamente.")
-                except Exception as e:
-                    print(f"✗ Erro ao processar resposta: {e}")
+                requisitar("message", {
+                    "src": src,
+                    "dst": dst,
+                    "message": mensagem,
+                    "timestamp": timestamp,
+                })
 
         case _:
             print("\n✗ Opção inválida! Por favor, escolha uma opção entre 1 e 7.")
@@ -281,3 +184,5 @@ print("\n" + "="*60)
 print("  Obrigado por usar o Bulletin Board!")
 print("  Até logo!")
 print("="*60)
+
+conexao.fechar()
@@ -1,10 +1,17 @@
 import os
+import sys
 import zmq
+import json
+import queue
 import random
 import time
+import argparse
+import threading
 import msgpack
 from datetime import datetime
 
+from cliente_dealer import Cliente
+
 CLIENT_TAG = "[cliente-bot]"
 _original_print = print
 
@@ -21,30 +28,334 @@ def print(*args, **kwargs):  # noqa: A001 - shadowing built-in intencional
     return _original_print(f"{CLIENT_TAG} {first}", *rest, **kwargs)
 
 
-context = zmq.Context()
+context = zmq.Context.instance()
 
 # Configuração opcional para espaçar bots e evitar rajadas simultâneas
 SPREAD_SECONDS = float(os.getenv("BOT_SPREAD_SECONDS", "2"))
+# Envia as publicações de cada rodada numa única requisição `batch`
+USAR_LOTE = os.getenv("BOT_LOTE", "0") == "1"
 
 
-def create_req_socket():
-    socket = context.socket(zmq.REQ)
-    socket.connect("tcp://broker:5555")
-    return socket
+# ---------------------------------------------------------------------------
+# Modo benchmark: python cliente_automatico.py benchmark [opções]
+#
+# Simula muitos usuários a partir de um único processo. Cada conexão é uma
+# thread com seu próprio Cliente (DEALER) e até --janela requisições em
+# andamento; em malha fechada (padrão) cada conexão envia a próxima
+# requisição assim que uma resposta chega, e com --taxa as requisições são
+# agendadas em intervalos fixos (malha aberta) e a latência é medida a
+# partir do horário agendado, incluindo a espera na fila.
+# ---------------------------------------------------------------------------
 
+OPERACOES_BENCHMARK = ("login", "publish", "message", "users", "channels", "history", "inbox")
+MIX_PADRAO = "login=5,publish=55,message=25,users=5,channels=5,history=5"
+
+mensagens_benchmark = [
+    "Olá, esta é uma mensagem de teste!",
+    "Teste de publicação em canal.",
+    "Mensagem automática gerada pelo benchmark.",
+    "x" * 256,
+]
 
-def reset_req_socket():
-    global req_socket
-    try:
-        req_socket.close(0)
-    except Exception:
-        pass
-    req_socket = create_req_socket()
-    print("Socket REQ recriado e reconectado ao broker")
 
+def interpretar_mix(texto):
+    mix = {}
+    for parte in texto.split(","):
+        nome, _, peso = parte.partition("=")
+        nome = nome.strip()
+        if nome not in OPERACOES_BENCHMARK:
+            raise ValueError(f"Operação desconhecida no mix: {nome}")
+        if float(peso) > 0:
+            mix[nome] = float(peso)
+    if not mix:
+        raise ValueError("O mix precisa de ao menos uma operação com peso positivo")
+    return mix
+
+
+class HistogramaLatencia:
+    """Latências de uma operação, com percentis exatos e faixas log2"""
+
+    def __init__(self):
+        self.amostras = []
+        self.erros = 0
+        self.timeouts = 0
+
+    def mesclar(self, outro):
+        self.amostras.extend(outro.amostras)
+        self.erros += outro.erros
+        self.timeouts += outro.timeouts
+
+    def resumo(self, duracao):
+        amostras = sorted(self.amostras)
+        n = len(amostras)
+
+        def percentil(fracao):
+            if not n:
+                return 0.0
+            return amostras[min(n - 1, int(fracao * n))] * 1000.0
+
+        # Faixas em potências de 2 de microssegundos (limite superior em ms)
+        faixas = {}
+        for segundos in amostras:
+            limite = 1 << max(0, int(segundos * 1_000_000)).bit_length()
+            faixas[limite] = faixas.get(limite, 0) + 1
+
+        return {
+            "n": n,
+            "erros": self.erros,
+            "timeouts": self.timeouts,
+            "vazao": n / duracao if duracao > 0 else 0.0,
+            "media_ms": sum(amostras) / n * 1000.0 if n else 0.0,
+            "p50_ms": percentil(0.5),
+            "p90_ms": percentil(0.9),
+            "p99_ms": percentil(0.99),
+            "p999_ms": percentil(0.999),
+            "max_ms": amostras[-1] * 1000.0 if n else 0.0,
+            "histograma": {f"{limite / 1000.0:g}": faixas[limite] for limite in sorted(faixas)},
+        }
 
-req_socket = create_req_socket()
-print("Socket conectado ao broker: tcp://broker:5555")
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.mix = interpretar_mix(args.mix)
+        self.operacoes = list(self.mix)
+        self.pesos = list(self.mix.values())
+        prefixo = f"bench_{os.getpid()}_{random.randint(0, 9999)}"
+        self.usuarios = [f"{prefixo}_u{i}" for i in range(args.usuarios)]
+        self.canais = [f"{prefixo}_c{i}" for i in range(args.canais)]
+        self.prefixo = prefixo
+        self.novos_logins = 0
+        self.lock = threading.Lock()
+        self.resultados = []
+
+    def conectar(self):
+        # Sem retentativas: uma requisição sem resposta no prazo conta como timeout
+        return Cliente(self.args.endereco, self.args.timeout_ms, tentativas=1)
+
+    def preparar(self):
+        """Cadastra os usuários e canais simulados antes da medição"""
+        cliente = self.conectar()
+        cliente.requisitar_varios([("login", {"user": user}) for user in self.usuarios])
+        cliente.requisitar_varios([("channel", {"channel": canal}) for canal in self.canais])
+        cliente.fechar()
+
+    def montar(self, operacao, rnd):
+        if operacao == "login":
+            with self.lock:
+                self.novos_logins += 1
+                user = f"{self.prefixo}_n{self.novos_logins}"
+            return "login", {"user": user}
+        if operacao == "publish":
+            return "publish", {"user": rnd.choice(self.usuarios), "channel": rnd.choice(self.canais),
+                               "message": rnd.choice(mensagens_benchmark)}
+        if operacao == "message":
+            return "message", {"src": rnd.choice(self.usuarios), "dst": rnd.choice(self.usuarios),
+                               "message": rnd.choice(mensagens_benchmark)}
+        if operacao == "history":
+            return "history", {"channel": rnd.choice(self.canais), "limit": 20}
+        if operacao == "inbox":
+            return "inbox", {"dst": rnd.choice(self.usuarios), "limit": 20}
+        return operacao, {}
+
+    def montar_requisicao(self, operacoes, rnd):
+        """Uma requisição com as operações (`batch` se houver mais de uma)"""
+        montadas = [self.montar(operacao, rnd) for operacao in operacoes]
+        if len(montadas) == 1:
+            return montadas[0]
+        return "batch", {"ops": [{"service": s, "data": d} for s, d in montadas]}
+
+    def registrar(self, operacoes, reply, inicio, medidas):
+        """No lote, a latência de cada operação é a da requisição inteira"""
+        fim = time.perf_counter()
+        if reply is None or len(operacoes) == 1:
+            replies = [reply] * len(operacoes)
+        else:
+            replies = reply.get("data", {}).get("replies")
+            if not isinstance(replies, list) or len(replies) != len(operacoes):
+                # Lote recusado inteiro (ex.: resposta de erro sem `replies`): erro em cada operação
+                replies = [None] * len(operacoes)
+        for operacao, resposta in zip(operacoes, replies):
+            histograma = medidas.setdefault(operacao, HistogramaLatencia())
+            if reply is None:
+                # Só o prazo esgotado conta como timeout
+                histograma.timeouts += 1
+                continue
+            histograma.amostras.append(fim - inicio)
+            if not isinstance(resposta, dict) or resposta.get("data", {}).get("status") == "erro":
+                histograma.erros += 1
+
+    def coletar(self, cliente, em_andamento, medidas, inicio_medicao, espera_ms=None):
+        for req_id, reply in cliente.concluidas(espera_ms):
+            operacoes, inicio = em_andamento.pop(req_id)
+            if inicio >= inicio_medicao:
+                self.registrar(operacoes, reply, inicio, medidas)
+
+    def trabalhador_fechado(self, semente, inicio_medicao, fim):
+        rnd = random.Random(semente)
+        cliente = self.conectar()
+        medidas = {}
+        em_andamento = {}  # id -> (operações, início)
+        while True:
+            agora = time.perf_counter()
+            while agora < fim and len(em_andamento) < self.args.janela:
+                operacoes = rnd.choices(self.operacoes, self.pesos, k=self.args.lote)
+                em_andamento[cliente.enviar(*self.montar_requisicao(operacoes, rnd))] = (operacoes, agora)
+            if not em_andamento:
+                break
+            self.coletar(cliente, em_andamento, medidas, inicio_medicao)
+        cliente.fechar()
+        with self.lock:
+            self.resultados.append(medidas)
+
+    def trabalhador_aberto(self, semente, agenda, inicio_medicao):
+        rnd = random.Random(semente)
+        cliente = self.conectar()
+        medidas = {}
+        em_andamento = {}
+        encerrar = False
+        while not encerrar or em_andamento:
+            if encerrar or len(em_andamento) >= self.args.janela:
+                self.coletar(cliente, em_andamento, medidas, inicio_medicao)
+                continue
+            try:
+                # Sem nada em andamento pode bloquear na agenda
+                item = agenda.get(block=not em_andamento)
+            except queue.Empty:
+                self.coletar(cliente, em_andamento, medidas, inicio_medicao, espera_ms=1)
+                continue
+            if item is None:
+                encerrar = True
+                continue
+            agendado, operacoes = item
+            espera = agendado - time.perf_counter()
+            while espera > 0:
+                if em_andamento:
+                    self.coletar(cliente, em_andamento, medidas, inicio_medicao, espera_ms=espera * 1000)
+                else:
+                    time.sleep(espera)
+                espera = agendado - time.perf_counter()
+            em_andamento[cliente.enviar(*self.montar_requisicao(operacoes, rnd))] = (operacoes, agendado)
+        cliente.fechar()
+        with self.lock:
+            self.resultados.append(medidas)
+
+    def executar(self):
+        args = self.args
+        self.preparar()
+
+        inicio = time.perf_counter()
+        inicio_medicao = inicio + args.aquecimento
+        fim = inicio_medicao + args.duracao
+        threads = []
+
+        if args.taxa > 0:
+            agenda = queue.Queue()
+            for i in range(args.concorrencia):
+                threads.append(threading.Thread(target=self.trabalhador_aberto, args=(i, agenda, inicio_medicao)))
+            for t in threads:
+                t.start()
+            rnd = random.Random(-1)
+            intervalo = 1.0 / args.taxa
+            agendado = inicio
+            while agendado < fim:
+                # Agenda com pouca antecedência para não acumular a fila inteira
+                while agendado - time.perf_counter() > 0.05:
+                    time.sleep(0.01)
+                agenda.put((agendado, rnd.choices(self.operacoes, self.pesos, k=args.lote)))
+                agendado += intervalo
+            for _ in threads:
+                agenda.put(None)
+        else:
+            for i in range(args.concorrencia):
+                threads.append(threading.Thread(target=self.trabalhador_fechado, args=(i, inicio_medicao, fim)))
+            for t in threads:
+                t.start()
+
+        for t in threads:
+            t.join()
+        return self.resumir(time.perf_counter() - inicio_medicao)
+
+    def resumir(self, duracao):
+        por_operacao = {}
+        total = HistogramaLatencia()
+        for medidas in self.resultados:
+            for operacao, histograma in medidas.items():
+                por_operacao.setdefault(operacao, HistogramaLatencia()).mesclar(histograma)
+                total.mesclar(histograma)
+
+        args = self.args
+        return {
+            "config": {
+                "endereco": args.endereco,
+                "modo": "aberto" if args.taxa > 0 else "fechado",
+                "taxa": args.taxa,
+                "concorrencia": args.concorrencia,
+                "lote": args.lote,
+                "janela": args.janela,
+                "usuarios": args.usuarios,
+                "canais": args.canais,
+                "duracao": args.duracao,
+                "aquecimento": args.aquecimento,
+                "mix": self.mix,
+            },
+            "duracao_real": duracao,
+            "total": total.resumo(duracao),
+            "operacoes": {op: h.resumo(duracao) for op, h in sorted(por_operacao.items())},
+        }
+
+
+def imprimir_resumo(resultado):
+    config = resultado["config"]
+    print(f"Benchmark {config['modo']}: {config['concorrencia']} conexões, {config['usuarios']} usuários, "
+          f"{config['lote']} operações por requisição, janela {config['janela']}, "
+          f"{resultado['duracao_real']:.1f}s medidos")
+    print(f"{'operacao':<10} {'n':>8} {'req/s':>9} {'erros':>6} {'timeout':>7} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8} {'max ms':>8}")
+    linhas = list(resultado["operacoes"].items()) + [("TOTAL", resultado["total"])]
+    for nome, r in linhas:
+        print(f"{nome:<10} {r['n']:>8} {r['vazao']:>9.1f} {r['erros']:>6} {r['timeouts']:>7} "
+              f"{r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['p999_ms']:>8.2f} {r['max_ms']:>8.2f}")
+
+
+def executar_benchmark(argv):
+    parser = argparse.ArgumentParser(prog="cliente_automatico.py benchmark",
+                                     description="Gerador de carga para o broker/servidores")
+    parser.add_argument("--endereco", default=os.getenv("BROKER_ENDERECO", "tcp://broker:5555"))
+    parser.add_argument("--usuarios", type=int, default=100, help="usuários simulados")
+    parser.add_argument("--canais", type=int, default=10, help="canais simulados")
+    parser.add_argument("--concorrencia", type=int, default=16, help="conexões simultâneas")
+    parser.add_argument("--taxa", type=float, default=0,
+                        help="requisições/s agendadas (malha aberta); 0 = malha fechada")
+    parser.add_argument("--lote", type=int, default=1,
+                        help="operações por requisição (> 1 usa o serviço batch)")
+    parser.add_argument("--janela", type=int, default=1,
+                        help="requisições em andamento por conexão (pipelining)")
+    parser.add_argument("--duracao", type=float, default=30, help="segundos medidos")
+    parser.add_argument("--aquecimento", type=float, default=2, help="segundos descartados no início")
+    parser.add_argument("--mix", default=MIX_PADRAO,
+                        help=f"pesos por operação ({', '.join(OPERACOES_BENCHMARK)})")
+    parser.add_argument("--timeout-ms", type=int, default=5000)
+    parser.add_argument("--json", help="grava o resultado em JSON neste arquivo ('-' = stdout)")
+    args = parser.parse_args(argv)
+
+    resultado = Benchmark(args).executar()
+    imprimir_resumo(resultado)
+    if args.json == "-":
+        _original_print(json.dumps(resultado, indent=2, ensure_ascii=False))
+    elif args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+        print(f"Resultado gravado em {args.json}")
+    return 0
+
+
+if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+    sys.exit(executar_benchmark(sys.argv[2:]))
+
+
+conexao = Cliente("tcp://broker:5555")
+print("Cliente conectado ao broker: tcp://broker:5555")
 
 # Socket para receber mensagens Pub/Sub
 sub_socket = context.socket(zmq.SUB)
@@ -54,72 +365,23 @@ sub_socket.connect("tcp://proxy:5558")
 username = f"user_{random.randint(1000, 9999)}"
 print(f"Cliente automático iniciado com usuário: {username}")
 
-# Relógio lógico
-logical_clock = 0
-
 
-def update_logical_clock(received_clock):
-    global logical_clock
-    logical_clock = max(logical_clock, received_clock) + 1
-
-
-def increment_logical_clock():
-    global logical_clock
-    logical_clock += 1
-    return logical_clock
-
-
-def send_request(request, descricao, max_attempts=3):
-    global req_socket
-
-    for attempt in range(1, max_attempts + 1):
-        try:
-            req_socket.send(msgpack.packb(request))
-        except zmq.Again:
-            print(f"Timeout ao enviar requisição de {descricao} (tentativa {attempt}/{max_attempts})", flush=True)
-            reset_req_socket()
-            continue
-        except Exception as e:
-            print(f"Erro ao enviar requisição de {descricao}: {e}", flush=True)
-            import traceback
-            traceback.print_exc()
-            reset_req_socket()
-            continue
-
-        try:
-            reply_raw = req_socket.recv()
-            reply = msgpack.unpackb(reply_raw, raw=False)
-            return reply
-        except Exception as e:
-            print(f"Erro ao receber resposta de {descricao}: {e}", flush=True)
-            import traceback
-            traceback.print_exc()
-            break
-
-        print(f"Nenhuma resposta para {descricao}. Recriando socket e tentando novamente...", flush=True)
-        reset_req_socket()
-
-    print(f"Falha ao concluir {descricao} após {max_attempts} tentativas.", flush=True)
-    return None
+def send_request(service, dados, descricao):
+    """Requisição com timeout e retentativas (o relógio lógico fica no Cliente)"""
+    try:
+        reply = conexao.requisitar(service, dados)
+    except Exception as e:
+        print(f"Erro na requisição de {descricao}: {e}", flush=True)
+        return None
+    if reply is None:
+        print(f"Falha ao concluir {descricao} após {conexao.tentativas_para(service)} tentativa(s).", flush=True)
+    return reply
 
 
 # Faz login
 while True:
-    timestamp = datetime.now().timestamp()
-    increment_logical_clock()
-    login_request = {
-        "opcao": "login",
-        "data": {
-            "user": username,
-            "timestamp": timestamp,
-            "clock": logical_clock,
-        },
-    }
-
-    reply = send_request(login_request, "login")
+    reply = send_request("login", {"user": username, "timestamp": datetime.now().timestamp()}, "login")
     if reply:
-        if reply.get("data", {}).get("clock") is not None:
-            update_logical_clock(reply["data"]["clock"])
         print(f"Login realizado: {reply}", flush=True)
         break
 
@@ -151,37 +413,18 @@ mensagens = [
 
 def obter_canais():
     """Obtém a lista de canais disponíveis"""
-    try:
-        timestamp = datetime.now().timestamp()
-        increment_logical_clock()
-        request = {
-            "opcao": "channels",
-            "data": {
-                "timestamp": timestamp,
-                "clock": logical_clock,
-            },
-        }
-        reply = send_request(request, "channels")
-        if not reply:
-            print("Resposta ausente ao obter canais")
-            return []
-
-            print(f"Resposta de canais recebida: {reply}")
-        if reply.get("data", {}).get("clock") is not None:
-            update_logical_clock(reply["data"]["clock"])
-        if reply.get("service") == "channels" and "channels" in reply.get("data", {}):
-            canais = reply["data"]["channels"]
-            print(f"Canais obtidos: {canais}")
-            return canais
-        print(f"Resposta inesperada ao obter canais: {reply}")
-        return []
-    except Exception as e:
-        print(f"Erro ao obter canais: {e}")
-        import traceback
-        traceback.print_exc()
-        reset_req_socket()
+    reply = send_request("channels", {"timestamp": datetime.now().timestamp()}, "channels")
+    if not reply:
+        print("Resposta ausente ao obter canais")
         return []
 
+    if reply.get("service") == "channels" and "channels" in reply.get("data", {}):
+        canais = reply["data"]["channels"]
+        print(f"Canais obtidos: {canais}")
+        return canais
+    print(f"Resposta inesperada ao obter canais: {reply}")
+    return []
+
 
 def criar_canal_se_necessario():
     """Cria um canal se não houver nenhum"""
@@ -189,43 +432,61 @@ def criar_canal_se_necessario():
     if not canais:
         # Cria um canal padrão
         canal = "geral"
-        timestamp = datetime.now().timestamp()
-        increment_logical_clock()
-        request = {
-            "opcao": "channel",
-            "data": {
-                "channel": canal,
-                "timestamp": timestamp,
-                "clock": logical_clock,
-            },
-        }
-        try:
-            print(f"Tentando criar canal '{canal}'...")
-            reply = send_request(request, "criação de canal")
-            if not reply:
-                print(f"Falha ao criar canal '{canal}'")
-                return []
-
-            print(f"Resposta de criação de canal recebida: {reply}")
-            if reply.get("data", {}).get("clock") is not None:
-                update_logical_clock(reply["data"]["clock"])
-            status = reply.get("data", {}).get("status", "erro")
-            if status == "sucesso":
-                print(f"Canal '{canal}' criado com sucesso")
-                return [canal]
-            else:
-                error_msg = reply.get("data", {}).get("description", "Erro desconhecido")
-                print(f"Erro ao criar canal '{canal}': {error_msg}")
-                return []
-        except Exception as e:
-            print(f"Exceção ao criar canal: {e}")
-            import traceback
-            traceback.print_exc()
-            reset_req_socket()
+        print(f"Tentando criar canal '{canal}'...")
+        reply = send_request("channel", {"channel": canal, "timestamp": datetime.now().timestamp()},
+                             "criação de canal")
+        if not reply:
+            print(f"Falha ao criar canal '{canal}'")
+            return []
+
+        print(f"Resposta de criação de canal recebida: {reply}")
+        status = reply.get("data", {}).get("status", "erro")
+        if status == "sucesso":
+            print(f"Canal '{canal}' criado com sucesso")
+            return [canal]
+        else:
+            error_msg = reply.get("data", {}).get("description", "Erro desconhecido")
+            print(f"Erro ao criar canal '{canal}': {error_msg}")
             return []
     return canais
 
 
+def dados_publicacao(canal, mensagem):
+    return {"user": username, "channel": canal, "message": mensagem, "timestamp": datetime.now().timestamp()}
+
+
+def publicar_em_lote(canal):
+    """Publica todas as mensagens pré-definidas numa única requisição `batch`"""
+    ops = [{"service": "publish", "data": dados_publicacao(canal, mensagem)} for mensagem in mensagens]
+    reply = send_request("batch", {"ops": ops}, "publicação em lote")
+    if not reply:
+        print("✗ Sem resposta ao publicar em lote")
+        return
+    replies = reply.get("data", {}).get("replies", [])
+    ok = sum(1 for r in replies if r.get("data", {}).get("status") == "OK")
+    print(f"✓ Lote publicado em '{canal}': {ok}/{len(ops)} mensagens aceitas")
+
+
+def publicar_em_paralelo(canal):
+    """Publica as mensagens pré-definidas com todas as requisições em andamento ao mesmo tempo"""
+    for mensagem in mensagens:
+        print(f"Enviando mensagem: {mensagem[:30]}...")
+    try:
+        replies = conexao.requisitar_varios([("publish", dados_publicacao(canal, m)) for m in mensagens])
+    except Exception as e:
+        print(f"✗ Exceção ao publicar: {e}")
+        return
+    for mensagem, reply in zip(mensagens, replies):
+        if not reply:
+            print("✗ Sem resposta ao publicar")
+        elif reply.get("data", {}).get("status") == "OK":
+            print(f"✓ Mensagem publicada com sucesso: {mensagem[:50]}...")
+        else:
+            error_msg = reply.get("data", {}).get("message", "Erro desconhecido")
+            print(f"✗ Erro ao publicar: {error_msg}")
+            print(f"Resposta completa: {reply}")
+
+
 # Loop principal
 print("Iniciando loop principal...")
 try:
@@ -243,46 +504,10 @@ try:
         canal_escolhido = random.choice(canais)
         print(f"\nEnviando mensagens para o canal '{canal_escolhido}'")
 
-        # Envia mensagens continuamente
-        for i in range(len(mensagens)):
-            mensagem = mensagens[i]
-            timestamp = datetime.now().timestamp()
-
-            increment_logical_clock()
-            request = {
-                "service": "publish",
-                "data": {
-                    "user": username,
-                    "channel": canal_escolhido,
-                    "message": mensagem,
-                    "timestamp": timestamp,
-                    "clock": logical_clock,
-                },
-            }
-
-            try:
-                print(f"Enviando mensagem: {mensagem[:30]}...")
-                print(f"Mensagem enviada: {request}")
-                reply = send_request(request, "publicação")
-                if not reply:
-                    print("✗ Sem resposta ao publicar")
-                    continue
-
-                print(f"Resposta recebida: {reply}")
-                if reply.get("data", {}).get("clock") is not None:
-                    update_logical_clock(reply["data"]["clock"])
-
-                if reply.get("data", {}).get("status") == "OK":
-                    print(f"✓ Mensagem publicada com sucesso: {mensagem[:50]}...")
-                else:
-                    error_msg = reply.get("data", {}).get("message", "Erro desconhecido")
-                    print(f"✗ Erro ao publicar: {error_msg}")
-                    print(f"Resposta completa: {reply}")
-            except Exception as e:
-                print(f"✗ Exceção ao publicar: {e}")
-                import traceback
-                traceback.print_exc()
-                reset_req_socket()
+        if USAR_LOTE:
+            publicar_em_lote(canal_escolhido)
+        else:
+            publicar_em_paralelo(canal_escolhido)
 
         print("Fim do lote atual.\n")
         if SPREAD_SECONDS > 0:
@@ -296,8 +521,7 @@ try:
             message = sub_socket.recv(zmq.NOBLOCK)
             data = msgpack.unpackb(message, raw=False)
             # Atualiza relógio lógico ao receber mensagem Pub/Sub
-            if data.get("clock") is not None:
-                update_logical_clock(data["clock"])
+            conexao.atualizar_clock(data.get("clock"))
             print(f"Mensagem recebida no tópico '{topic}': {data}")
         except zmq.Again:
             pass  # Nenhuma mensagem recebida
@@ -305,10 +529,6 @@ try:
 except KeyboardInterrupt:
     print(f"\nCliente automático {username} encerrado.")
 finally:
-    try:
-        req_socket.close()
-    except Exception:
-        pass
+    conexao.fechar()
     sub_socket.close()
     context.term()
-
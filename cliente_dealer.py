@@ -0,0 +1,258 @@
+import os
+import time
+import asyncio
+import itertools
+import zmq
+import zmq.asyncio
+import msgpack
+
+# Biblioteca de acesso ao broker para os clientes Python.
+#
+# Em vez de um REQ (uma requisição por vez, e o socket fica inutilizável
+# depois de um timeout), usa um DEALER: cada requisição leva um id próprio
+# num frame de envelope, [id, b"", payload], que o broker e o REP do
+# servidor devolvem intacto na resposta. Assim várias requisições podem
+# ficar em andamento na mesma conexão, cada uma com seu prazo e suas
+# retentativas, e a resposta é associada à requisição pelo id (respostas
+# atrasadas de uma tentativa anterior são descartadas). O servidor não
+# deduplica pelo id, então só as consultas são reenviadas: um publish ou
+# message reenviado depois de um timeout poderia ser aplicado duas vezes.
+#
+# Cliente      - API síncrona (enviar/concluidas/aguardar, requisitar, requisitar_varios)
+# ClienteAsync - API asyncio (await requisitar), com várias corrotinas no mesmo socket
+
+ENDERECO_PADRAO = os.getenv("BROKER_ENDERECO", "tcp://broker:5555")
+TIMEOUT_MS = int(os.getenv("CLIENTE_TIMEOUT_MS", 5000))
+# Tentativas por requisição (a mesma requisição é reenviada com o mesmo id)
+TENTATIVAS = int(os.getenv("CLIENTE_TENTATIVAS", 3))
+# Serviços sem efeito no servidor, que podem ser reenviados com segurança;
+# os demais têm uma única tentativa
+SERVICOS_REENVIAVEIS = frozenset({"users", "listar", "channels", "listarCanal", "history", "inbox", "stats"})
+# Requisições em andamento por conexão em requisitar_varios
+JANELA = int(os.getenv("CLIENTE_JANELA", 32))
+
+
+class _Pendente:
+    __slots__ = ("frames", "prazo", "tentativas", "maximo")
+
+    def __init__(self, frames, prazo, maximo):
+        self.frames = frames
+        self.prazo = prazo
+        self.tentativas = 1
+        self.maximo = maximo
+
+
+class _ClienteBase:
+    """Montagem das requisições, relógio lógico e contadores comuns às duas APIs"""
+
+    def __init__(self, timeout_ms, tentativas):
+        self.timeout_ms = timeout_ms
+        self.tentativas = max(1, tentativas)
+        self.clock = 0
+        self.ids = itertools.count(1)
+        self.contadores = {"enviadas": 0, "reenviadas": 0, "timeouts": 0, "descartadas": 0}
+
+    def montar(self, service, dados):
+        """Retorna (id, frames) de uma requisição, com timestamp e clock preenchidos"""
+        dados = dict(dados or {})
+        dados.setdefault("timestamp", time.time())
+        self.clock += 1
+        dados["clock"] = self.clock
+        req_id = next(self.ids)
+        payload = msgpack.packb({"service": service, "data": dados})
+        return req_id, [req_id.to_bytes(8, "big"), b"", payload]
+
+    def tentativas_para(self, service):
+        """Quantas vezes a requisição pode ser enviada (1 se não for reenviável)"""
+        return self.tentativas if service in SERVICOS_REENVIAVEIS else 1
+
+    def interpretar(self, frames):
+        """Retorna (id, resposta) de uma mensagem recebida, ou None se for inválida"""
+        if len(frames) < 2 or len(frames[0]) != 8:
+            self.contadores["descartadas"] += 1
+            return None
+        try:
+            reply = msgpack.unpackb(frames[-1], raw=False)
+        except Exception:
+            self.contadores["descartadas"] += 1
+            return None
+        if isinstance(reply, dict):
+            self.atualizar_clock(reply.get("data", {}).get("clock"))
+        return int.from_bytes(frames[0], "big"), reply
+
+    def atualizar_clock(self, clock):
+        """Relógio lógico: também usado para mensagens recebidas por Pub/Sub"""
+        if isinstance(clock, int):
+            self.clock = max(self.clock, clock) + 1
+
+
+class Cliente(_ClienteBase):
+    """Conexão DEALER síncrona com várias requisições em andamento
+
+    Não é thread-safe: cada thread usa o seu Cliente. Uma requisição sem
+    resposta depois de todas as tentativas é concluída com None.
+    """
+
+    def __init__(self, endereco=ENDERECO_PADRAO, timeout_ms=TIMEOUT_MS, tentativas=TENTATIVAS, context=None):
+        super().__init__(timeout_ms, tentativas)
+        self.endereco = endereco
+        self.socket = (context or zmq.Context.instance()).socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(endereco)
+        self.pendentes = {}  # id -> _Pendente
+        self.prontas = {}  # id -> resposta (ou None) ainda não retirada
+
+    def enviar(self, service, dados=None):
+        """Envia sem esperar a resposta; retorna o id da requisição"""
+        req_id, frames = self.montar(service, dados)
+        self.pendentes[req_id] = _Pendente(frames, time.monotonic() + self.timeout_ms / 1000.0,
+                                           self.tentativas_para(service))
+        self.socket.send_multipart(frames)
+        self.contadores["enviadas"] += 1
+        return req_id
+
+    def _receber(self, espera_ms):
+        if not self.socket.poll(espera_ms, zmq.POLLIN):
+            return
+        while True:
+            try:
+                frames = self.socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            resultado = self.interpretar(frames)
+            if resultado is None:
+                continue
+            req_id, reply = resultado
+            if self.pendentes.pop(req_id, None) is None:
+                # Resposta de uma tentativa anterior já respondida ou abandonada
+                self.contadores["descartadas"] += 1
+            else:
+                self.prontas[req_id] = reply
+
+    def _verificar_prazos(self):
+        agora = time.monotonic()
+        for req_id, pendente in list(self.pendentes.items()):
+            if pendente.prazo > agora:
+                continue
+            if pendente.tentativas < pendente.maximo:
+                pendente.tentativas += 1
+                pendente.prazo = agora + self.timeout_ms / 1000.0
+                self.socket.send_multipart(pendente.frames)
+                self.contadores["reenviadas"] += 1
+            else:
+                del self.pendentes[req_id]
+                self.prontas[req_id] = None
+                self.contadores["timeouts"] += 1
+
+    def _progredir(self, espera_ms):
+        if self.pendentes:
+            proximo_prazo = min(p.prazo for p in self.pendentes.values())
+            espera_ms = min(espera_ms, max(0, int((proximo_prazo - time.monotonic()) * 1000) + 1))
+        self._receber(espera_ms)
+        self._verificar_prazos()
+
+    def concluidas(self, espera_ms=None):
+        """Retira as requisições concluídas como [(id, resposta)], esperando até
+        espera_ms (None = até concluir alguma) se ainda não houver nenhuma"""
+        limite = None if espera_ms is None else time.monotonic() + espera_ms / 1000.0
+        while self.pendentes:
+            restante = self.timeout_ms if limite is None else max(0, int((limite - time.monotonic()) * 1000))
+            # Sempre passa ao menos uma vez pelo socket para recolher o que já chegou
+            self._progredir(0 if self.prontas else restante)
+            if self.prontas or restante == 0:
+                break
+        prontas = list(self.prontas.items())
+        self.prontas.clear()
+        return prontas
+
+    def aguardar(self, req_id):
+        """Espera a resposta de uma requisição (None em timeout)"""
+        while req_id not in self.prontas:
+            if req_id not in self.pendentes:
+                raise KeyError(f"Requisição desconhecida: {req_id}")
+            self._progredir(self.timeout_ms)
+        return self.prontas.pop(req_id)
+
+    def requisitar(self, service, dados=None):
+        return self.aguardar(self.enviar(service, dados))
+
+    def requisitar_varios(self, requisicoes, janela=JANELA):
+        """Executa [(service, dados), ...] com até `janela` requisições em
+        andamento; retorna as respostas na mesma ordem"""
+        requisicoes = list(requisicoes)
+        respostas = [None] * len(requisicoes)
+        posicoes = {}
+        outras = {}
+        proxima = 0
+        while proxima < len(requisicoes) or posicoes:
+            while proxima < len(requisicoes) and len(posicoes) < janela:
+                posicoes[self.enviar(*requisicoes[proxima])] = proxima
+                proxima += 1
+            for req_id, reply in self.concluidas():
+                if req_id in posicoes:
+                    respostas[posicoes.pop(req_id)] = reply
+                else:
+                    outras[req_id] = reply
+        # Enviadas por fora de requisitar_varios: ficam para quem as aguarda
+        self.prontas.update(outras)
+        return respostas
+
+    def fechar(self):
+        self.socket.close(0)
+
+
+class ClienteAsync(_ClienteBase):
+    """Conexão DEALER para asyncio: cada `await requisitar(...)` fica em
+    andamento junto com as demais corrotinas que usam o mesmo cliente"""
+
+    def __init__(self, endereco=ENDERECO_PADRAO, timeout_ms=TIMEOUT_MS, tentativas=TENTATIVAS, context=None):
+        super().__init__(timeout_ms, tentativas)
+        self.endereco = endereco
+        self.socket = (context or zmq.asyncio.Context.instance()).socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(endereco)
+        self.futuros = {}  # id -> Future da resposta
+        self.tarefa = None
+
+    async def _receber(self):
+        while True:
+            resultado = self.interpretar(await self.socket.recv_multipart())
+            if resultado is None:
+                continue
+            req_id, reply = resultado
+            futuro = self.futuros.get(req_id)
+            if futuro is None or futuro.done():
+                self.contadores["descartadas"] += 1
+            else:
+                futuro.set_result(reply)
+
+    async def requisitar(self, service, dados=None):
+        """Resposta da requisição, ou None se todas as tentativas expirarem"""
+        if self.tarefa is None:
+            self.tarefa = asyncio.ensure_future(self._receber())
+        req_id, frames = self.montar(service, dados)
+        futuro = self.futuros[req_id] = asyncio.get_running_loop().create_future()
+        try:
+            for tentativa in range(self.tentativas_para(service)):
+                await self.socket.send_multipart(frames)
+                self.contadores["enviadas" if tentativa == 0 else "reenviadas"] += 1
+                try:
+                    return await asyncio.wait_for(asyncio.shield(futuro), self.timeout_ms / 1000.0)
+                except asyncio.TimeoutError:
+                    continue
+            self.contadores["timeouts"] += 1
+            return None
+        finally:
+            self.futuros.pop(req_id, None)
+
+    async def requisitar_varios(self, requisicoes):
+        return await asyncio.gather(*(self.requisitar(service, dados) for service, dados in requisicoes))
+
+    async def fechar(self):
+        if self.tarefa is not None:
+            self.tarefa.cancel()
+            try:
+                await self.tarefa
+            except asyncio.CancelledError:
+                pass
+        self.socket.close(0)
@@ -0,0 +1,454 @@
+import os
+import sys
+import zlib
+import struct
+import bisect
+import logging
+import threading
+from array import array
+import msgpack
+
+from registros import iterar_eventos, REGISTRO
+
+# Cabeçalho de cada registro no segmento: tamanho do payload + CRC32
+CABECALHO = struct.Struct(">II")
+# Cada entrada do índice guarda o offset do registro dentro do segmento
+ENTRADA_INDICE = struct.Struct(">Q")
+# Entrada do índice secundário: tamanhos da chave e da origem, seq e clock do
+# registro, seguidos da chave e da origem
+ENTRADA_SECUNDARIA = struct.Struct(">HHQq")
+# Início de um arquivo de índice secundário no formato acima; um arquivo sem
+# ele (formato anterior, sem a origem) é descartado e refeito a partir do log
+MAGICO_SECUNDARIO = b"SIDX\x02"
+
+logger = logging.getLogger("servidor")
+
+SEGMENTO_MAX_BYTES = int(os.environ.get("SEGMENTO_MAX_BYTES", 64 * 1024 * 1024))
+# Marcador de importação em andamento (importar_json), seguido do nome do arquivo
+PREFIXO_IMPORTACAO = "importando-"
+
+
+class LogSegmentado:
+    """Log append-only em segmentos rotativos com índice de offsets.
+
+    Cada registro recebe um número de sequência global. O segmento
+    `<base>.seg` guarda os registros (tamanho + CRC + payload msgpack) e o
+    `<base>.idx` guarda o offset de cada registro, de forma que gravar e ler
+    um registro custa O(1) independente do tamanho do histórico.
+    """
+
+    def __init__(self, diretorio, max_bytes_segmento=SEGMENTO_MAX_BYTES):
+        self.diretorio = diretorio
+        self.max_bytes_segmento = max_bytes_segmento
+        self.lock = threading.RLock()
+        self.bases = []
+        self.leitores = {}
+        self.seg_escrita = None
+        self.idx_escrita = None
+        self.tamanho_segmento = 0
+        self.proxima_seq = 0
+        self.pendente = False
+        self.indices = []
+        os.makedirs(diretorio, exist_ok=True)
+        self._abrir()
+
+    def _caminho(self, base, extensao):
+        return os.path.join(self.diretorio, f"{base:020d}.{extensao}")
+
+    def _abrir(self):
+        for nome in os.listdir(self.diretorio):
+            if nome.endswith(".seg"):
+                self.bases.append(int(nome[:-4]))
+        self.bases.sort()
+
+        if not self.bases:
+            self._novo_segmento(0)
+            return
+
+        base = self.bases[-1]
+        total = self._recuperar_segmento(base)
+        self.proxima_seq = base + total
+        self.seg_escrita = open(self._caminho(base, "seg"), "ab")
+        self.idx_escrita = open(self._caminho(base, "idx"), "ab")
+        self.tamanho_segmento = self.seg_escrita.tell()
+
+    def _recuperar_segmento(self, base):
+        """Descarta gravações parciais do último segmento e reconstrói o índice"""
+        seg_path = self._caminho(base, "seg")
+        idx_path = self._caminho(base, "idx")
+        tamanho_seg = os.path.getsize(seg_path)
+
+        offsets = []
+        if os.path.exists(idx_path):
+            with open(idx_path, "rb") as f:
+                dados = f.read()
+            total = len(dados) // ENTRADA_INDICE.size
+            offsets = [ENTRADA_INDICE.unpack_from(dados, i * ENTRADA_INDICE.size)[0] for i in range(total)]
+
+        with open(seg_path, "rb") as f:
+            # Só confia em entradas do índice que apontam para registros completos
+            while offsets:
+                f.seek(offsets[-1])
+                if self._ler_registro(f) is not None:
+                    break
+                offsets.pop()
+
+            fim = f.tell() if offsets else 0
+            f.seek(fim)
+            # Registros gravados no segmento mas não no índice
+            while fim < tamanho_seg:
+                if self._ler_registro(f) is None:
+                    break
+                offsets.append(fim)
+                fim = f.tell()
+
+        with open(seg_path, "r+b") as f:
+            f.truncate(fim)
+        with open(idx_path, "wb") as f:
+            f.write(b"".join(ENTRADA_INDICE.pack(o) for o in offsets))
+        return len(offsets)
+
+    @staticmethod
+    def _ler_registro(f):
+        cabecalho = f.read(CABECALHO.size)
+        if len(cabecalho) < CABECALHO.size:
+            return None
+        tamanho, crc = CABECALHO.unpack(cabecalho)
+        payload = f.read(tamanho)
+        if len(payload) < tamanho or zlib.crc32(payload) != crc:
+            return None
+        return payload
+
+    def _novo_segmento(self, base):
+        if self.seg_escrita:
+            self.seg_escrita.close()
+            self.idx_escrita.close()
+        self.bases.append(base)
+        self.seg_escrita = open(self._caminho(base, "seg"), "ab")
+        self.idx_escrita = open(self._caminho(base, "idx"), "ab")
+        self.tamanho_segmento = 0
+
+    def append(self, registro):
+        """Acrescenta um registro ao log e retorna seu número de sequência"""
+        payload = msgpack.packb(registro)
+        with self.lock:
+            if self.tamanho_segmento >= self.max_bytes_segmento:
+                self.flush()
+                self._novo_segmento(self.proxima_seq)
+
+            offset = self.tamanho_segmento
+            self.seg_escrita.write(CABECALHO.pack(len(payload), zlib.crc32(payload)))
+            self.seg_escrita.write(payload)
+            self.idx_escrita.write(ENTRADA_INDICE.pack(offset))
+            self.tamanho_segmento += CABECALHO.size + len(payload)
+            self.pendente = True
+
+            seq = self.proxima_seq
+            self.proxima_seq += 1
+            for indice in self.indices:
+                indice.adicionar_registro(seq, registro)
+            return seq
+
+    def flush(self, fsync=False):
+        """Descarrega os buffers do segmento atual (opcionalmente com fsync)"""
+        with self.lock:
+            if not self.pendente:
+                return
+            self.seg_escrita.flush()
+            self.idx_escrita.flush()
+            if fsync:
+                os.fsync(self.seg_escrita.fileno())
+                os.fsync(self.idx_escrita.fileno())
+            for indice in self.indices:
+                indice.flush(fsync)
+            self.pendente = False
+
+    def registrar_indice(self, indice):
+        """Associa um índice secundário ao log e o atualiza com o que faltar"""
+        with self.lock:
+            indice.truncar(self.proxima_seq)
+            for seq, registro in self.iterar(indice.proxima_seq):
+                indice.adicionar_registro(seq, registro)
+            indice.flush()
+            self.indices.append(indice)
+
+    def _leitor(self, base):
+        fds = self.leitores.get(base)
+        if fds is None:
+            fds = (os.open(self._caminho(base, "seg"), os.O_RDONLY),
+                   os.open(self._caminho(base, "idx"), os.O_RDONLY))
+            self.leitores[base] = fds
+        return fds
+
+    def ler(self, seq):
+        """Lê o registro com o número de sequência informado"""
+        with self.lock:
+            if seq < 0 or seq >= self.proxima_seq:
+                raise IndexError(seq)
+            if self.pendente:
+                self.flush()
+            base = self.bases[bisect.bisect_right(self.bases, seq) - 1]
+            seg_fd, idx_fd = self._leitor(base)
+
+        posicao = (seq - base) * ENTRADA_INDICE.size
+        offset = ENTRADA_INDICE.unpack(os.pread(idx_fd, ENTRADA_INDICE.size, posicao))[0]
+        tamanho, _ = CABECALHO.unpack(os.pread(seg_fd, CABECALHO.size, offset))
+        payload = os.pread(seg_fd, tamanho, offset + CABECALHO.size)
+        return msgpack.unpackb(payload, raw=False)
+
+    def iterar(self, inicio=0):
+        """Percorre (seq, registro) a partir de `inicio` na ordem de gravação"""
+        with self.lock:
+            if self.pendente:
+                self.flush()
+            fim = self.proxima_seq
+            bases = list(self.bases)
+
+        for i, base in enumerate(bases):
+            proxima_base = bases[i + 1] if i + 1 < len(bases) else fim
+            if proxima_base <= inicio:
+                continue
+            seq = base
+            with open(self._caminho(base, "seg"), "rb") as f:
+                while seq < proxima_base:
+                    payload = self._ler_registro(f)
+                    if payload is None:
+                        break
+                    if seq >= inicio:
+                        yield seq, msgpack.unpackb(payload, raw=False)
+                    seq += 1
+
+    def __len__(self):
+        return self.proxima_seq
+
+    def fechar(self):
+        with self.lock:
+            self.pendente = True
+            self.flush(fsync=True)
+            for indice in self.indices:
+                indice.fechar()
+            self.seg_escrita.close()
+            self.idx_escrita.close()
+            for seg_fd, idx_fd in self.leitores.values():
+                os.close(seg_fd)
+                os.close(idx_fd)
+            self.leitores.clear()
+
+
+def ordem_registro(clock, origem, seq):
+    """Posição de um registro na ordem do cluster: (clock, origem, desempate)
+
+    O clock é atribuído pelo servidor de origem (um tick do relógio lógico),
+    então (clock, origem) não se repete e é igual em todas as réplicas.
+    Registros sem origem (importados dos JSON antigos) desempatam pela seq,
+    que é a mesma em todos os servidores porque a importação é feita num
+    log vazio, na ordem do arquivo.
+    """
+    return (clock, origem, seq if origem == "" else 0)
+
+
+class IndiceSecundario:
+    """Índice persistente chave -> números de sequência de um LogSegmentado.
+
+    Guarda, para cada valor de `campo` (ex.: o canal de uma publicação), as
+    seqs dos registros ordenadas por `ordem_registro`, que não depende da
+    ordem em que cada réplica recebeu os registros. Consultas paginadas
+    devolvem só as seqs necessárias, então ler as últimas N entradas de uma
+    chave não depende do tamanho do log inteiro.
+    """
+
+    def __init__(self, caminho, campo):
+        self.caminho = caminho
+        self.campo = campo
+        self.lock = threading.RLock()
+        # chave -> (clocks, ids de origem, seqs), em arrays paralelos ordenados
+        self.entradas = {}
+        self.origens = []
+        self.ids_origem = {}
+        self.proxima_seq = 0
+        self.maior_clock = 0
+        self._carregar()
+        novo = not os.path.exists(caminho) or os.path.getsize(caminho) == 0
+        self.arquivo = open(caminho, "ab")
+        if novo:
+            self.arquivo.write(MAGICO_SECUNDARIO)
+
+    def _carregar(self):
+        if not os.path.exists(self.caminho):
+            return
+        with open(self.caminho, "rb") as f:
+            dados = f.read()
+        if not dados.startswith(MAGICO_SECUNDARIO):
+            os.truncate(self.caminho, 0)
+            return
+        posicao = valido = len(MAGICO_SECUNDARIO)
+        while posicao + ENTRADA_SECUNDARIA.size <= len(dados):
+            tamanho_chave, tamanho_origem, seq, clock = ENTRADA_SECUNDARIA.unpack_from(dados, posicao)
+            inicio = posicao + ENTRADA_SECUNDARIA.size
+            fim = inicio + tamanho_chave + tamanho_origem
+            if fim > len(dados):
+                break
+            chave = dados[inicio:inicio + tamanho_chave].decode("utf-8")
+            origem = dados[inicio + tamanho_chave:fim].decode("utf-8")
+            self._indexar(chave, seq, clock, origem)
+            posicao = valido = fim
+        if valido < len(dados):
+            os.truncate(self.caminho, valido)
+
+    def _id_origem(self, origem):
+        id_origem = self.ids_origem.get(origem)
+        if id_origem is None:
+            id_origem = self.ids_origem[origem] = len(self.origens)
+            self.origens.append(origem)
+        return id_origem
+
+    def _ordem(self, entradas, i):
+        clocks, origens, seqs = entradas
+        return ordem_registro(clocks[i], self.origens[origens[i]], seqs[i])
+
+    def _posicao(self, entradas, ordem, depois_de_iguais):
+        """Índice da primeira entrada com ordem > `ordem` (ou >=)"""
+        clocks = entradas[0]
+        inicio = bisect.bisect_left(clocks, ordem[0])
+        fim = bisect.bisect_right(clocks, ordem[0])
+        # Mesmo clock: poucas entradas, compara o resto da ordem
+        while inicio < fim:
+            atual = self._ordem(entradas, inicio)
+            if atual > ordem or (atual == ordem and not depois_de_iguais):
+                break
+            inicio += 1
+        return inicio
+
+    def _indexar(self, chave, seq, clock, origem):
+        entradas = self.entradas.get(chave)
+        if entradas is None:
+            entradas = self.entradas[chave] = (array("q"), array("H"), array("Q"))
+        clocks, origens, seqs = entradas
+        id_origem = self._id_origem(origem)
+        ordem = ordem_registro(clock, origem, seq)
+        if not clocks or self._ordem(entradas, len(clocks) - 1) < ordem:
+            # Caso comum: o registro mais recente vai para o fim
+            clocks.append(clock)
+            origens.append(id_origem)
+            seqs.append(seq)
+        else:
+            i = self._posicao(entradas, ordem, True)
+            clocks.insert(i, clock)
+            origens.insert(i, id_origem)
+            seqs.insert(i, seq)
+        self.proxima_seq = max(self.proxima_seq, seq + 1)
+        self.maior_clock = max(self.maior_clock, clock)
+
+    def _codificar(self, chave, seq, clock, origem):
+        chave = chave.encode("utf-8")
+        origem = origem.encode("utf-8")
+        return ENTRADA_SECUNDARIA.pack(len(chave), len(origem), seq, clock) + chave + origem
+
+    def adicionar_registro(self, seq, registro):
+        chave = registro.get(self.campo)
+        if chave is None:
+            return
+        chave = str(chave)
+        clock = int(registro.get("clock") or 0)
+        origem = str(registro.get("origin") or "")
+        with self.lock:
+            self._indexar(chave, seq, clock, origem)
+            self.arquivo.write(self._codificar(chave, seq, clock, origem))
+
+    def truncar(self, total):
+        """Descarta entradas que apontam além do fim do log (após uma queda)"""
+        with self.lock:
+            if self.proxima_seq <= total:
+                return
+            self.arquivo.close()
+            restantes = []
+            for chave, (clocks, origens, seqs) in self.entradas.items():
+                for clock, id_origem, seq in zip(clocks, origens, seqs):
+                    if seq < total:
+                        restantes.append((seq, chave, clock, self.origens[id_origem]))
+            restantes.sort()
+            self.entradas, self.proxima_seq, self.maior_clock = {}, 0, 0
+            with open(self.caminho, "wb") as f:
+                f.write(MAGICO_SECUNDARIO)
+                for seq, chave, clock, origem in restantes:
+                    self._indexar(chave, seq, clock, origem)
+                    f.write(self._codificar(chave, seq, clock, origem))
+            self.proxima_seq = max(self.proxima_seq, total)
+            self.arquivo = open(self.caminho, "ab")
+
+    def consultar(self, chave, antes=None, depois=None, limite=50):
+        """Retorna até `limite` (seq, ordem) da chave, em ordem crescente
+
+        `antes`/`depois` são cursores exclusivos no formato de
+        `ordem_registro`. Sem cursor, retorna as últimas entradas; só com
+        `depois`, as primeiras após o cursor.
+        """
+        with self.lock:
+            entradas = self.entradas.get(chave)
+            if not entradas or limite <= 0:
+                return []
+            inicio = self._posicao(entradas, depois, True) if depois is not None else 0
+            fim = self._posicao(entradas, antes, False) if antes is not None else len(entradas[0])
+            if depois is not None and antes is None:
+                posicoes = range(inicio, min(fim, inicio + limite))
+            else:
+                posicoes = range(max(inicio, fim - limite), fim)
+            return [(entradas[2][i], self._ordem(entradas, i)) for i in posicoes]
+
+    def flush(self, fsync=False):
+        with self.lock:
+            self.arquivo.flush()
+            if fsync:
+                os.fsync(self.arquivo.fileno())
+
+    def fechar(self):
+        with self.lock:
+            self.arquivo.close()
+
+
+def importar_json(caminho_json, log):
+    """Importa (uma única vez) um arquivo JSON legado para o log
+
+    Aceita também o formato compacto de registros (ver registros.py) e lê o
+    arquivo por partes. Só importa se o log ainda estiver vazio, então pode
+    ser chamado em toda inicialização sem duplicar registros. Um marcador
+    no diretório do log fica lá enquanto a importação não termina: se ela
+    for interrompida, a próxima chamada continua a partir dos registros que
+    já estão no log. Retorna quantos registros entraram.
+    """
+    marcador = os.path.join(log.diretorio, PREFIXO_IMPORTACAO + os.path.basename(caminho_json))
+    retomar = os.path.exists(marcador)
+    if (len(log) > 0 and not retomar) or not os.path.exists(caminho_json):
+        return 0
+    if retomar:
+        logger.warning("Retomando importacao de %s apos %d registros", caminho_json, len(log))
+    else:
+        with open(marcador, "wb") as arquivo:
+            os.fsync(arquivo.fileno())
+    # A importação roda antes de o servidor atender: o log só tem registros dela
+    pular = len(log)
+    total = 0
+    try:
+        for tipo, registro in iterar_eventos(caminho_json):
+            if tipo != REGISTRO:
+                continue
+            if pular:
+                pular -= 1
+                continue
+            log.append(registro)
+            total += 1
+    except (OSError, ValueError) as e:
+        logger.warning("Importacao de %s interrompida apos %d registros: %s", caminho_json, total, e)
+    log.flush(fsync=True)
+    os.remove(marcador)
+    return total
+
+if __name__ == "__main__":
+    # Uso: python armazenamento.py <arquivo.json> <diretorio_do_log>
+    if len(sys.argv) != 3:
+        print("Uso: python armazenamento.py <arquivo.json> <diretorio_do_log>")
+        sys.exit(1)
+    log = LogSegmentado(sys.argv[2])
+    total = importar_json(sys.argv[1], log)
+    log.fechar()
+    print(f"{total} registros importados para {sys.argv[2]}")
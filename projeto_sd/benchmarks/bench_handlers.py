@@ -0,0 +1,146 @@
+"""Benchmarks dos handlers do servidor, executados no próprio processo
+
+Não precisa de Docker nem dos hostnames do cluster: o estado é montado num
+diretório temporário, o PUB de canais fica num endpoint inproc sem
+assinantes e a replicação usa um pool sem outros servidores.
+
+    pip install pytest-benchmark
+    pytest projeto_sd/benchmarks/bench_handlers.py --benchmark-group-by=param:tamanho
+
+BENCH_TAMANHOS escolhe os volumes de usuários/canais/publicações
+(padrão 1000,10000,100000).
+"""
+import os
+import sys
+import json
+import itertools
+
+import pytest
+import msgpack
+import zmq
+
+pytest.importorskip("pytest_benchmark")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import servidor  # noqa: E402
+from replicacao import PoolReplicacao  # noqa: E402
+
+TAMANHOS = [int(n) for n in os.environ.get("BENCH_TAMANHOS", "1000,10000,100000").split(",")]
+# As publicações pré-carregadas se espalham por estes canais (históricos com tamanho/100 entradas)
+CANAIS_ATIVOS = 100
+
+contador = itertools.count()
+
+
+@pytest.fixture(scope="module", params=TAMANHOS, ids=lambda n: f"tamanho={n}")
+def tamanho(request, tmp_path_factory):
+    """Servidor com `tamanho` usuários, canais, publicações e mensagens privadas"""
+    n = request.param
+    diretorio = tmp_path_factory.mktemp(f"dados_{n}")
+    anterior = {nome: getattr(servidor, nome) for nome in ("DATA_DIR", "ESTADO_DIR")}
+    servidor.DATA_DIR = str(diretorio)
+    servidor.ESTADO_DIR = str(diretorio / "estado")
+    os.environ["LOG_DIR"] = str(diretorio / "logs")
+    os.environ.setdefault("PERSISTENCIA_FSYNC", "none")
+
+    servidor.iniciar_armazenamento()
+    servidor.pub_socket = zmq.Context.instance().socket(zmq.PUB)
+    servidor.pub_socket.bind(f"inproc://bench-pub-{n}")
+    servidor.replicador = PoolReplicacao(servidor.NOME_SERVIDOR, servidor.REPLICATION_PORT, lambda: [])
+
+    for i in range(n):
+        servidor.usuarios[f"u{i}"] = {"user": f"u{i}", "timestamp": i}
+        servidor.canais[f"c{i}"] = {"channel": f"c{i}", "timestamp": i}
+    for i in range(n):
+        servidor.publicacoes_log.append({"user": f"u{i % n}", "channel": f"c{i % CANAIS_ATIVOS}",
+                                         "message": f"mensagem {i}", "timestamp": i, "clock": i})
+        servidor.mensagens_log.append({"src": f"u{i % n}", "dst": f"u{(i * 7) % CANAIS_ATIVOS}",
+                                       "message": f"mensagem {i}", "timestamp": i, "clock": i})
+    with servidor.lock_estado:
+        servidor.invalidar_listagem("users")
+        servidor.invalidar_listagem("channels")
+    servidor.compactar_estado()
+    servidor.publicacoes_log.flush()
+    servidor.mensagens_log.flush()
+
+    yield n
+
+    servidor.encerrar_armazenamento()
+    servidor.pub_socket.close(0)
+    servidor.pub_socket = None
+    servidor.replicador = None
+    servidor.usuarios = {}
+    servidor.canais = {}
+    for nome, valor in anterior.items():
+        setattr(servidor, nome, valor)
+    del os.environ["LOG_DIR"]
+
+
+def novo_nome(prefixo):
+    return f"{prefixo}{next(contador)}"
+
+
+def test_login(benchmark, tamanho):
+    reply = benchmark(lambda: servidor.servico_login({"user": novo_nome("novo"), "timestamp": 0}))
+    assert reply["data"]["status"] == "sucesso"
+
+
+def test_users(benchmark, tamanho):
+    reply = benchmark(servidor.servico_users, {})
+    assert len(reply["data"]["users"].nomes) >= tamanho
+
+
+def test_channel(benchmark, tamanho):
+    reply = benchmark(lambda: servidor.servico_channel({"channel": novo_nome("canal"), "timestamp": 0}))
+    assert reply["data"]["status"] == "sucesso"
+
+
+def test_channels(benchmark, tamanho):
+    reply = benchmark(servidor.servico_channels, {})
+    assert len(reply["data"]["channels"].nomes) >= tamanho
+
+
+def test_publish(benchmark, tamanho):
+    dados = {"user": "u1", "channel": "c1", "message": "ola", "timestamp": 0}
+    reply = benchmark(servidor.servico_publish, dados)
+    assert reply["data"]["status"] == "OK"
+
+
+def test_message(benchmark, tamanho):
+    dados = {"src": "u1", "dst": "u2", "message": "ola", "timestamp": 0}
+    reply = benchmark(servidor.servico_message, dados)
+    assert reply["data"]["status"] == "OK"
+
+
+def test_history(benchmark, tamanho):
+    reply = benchmark(servidor.servico_history, {"channel": "c1", "limit": 50})
+    assert reply["data"]["status"] == "OK"
+
+
+def test_inbox(benchmark, tamanho):
+    reply = benchmark(servidor.servico_inbox, {"dst": "u7", "limit": 50})
+    assert reply["data"]["status"] == "OK"
+
+
+def test_requisicao_publish(benchmark, tamanho):
+    """Caminho completo: decodificação, dispatch, handler e codificação"""
+    request = msgpack.packb({"service": "publish",
+                             "data": {"user": "u1", "channel": "c1", "message": "ola", "timestamp": 0, "clock": 1}})
+    resposta = msgpack.unpackb(benchmark(servidor.processar_requisicao, request), raw=False)
+    assert resposta["data"]["status"] == "OK"
+
+
+def test_requisicao_users(benchmark, tamanho):
+    """Listagem completa: a lista de nomes vem codificada do cache"""
+    request = msgpack.packb({"service": "users", "data": {"clock": 1}})
+    resposta = msgpack.unpackb(benchmark(servidor.processar_requisicao, request), raw=False)
+    assert len(resposta["data"]["users"]) >= tamanho
+
+
+def test_requisicao_publish_json(benchmark, tamanho):
+    """Cliente JSON: o formato sai do primeiro byte, sem tentar MessagePack antes"""
+    request = json.dumps({"service": "publish",
+                          "data": {"user": "u1", "channel": "c1", "message": "ola", "timestamp": 0, "clock": 1}}).encode()
+    resposta = json.loads(benchmark(servidor.processar_requisicao, request))
+    assert resposta["data"]["status"] == "OK"
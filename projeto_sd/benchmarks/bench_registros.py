@@ -0,0 +1,54 @@
+"""Benchmarks do formato de registros (registros.py) com verificação de ida e volta
+
+    pytest projeto_sd/benchmarks/bench_registros.py
+
+A leitura por partes do JSON usa blocos pequenos de propósito: números,
+strings e registros ficam cortados na fronteira entre blocos.
+"""
+import io
+import os
+import sys
+import json
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from registros import LeitorJson, escrever_json, converter_para_registros, converter_para_json, carregar  # noqa: E402
+
+DOCUMENTO = json.dumps({
+    "users": [{"user": f"u{i}", "timestamp": 1700000000.125 + i} for i in range(200)],
+    "channels": [],
+    "versao": 2.5,
+    "limite": 5e10,
+    "fator": -1.25e-3,
+    "ativo": True,
+    "dono": None,
+}, indent=2, ensure_ascii=False)
+
+
+def reescrever(documento, bloco):
+    saida = io.StringIO()
+    escrever_json(LeitorJson(io.StringIO(documento), bloco=bloco), saida)
+    return saida.getvalue()
+
+
+@pytest.mark.parametrize("bloco", [1, 3, 7, 64])
+def test_leitor_json_blocos_pequenos(benchmark, bloco):
+    assert benchmark(reescrever, DOCUMENTO, bloco) == DOCUMENTO
+
+
+@pytest.mark.parametrize("documento", ["{}", "[]", DOCUMENTO])
+def test_ida_e_volta_registros(benchmark, tmp_path, documento):
+    entrada, registros, saida = tmp_path / "e.json", tmp_path / "e.bbr", tmp_path / "s.json"
+    entrada.write_text(documento, encoding="utf-8")
+
+    def ida_e_volta():
+        converter_para_registros(str(entrada), str(registros))
+        converter_para_json(str(registros), str(saida))
+
+    benchmark(ida_e_volta)
+    assert saida.read_text(encoding="utf-8") == documento
+    assert carregar(str(registros)) == json.loads(documento)
@@ -0,0 +1,110 @@
+"""Recuperação da replicação em fluxo (StreamReplicacao) após a poda de lotes
+
+    pytest projeto_sd/benchmarks/bench_replicacao.py
+
+A origem publica num SUB local em vez do proxy, e os lotes são entregues ao
+receptor à mão: assim dá para simular um servidor que perdeu lotes que a
+origem já descartou.
+"""
+import os
+import sys
+import time
+import itertools
+
+import pytest
+import msgpack
+import zmq
+
+pytest.importorskip("pytest_benchmark")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from replicacao import StreamReplicacao  # noqa: E402
+
+contador = itertools.count()
+
+
+def criar(nome, aplicadas, **opcoes):
+    n = next(contador)
+    return StreamReplicacao(nome, lambda service, data: aplicadas.append(data["n"]),
+                            endereco_pub=f"inproc://rep-pub-{nome}-{n}", endereco_sub=f"inproc://rep-sub-{nome}-{n}",
+                            tamanho_lote=1, linger_ms=0, **opcoes)
+
+
+def capturar(origem):
+    """SUB ligado ao endereço onde a origem publica"""
+    sub = zmq.Context.instance().socket(zmq.SUB)
+    sub.bind(origem.endereco_pub)
+    sub.setsockopt(zmq.SUBSCRIBE, b"")
+    return sub
+
+
+def receber(sub, quantidade):
+    lotes = []
+    while len(lotes) < quantidade:
+        assert sub.poll(5000), f"esperava {quantidade} lotes, chegaram {len(lotes)}"
+        lotes.append(msgpack.unpackb(sub.recv_multipart()[1], raw=False))
+    return lotes
+
+
+def publicar(origem, sub, quantidade, inicio=0):
+    time.sleep(0.1)  # conexão inproc do PUB da origem
+    for n in range(inicio, inicio + quantidade):
+        origem.replicar({"service": "publish", "data": {"n": n}})
+    return receber(sub, quantidade)
+
+
+def test_recupera_apos_poda(benchmark):
+    origem = criar("a", [], retencao=3)
+    sub = capturar(origem)
+    aplicadas = []
+    receptor = criar("b", aplicadas)
+
+    lotes = publicar(origem, sub, 1)
+    origem._registrar_ack(receptor._receber_lote(lotes[0]))
+    lotes += publicar(origem, sub, 9, inicio=1)
+    # Perde os lotes 2-9; o 10 fica adiantado e pede retransmissão desde o 1
+    ack = receptor._receber_lote(lotes[9])
+    assert ack["retransmitir"] and ack["ate"] == 1
+    origem._registrar_ack(ack)
+
+    # A origem só retém os lotes 8-10: manda o salto até 7 e depois eles
+    retransmitidos = receber(sub, 4)
+    assert retransmitidos[0]["salto_ate"] == 7
+
+    def aplicar():
+        for lote in retransmitidos:
+            ack = receptor._receber_lote(lote)
+        return ack
+
+    ack = benchmark.pedantic(aplicar, rounds=1, iterations=1)
+    assert ack == {"servidor": "b", "epoca": origem.epoca, "ate": 10, "retransmitir": False}
+    assert aplicadas == [0, 7, 8, 9]
+    assert receptor.metricas()["lotes_perdidos"] == 6
+
+    # Depois do salto a replicação segue normalmente
+    for lote in publicar(origem, sub, 2, inicio=10):
+        ack = receptor._receber_lote(lote)
+    assert ack["ate"] == 12 and aplicadas[-2:] == [10, 11]
+
+
+def test_limite_de_pendentes():
+    origem = criar("c", [])
+    sub = capturar(origem)
+    aplicadas = []
+    receptor = criar("d", aplicadas, max_pendentes=4)
+
+    lotes = publicar(origem, sub, 20)
+    receptor._receber_lote(lotes[0])
+    for lote in lotes[2:]:
+        ack = receptor._receber_lote(lote)
+    assert len(receptor.origens["c"]["pendentes"]) == 4
+    assert ack["retransmitir"]
+
+    # O lote que faltava libera os guardados; os descartados voltam na retransmissão
+    receptor._receber_lote(lotes[1])
+    assert receptor.origens["c"]["aplicado"] == 6
+    for lote in lotes[6:]:
+        ack = receptor._receber_lote(lote)
+    assert ack == {"servidor": "d", "epoca": origem.epoca, "ate": 20, "retransmitir": False}
+    assert aplicadas == list(range(20))
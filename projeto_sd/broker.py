@@ -1,20 +1,228 @@
+import os
+import time
+import collections
 import zmq
+import msgpack
 
-context = zmq.Context()
+# BROKER_MODO:
+#   proxy      - zmq.proxy(ROUTER, DEALER): distribui em round-robin às cegas
+#   balanceado - os servidores se anunciam (PRONTO) e mandam heartbeats; cada
+#                requisição vai para o servidor vivo com menos requisições em
+#                andamento, e as de um servidor que sumiu são reenviadas ou
+#                respondidas com erro (BROKER_FALHA)
+BROKER_MODO = os.environ.get("BROKER_MODO", "proxy")
+
+# Protocolo broker <-> servidor no modo balanceado (o servidor usa um DEALER;
+# ver servidor.ConexaoBroker). Todas as mensagens começam por um comando:
+#   servidor -> broker: [PRONTO, capacidade] | [HEARTBEAT] | [RESPOSTA, seq, envelope..., payload]
+#   broker -> servidor: [REQUISICAO, seq, envelope..., payload] | [HEARTBEAT]
+# `envelope` são os frames de roteamento do cliente (terminados pelo frame vazio).
+PRONTO = b"PRONTO"
+HEARTBEAT = b"HB"
+REQUISICAO = b"REQ"
+RESPOSTA = b"REP"
+
+HEARTBEAT_INTERVALO = float(os.environ.get("BROKER_HEARTBEAT", 1.0))
+# Heartbeats perdidos até o servidor ser considerado morto
+HEARTBEAT_TOLERANCIA = 3
+# reenviar - as requisições em andamento de um servidor morto vão para outro
+# erro     - o cliente recebe uma resposta de erro imediatamente
+BROKER_FALHA = os.environ.get("BROKER_FALHA", "erro")
+# Tempo máximo (s) que uma requisição espera na fila sem servidor disponível
+ESPERA_MAXIMA = float(os.environ.get("BROKER_ESPERA_MAXIMA", 5.0))
+FILA_MAXIMA = int(os.environ.get("BROKER_FILA", 10000))
+RELATORIO_INTERVALO = float(os.environ.get("BROKER_RELATORIO", 10))
+MAX_LOTE = 1000
+
+
+def executar_proxy(context):
+    client_socket = context.socket(zmq.ROUTER)
+    client_socket.bind("tcp://*:5555")
+    print("[BROKER] ROUTER porta 5555", flush=True)
+
+    server_socket = context.socket(zmq.DEALER)
+    server_socket.bind("tcp://*:5556")
+    print("[BROKER] DEALER porta 5556", flush=True)
+
+    try:
+        zmq.proxy(client_socket, server_socket)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client_socket.close()
+        server_socket.close()
+
+
+class Servidor:
+    def __init__(self, identidade, capacidade):
+        self.identidade = identidade
+        self.capacidade = capacidade
+        self.em_andamento = {}  # seq -> requisição
+        self.atendidas = 0
+        self.expira = time.monotonic() + HEARTBEAT_INTERVALO * HEARTBEAT_TOLERANCIA
+
+    def livre(self):
+        return len(self.em_andamento) < self.capacidade
+
+
+class BrokerBalanceado:
+    def __init__(self, context):
+        self.frontend = context.socket(zmq.ROUTER)
+        self.frontend.bind("tcp://*:5555")
+        self.backend = context.socket(zmq.ROUTER)
+        # Um servidor que reconecta com a mesma identidade substitui a conexão antiga
+        self.backend.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        self.backend.bind("tcp://*:5556")
+        self.servidores = {}
+        # Requisições aguardando servidor: (seq, envelope, payload, chegada)
+        self.pendentes = collections.deque()
+        self.seq = 0
+        self.contadores = {"requisicoes": 0, "respostas": 0, "reenviadas": 0, "falhas": 0, "atrasadas": 0}
+        self.proximo_heartbeat = time.monotonic() + HEARTBEAT_INTERVALO
+        self.proximo_relatorio = time.monotonic() + RELATORIO_INTERVALO
+        print(f"[BROKER] Balanceado: clientes 5555, servidores 5556 (falha: {BROKER_FALHA})", flush=True)
+
+    def responder_erro(self, envelope, descricao):
+        self.contadores["falhas"] += 1
+        reply = {
+            "service": "unknown",
+            "data": {"status": "erro", "description": descricao, "timestamp": time.time()}
+        }
+        self.frontend.send_multipart(envelope + [msgpack.packb(reply)])
 
-client_socket = context.socket(zmq.ROUTER)
-client_socket.bind("tcp://*:5555")
-print("[BROKER] ROUTER porta 5555", flush=True)
+    def escolher(self):
+        """Servidor vivo com capacidade livre e menos requisições em andamento"""
+        melhor = None
+        for servidor in self.servidores.values():
+            if servidor.livre() and (melhor is None or len(servidor.em_andamento) < len(melhor.em_andamento)):
+                melhor = servidor
+        return melhor
 
-server_socket = context.socket(zmq.DEALER)
-server_socket.bind("tcp://*:5556")
-print("[BROKER] DEALER porta 5556", flush=True)
+    def despachar(self):
+        while self.pendentes:
+            servidor = self.escolher()
+            if servidor is None:
+                return
+            seq, envelope, payload, chegada = self.pendentes.popleft()
+            servidor.em_andamento[seq] = (envelope, payload, chegada)
+            self.backend.send_multipart([servidor.identidade, REQUISICAO, seq.to_bytes(8, "big")] + envelope + [payload])
 
+    def receber_cliente(self, frames):
+        # [identidade, ..., b"", payload]: tudo antes do payload é o envelope
+        envelope, payload = frames[:-1], frames[-1]
+        self.contadores["requisicoes"] += 1
+        if len(self.pendentes) >= FILA_MAXIMA:
+            self.responder_erro(envelope, "Broker sobrecarregado")
+            return
+        self.seq += 1
+        self.pendentes.append((self.seq, envelope, payload, time.monotonic()))
+
+    def receber_servidor(self, frames):
+        identidade, comando = frames[0], frames[1]
+        servidor = self.servidores.get(identidade)
+
+        if comando == PRONTO:
+            capacidade = int(frames[2]) if len(frames) > 2 else 1
+            if servidor is None:
+                print(f"[BROKER] Servidor pronto: {identidade.decode(errors='replace')} (capacidade {capacidade})", flush=True)
+                servidor = self.servidores[identidade] = Servidor(identidade, capacidade)
+            else:
+                # Servidor reiniciado com a mesma identidade: o que estava em andamento se perdeu
+                self.remover(servidor)
+                servidor = self.servidores[identidade] = Servidor(identidade, capacidade)
+        elif servidor is None:
+            # Servidor que o broker não conhece (ex.: broker reiniciado): pede um novo PRONTO
+            self.backend.send_multipart([identidade, PRONTO])
+            return
+        elif comando == RESPOSTA:
+            seq = int.from_bytes(frames[2], "big")
+            if servidor.em_andamento.pop(seq, None) is None:
+                # Já foi reenviada ou respondida com erro
+                self.contadores["atrasadas"] += 1
+            else:
+                servidor.atendidas += 1
+                self.contadores["respostas"] += 1
+                self.frontend.send_multipart(frames[3:])
+
+        servidor.expira = time.monotonic() + HEARTBEAT_INTERVALO * HEARTBEAT_TOLERANCIA
+
+    def remover(self, servidor):
+        self.servidores.pop(servidor.identidade, None)
+        requisicoes = sorted(servidor.em_andamento.items())
+        if requisicoes:
+            print(f"[BROKER] {servidor.identidade.decode(errors='replace')} perdeu {len(requisicoes)} requisições em andamento", flush=True)
+        if BROKER_FALHA == "reenviar":
+            for seq, (envelope, payload, chegada) in reversed(requisicoes):
+                self.pendentes.appendleft((seq, envelope, payload, chegada))
+                self.contadores["reenviadas"] += 1
+        else:
+            for _, (envelope, _, _) in requisicoes:
+                self.responder_erro(envelope, "Servidor indisponivel")
+
+    def manutencao(self):
+        agora = time.monotonic()
+        for servidor in list(self.servidores.values()):
+            if agora > servidor.expira:
+                print(f"[BROKER] Servidor sem heartbeat: {servidor.identidade.decode(errors='replace')}", flush=True)
+                self.remover(servidor)
+
+        while self.pendentes and agora - self.pendentes[0][3] > ESPERA_MAXIMA:
+            _, envelope, _, _ = self.pendentes.popleft()
+            self.responder_erro(envelope, "Nenhum servidor disponivel")
+
+        if agora >= self.proximo_heartbeat:
+            for identidade in self.servidores:
+                self.backend.send_multipart([identidade, HEARTBEAT])
+            self.proximo_heartbeat = agora + HEARTBEAT_INTERVALO
+
+        if RELATORIO_INTERVALO > 0 and agora >= self.proximo_relatorio:
+            print(f"[BROKER] {self.metricas()}", flush=True)
+            self.proximo_relatorio = agora + RELATORIO_INTERVALO
+
+    def metricas(self):
+        return dict(
+            self.contadores,
+            pendentes=len(self.pendentes),
+            servidores={
+                s.identidade.decode(errors="replace"): {
+                    "em_andamento": len(s.em_andamento),
+                    "capacidade": s.capacidade,
+                    "atendidas": s.atendidas,
+                }
+                for s in self.servidores.values()
+            },
+        )
+
+    def executar(self):
+        poller = zmq.Poller()
+        poller.register(self.frontend, zmq.POLLIN)
+        poller.register(self.backend, zmq.POLLIN)
+        while True:
+            socks = dict(poller.poll(HEARTBEAT_INTERVALO * 1000 / 2))
+            # Drena o que estiver disponível, com limite para não deixar o outro lado esperando
+            if self.backend in socks:
+                for _ in range(MAX_LOTE):
+                    try:
+                        self.receber_servidor(self.backend.recv_multipart(zmq.NOBLOCK))
+                    except zmq.Again:
+                        break
+            if self.frontend in socks:
+                for _ in range(MAX_LOTE):
+                    try:
+                        self.receber_cliente(self.frontend.recv_multipart(zmq.NOBLOCK))
+                    except zmq.Again:
+                        break
+            self.despachar()
+            self.manutencao()
+
+
+context = zmq.Context()
 try:
-    zmq.proxy(client_socket, server_socket)
+    if BROKER_MODO == "balanceado":
+        BrokerBalanceado(context).executar()
+    else:
+        executar_proxy(context)
 except KeyboardInterrupt:
     pass
 finally:
-    client_socket.close()
-    server_socket.close()
-    context.term()
+    context.destroy(linger=0)
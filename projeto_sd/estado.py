@@ -0,0 +1,256 @@
+import os
+import logging
+import threading
+
+from registros import EscritorRegistros, LeitorRegistros, MAGICO, REGISTRO, SECAO, METADADO
+
+logger = logging.getLogger("servidor")
+
+# Persistência de usuários e canais em snapshot + WAL (write-ahead log).
+#
+# Cada servidor grava os próprios arquivos no volume compartilhado:
+#
+#   <nome>.snap  - estado completo no formato de registros (seções "users" e
+#                  "channels" e o metadado "posicoes"); só é reescrito na
+#                  compactação, via arquivo temporário + rename
+#   <nome>.wal   - registros [tipo, registro] dos usuários/canais novos; o
+#                  gravador acrescenta um quadro por lote (group commit)
+#   <nome>.wal.1 - WAL girado durante uma compactação em andamento
+#
+# Compactar: gira o WAL, grava o snapshot com o estado em memória e apaga o
+# WAL girado. Reaplicar um registro já conhecido não muda nada (o nome já
+# existe), então uma queda em qualquer ponto não perde nem duplica dados.
+#
+# Os arquivos dos outros servidores são acompanhados por posição (versão do
+# snapshot, inode e offset do WAL): cada leitura só processa o que foi
+# acrescentado depois da anterior, e o snapshot de outro servidor só é relido
+# quando ele compactou. As posições vão junto no snapshot, então a
+# inicialização também só lê a cauda dos WALs.
+SUFIXO_SNAPSHOT = ".snap"
+SUFIXO_WAL = ".wal"
+SUFIXO_WAL_GIRADO = ".wal.1"
+# Os registros de um lote do gravador viram um único quadro do WAL
+QUADRO_WAL = 1 << 30
+
+
+def versao_arquivo(caminho):
+    try:
+        st = os.stat(caminho)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+    except OSError:
+        return None
+
+
+# As leituras retornam blocos (tipo, [registros]): um quadro do snapshot vira
+# um bloco inteiro, sem montar uma tupla por registro
+def ler_snapshot(caminho):
+    """Retorna ([(tipo, registros)], metadados) de um snapshot"""
+    blocos = []
+    metadados = {}
+    tipo_atual = None
+    for tipo, valor in LeitorRegistros(caminho).quadros():
+        if tipo == REGISTRO:
+            blocos.append((tipo_atual, valor))
+        elif tipo == SECAO:
+            tipo_atual = valor
+        elif tipo == METADADO:
+            metadados[valor[0]] = valor[1]
+    return blocos, metadados
+
+
+def ler_wal(caminho, inicio=0):
+    """Retorna ([(tipo, registros)], fim_valido) a partir do offset `inicio`"""
+    if not inicio and os.path.getsize(caminho) < len(MAGICO):
+        return [], 0  # recém-criado, cabeçalho ainda não gravado
+    leitor = LeitorRegistros(caminho, inicio)
+    blocos = []
+    for tipo, valor in leitor.quadros():
+        if tipo == REGISTRO:
+            blocos.extend((entrada[0], [entrada[1]]) for entrada in valor)
+    return blocos, leitor.fim_valido
+
+
+class EstadoPersistente:
+    """Snapshot + WAL dos usuários e canais de um servidor
+
+    `registrar` roda na thread de persistência e devolve o próprio objeto,
+    que o gravador sincroniza com `flush(fsync)` ao final do lote. `compactar`
+    pode rodar em outra thread: `lock` protege o WAL entre as duas.
+    """
+
+    def __init__(self, diretorio, nome):
+        self.diretorio = diretorio
+        self.nome = nome
+        self.lock = threading.Lock()
+        self.wal = None
+        self.wal_bytes = 0
+        # Outro servidor -> {"snapshot": versão lida, "wal": [inode, offset]}
+        self.posicoes = {}
+        self.contadores = {"compactacoes": 0, "registros_wal": 0, "registros_snapshot": 0}
+        os.makedirs(diretorio, exist_ok=True)
+
+    def caminho(self, nome, sufixo):
+        return os.path.join(self.diretorio, nome + sufixo)
+
+    def existe(self):
+        """Se este servidor já tem snapshot ou WAL (senão é a primeira inicialização)"""
+        return any(os.path.exists(self.caminho(self.nome, sufixo))
+                   for sufixo in (SUFIXO_SNAPSHOT, SUFIXO_WAL, SUFIXO_WAL_GIRADO))
+
+    def precisa_compactar(self):
+        """Sobrou um WAL girado de uma compactação interrompida"""
+        return os.path.exists(self.caminho(self.nome, SUFIXO_WAL_GIRADO))
+
+    def carregar(self):
+        """Lê o estado próprio e o dos outros servidores e abre o WAL
+
+        Retorna os blocos (tipo, registros) na ordem em que devem ser
+        indexados. Chamado uma vez, antes de o servidor atender.
+        """
+        entradas = []
+        snapshot = self.caminho(self.nome, SUFIXO_SNAPSHOT)
+        if os.path.exists(snapshot):
+            entradas, metadados = ler_snapshot(snapshot)
+            self.contadores["registros_snapshot"] = sum(len(registros) for _, registros in entradas)
+            self.posicoes = metadados.get("posicoes", {})
+
+        for sufixo in (SUFIXO_WAL_GIRADO, SUFIXO_WAL):
+            caminho = self.caminho(self.nome, sufixo)
+            if not os.path.exists(caminho):
+                continue
+            novas, fim = ler_wal(caminho)
+            entradas.extend(novas)
+            self.contadores["registros_wal"] += len(novas)
+            if sufixo == SUFIXO_WAL and fim < os.path.getsize(caminho):
+                # Quadro incompleto de uma gravação interrompida: descarta
+                logger.warning("%s: descartando %d bytes no fim do WAL", caminho, os.path.getsize(caminho) - fim)
+                os.truncate(caminho, fim)
+
+        wal = self.caminho(self.nome, SUFIXO_WAL)
+        self.wal = EscritorRegistros(wal, anexar=True, registros_por_quadro=QUADRO_WAL)
+        self.wal.flush()
+        self.wal_bytes = self.wal.arquivo.tell()
+
+        outras, self.posicoes = self.ler_outros(self.posicoes)
+        entradas.extend(outras)
+        return entradas
+
+    def registrar(self, tipo, registro):
+        """Acrescenta um usuário ("users") ou canal ("channels") ao WAL"""
+        with self.lock:
+            self.wal.registro([tipo, registro])
+        return self
+
+    def flush(self, fsync=False):
+        with self.lock:
+            self.wal.flush(fsync)
+            self.wal_bytes = self.wal.arquivo.tell()
+
+    def compactar(self, copiar_estado, fsync=True):
+        """Grava um snapshot novo e descarta o WAL que ele cobre
+
+        `copiar_estado()` retorna (usuarios, canais, posicoes) consistentes
+        entre si; é chamada depois de girar o WAL, então tudo o que foi para o
+        WAL girado já está em memória e entra no snapshot.
+        """
+        wal = self.caminho(self.nome, SUFIXO_WAL)
+        girado = self.caminho(self.nome, SUFIXO_WAL_GIRADO)
+        with self.lock:
+            self.wal.fechar(fsync)
+            if os.path.exists(girado):
+                # Compactação anterior interrompida: o conteúdo já foi
+                # carregado na memória, basta juntar os dois no snapshot
+                with open(girado, "ab") as destino, open(wal, "rb") as origem:
+                    origem.seek(len(MAGICO))
+                    destino.write(origem.read())
+                os.remove(wal)
+            else:
+                os.replace(wal, girado)
+            self.wal = EscritorRegistros(wal, registros_por_quadro=QUADRO_WAL)
+            self.wal.flush(fsync)
+            self.wal_bytes = self.wal.arquivo.tell()
+
+        usuarios, canais, posicoes = copiar_estado()
+        snapshot = self.caminho(self.nome, SUFIXO_SNAPSHOT)
+        temporario = snapshot + ".tmp"
+        with EscritorRegistros(temporario) as escritor:
+            escritor.metadado("posicoes", posicoes)
+            escritor.secao("users")
+            escritor.registros(usuarios)
+            escritor.secao("channels")
+            escritor.registros(canais)
+            escritor.flush(fsync)
+        os.replace(temporario, snapshot)
+        os.remove(girado)
+        self.contadores["compactacoes"] += 1
+        self.contadores["registros_snapshot"] = len(usuarios) + len(canais)
+        return len(usuarios) + len(canais)
+
+    def origens(self):
+        """Nomes dos outros servidores com arquivos no diretório"""
+        nomes = set()
+        for arquivo in os.listdir(self.diretorio):
+            for sufixo in (SUFIXO_SNAPSHOT, SUFIXO_WAL, SUFIXO_WAL_GIRADO):
+                if arquivo.endswith(sufixo):
+                    nomes.add(arquivo[:-len(sufixo)])
+                    break
+        nomes.discard(self.nome)
+        return sorted(nomes)
+
+    def ler_outros(self, posicoes):
+        """Blocos novos dos outros servidores desde `posicoes`
+
+        Retorna (blocos, novas posições); quem chama aplica os blocos e
+        só então adota as posições novas.
+        """
+        entradas = []
+        novas = {}
+        for origem in self.origens():
+            anterior = posicoes.get(origem, {})
+            atual = dict(anterior)
+            snapshot = self.caminho(origem, SUFIXO_SNAPSHOT)
+            wal = self.caminho(origem, SUFIXO_WAL)
+            girado = self.caminho(origem, SUFIXO_WAL_GIRADO)
+            inode, offset = anterior.get("wal") or (None, 0)
+            reler_snapshot = False
+            try:
+                st = os.stat(wal)
+                inode_wal, tamanho_wal = st.st_ino, st.st_size
+            except OSError:
+                inode_wal = tamanho_wal = None
+
+            if inode is None:
+                # Primeira leitura: snapshot, WAL girado (se houver) e WAL inteiros
+                reler_snapshot = True
+                if os.path.exists(girado):
+                    entradas.extend(ler_wal(girado)[0])
+            elif inode != inode_wal:
+                # O WAL acompanhado foi girado: termina de lê-lo se ainda
+                # existe; senão já foi compactado e o snapshot o cobre
+                try:
+                    if os.stat(girado).st_ino == inode:
+                        entradas.extend(ler_wal(girado, offset)[0])
+                    else:
+                        reler_snapshot = True
+                except OSError:
+                    reler_snapshot = True
+                offset = 0
+
+            versao = versao_arquivo(snapshot)
+            if versao is not None and (reler_snapshot or list(versao) != list(anterior.get("snapshot") or [])):
+                entradas.extend(ler_snapshot(snapshot)[0])
+                atual["snapshot"] = list(versao)
+            if inode_wal is not None and (inode_wal != inode or tamanho_wal > offset):
+                # Só abre o WAL se ele cresceu ou foi trocado desde a última leitura
+                novas_entradas, fim = ler_wal(wal, offset)
+                entradas.extend(novas_entradas)
+                atual["wal"] = [inode_wal, fim]
+            novas[origem] = atual
+        return entradas, novas
+
+    def fechar(self):
+        with self.lock:
+            self.wal.fechar(fsync=True)
+
+    def metricas(self):
+        return dict(self.contadores, wal_bytes=self.wal_bytes)
@@ -0,0 +1,105 @@
+import time
+import threading
+
+# Histograma log-linear em microssegundos: cada potência de 2 é dividida em
+# 2**SUB_BITS faixas, o que dá erro relativo de no máximo ~6% nos percentis
+# com registro O(1) e memória proporcional só às faixas usadas
+SUB_BITS = 4
+SUB_FAIXAS = 1 << SUB_BITS
+
+# Limite de serviços distintos (o nome vem do cliente); o excedente vai para "outros"
+MAX_SERVICOS = 64
+
+
+# Abaixo de 2 * SUB_FAIXAS us cada valor tem a própria faixa; acima, a
+# mantissa (us >> expoente) fica entre SUB_FAIXAS e 2 * SUB_FAIXAS - 1, ou
+# seja, cada potência de 2 usa todas as SUB_FAIXAS faixas
+def _faixa(us):
+    if us < 2 * SUB_FAIXAS:
+        return us
+    expoente = us.bit_length() - SUB_BITS - 1
+    return (expoente << SUB_BITS) + (us >> expoente)
+
+
+def _limite_superior(faixa):
+    if faixa < 2 * SUB_FAIXAS:
+        return faixa
+    expoente = (faixa >> SUB_BITS) - 1
+    return ((faixa - (expoente << SUB_BITS) + 1) << expoente) - 1
+
+
+class Histograma:
+    """Histograma de latências (não é thread-safe: quem usa protege)"""
+
+    def __init__(self):
+        self.contagens = {}
+        self.total = 0
+        self.soma_us = 0
+        self.maximo_us = 0
+
+    def registrar(self, segundos):
+        us = int(segundos * 1_000_000)
+        faixa = _faixa(us)
+        self.contagens[faixa] = self.contagens.get(faixa, 0) + 1
+        self.total += 1
+        self.soma_us += us
+        if us > self.maximo_us:
+            self.maximo_us = us
+
+    def percentis(self, *fracoes):
+        """Limite superior (em ms) da faixa de cada percentil pedido"""
+        resultado = [0.0] * len(fracoes)
+        if not self.total:
+            return resultado
+        alvos = sorted((max(1, int(f * self.total + 0.5)), i) for i, f in enumerate(fracoes))
+        acumulado = 0
+        proximo = 0
+        for faixa in sorted(self.contagens):
+            acumulado += self.contagens[faixa]
+            while proximo < len(alvos) and acumulado >= alvos[proximo][0]:
+                valor = min(_limite_superior(faixa), self.maximo_us)
+                resultado[alvos[proximo][1]] = valor / 1000.0
+                proximo += 1
+            if proximo == len(alvos):
+                break
+        return resultado
+
+    def resumo(self):
+        p50, p99, p999 = self.percentis(0.5, 0.99, 0.999)
+        return {
+            "n": self.total,
+            "media_ms": self.soma_us / self.total / 1000.0 if self.total else 0.0,
+            "p50_ms": p50,
+            "p99_ms": p99,
+            "p999_ms": p999,
+            "max_ms": self.maximo_us / 1000.0,
+        }
+
+
+class Instrumentacao:
+    """Contadores de requisições, erros e latência por serviço"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.servicos = {}
+        self.inicio = time.time()
+
+    def registrar(self, servico, segundos, erro=False):
+        with self.lock:
+            estatistica = self.servicos.get(servico)
+            if estatistica is None:
+                if len(self.servicos) >= MAX_SERVICOS:
+                    servico = "outros"
+                    estatistica = self.servicos.get(servico)
+                if estatistica is None:
+                    estatistica = self.servicos[servico] = {"erros": 0, "latencia": Histograma()}
+            estatistica["latencia"].registrar(segundos)
+            if erro:
+                estatistica["erros"] += 1
+
+    def resumo(self):
+        with self.lock:
+            return {
+                nome: dict(e["latencia"].resumo(), erros=e["erros"])
+                for nome, e in self.servicos.items()
+            }
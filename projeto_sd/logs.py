@@ -0,0 +1,96 @@
+import os
+import sys
+import queue
+import random
+import logging
+import logging.handlers
+
+# Logger geral (eventos, avisos e erros) e logger das linhas por requisição,
+# que pode ser amostrado ou desligado sem afetar os erros
+logger = logging.getLogger("servidor")
+log_requisicoes = logging.getLogger("servidor.requisicoes")
+
+LOG_NIVEL = os.environ.get("LOG_NIVEL", "INFO").upper()
+# Fração das linhas por requisição que é registrada (0 desliga, 1 registra todas)
+LOG_AMOSTRAGEM = float(os.environ.get("LOG_AMOSTRAGEM", 1.0))
+LOG_ARQUIVO = os.environ.get("LOG_ARQUIVO", "log.txt")
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUPS = int(os.environ.get("LOG_BACKUPS", 5))
+LOG_FILA = int(os.environ.get("LOG_FILA", 10000))
+
+
+class FiltroAmostragem(logging.Filter):
+    """Deixa passar só uma fração dos registros abaixo de WARNING"""
+
+    def __init__(self, taxa):
+        super().__init__()
+        self.taxa = taxa
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.taxa >= 1.0:
+            return True
+        return self.taxa > 0 and random.random() < self.taxa
+
+
+class HandlerFila(logging.handlers.QueueHandler):
+    """QueueHandler com fila limitada: descarta (e conta) quando está cheia
+
+    Quem registra nunca bloqueia nem faz syscall: a formatação e a escrita
+    ficam com a thread do QueueListener.
+    """
+
+    def __init__(self, fila):
+        super().__init__(fila)
+        self.descartados = 0
+
+    def prepare(self, record):
+        # A formatação fica para a thread de escrita
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.descartados += 1
+
+
+handler_fila = None
+listener = None
+
+
+def configurar_logs(prefixo="[S]"):
+    """Liga os loggers do servidor à fila drenada por uma thread de escrita"""
+    global handler_fila, listener
+    if listener is not None:
+        return
+
+    saida = logging.StreamHandler(sys.stdout)
+    saida.setFormatter(logging.Formatter(f"{prefixo} %(message)s"))
+    arquivo = logging.handlers.RotatingFileHandler(
+        LOG_ARQUIVO, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8"
+    )
+    arquivo.setFormatter(logging.Formatter("[%(created)f] %(levelname)s %(message)s"))
+
+    handler_fila = HandlerFila(queue.Queue(maxsize=LOG_FILA))
+    logger.addHandler(handler_fila)
+    logger.setLevel(LOG_NIVEL)
+    logger.propagate = False
+    log_requisicoes.addFilter(FiltroAmostragem(LOG_AMOSTRAGEM))
+    if LOG_AMOSTRAGEM <= 0:
+        log_requisicoes.setLevel(logging.WARNING)
+
+    listener = logging.handlers.QueueListener(handler_fila.queue, saida, arquivo)
+    listener.start()
+
+
+def encerrar_logs():
+    """Escreve o que restou na fila (usado no encerramento)"""
+    if listener is not None:
+        listener.stop()
+
+
+def metricas():
+    return {
+        "fila": handler_fila.queue.qsize() if handler_fila else 0,
+        "descartados": handler_fila.descartados if handler_fila else 0,
+    }
@@ -0,0 +1,118 @@
+import time
+import queue
+import logging
+import threading
+
+logger = logging.getLogger("servidor")
+
+# Política de fsync das gravações em disco:
+#   always - o handler só responde depois que o lote foi gravado com fsync
+#   batch  - o handler responde ao enfileirar; fsync uma vez por lote
+#   none   - o handler responde ao enfileirar; sem fsync (só flush dos buffers)
+POLITICAS_FSYNC = ("always", "batch", "none")
+
+
+class GravadorAssincrono:
+    """Thread de persistência write-behind com group commit.
+
+    Os handlers enfileiram operações de escrita numa fila limitada; a thread
+    agrupa o que estiver pendente (até `max_registros` ou `intervalo_ms`),
+    executa as escritas e faz um único flush/fsync por lote.
+    """
+
+    def __init__(self, politica="batch", intervalo_ms=5, max_registros=512, tamanho_fila=10000):
+        if politica not in POLITICAS_FSYNC:
+            raise ValueError(f"Politica de fsync invalida: {politica}")
+        self.politica = politica
+        self.fsync = politica != "none"
+        self.intervalo = intervalo_ms / 1000.0
+        self.max_registros = max_registros
+        self.fila = queue.Queue(maxsize=tamanho_fila)
+        self.lotes_gravados = 0
+        self.registros_gravados = 0
+        self.thread = threading.Thread(target=self._executar, daemon=True)
+        self.thread.start()
+
+    def persistir(self, funcao, *args, chave=None):
+        """Enfileira `funcao(*args)` para a thread de persistência
+
+        A função pode devolver um objeto com `flush(fsync)` (ex.: um
+        LogSegmentado), que é sincronizado uma vez ao final do lote. Escritas
+        com a mesma `chave` no mesmo lote são coalescidas (só a última roda).
+        Com a política `always` bloqueia até o lote estar durável.
+        """
+        evento = threading.Event() if self.politica == "always" else None
+        self.fila.put((chave, funcao, args, evento))
+        if evento:
+            evento.wait()
+
+    def persistir_lote(self, operacoes):
+        """Enfileira várias operações `(funcao, args, chave)` de uma vez
+
+        Com a política `always` espera uma única vez, pela última: a thread
+        consome a fila em ordem, então as anteriores já estão duráveis.
+        """
+        evento = threading.Event() if self.politica == "always" else None
+        ultima = len(operacoes) - 1
+        for i, (funcao, args, chave) in enumerate(operacoes):
+            self.fila.put((chave, funcao, args, evento if i == ultima else None))
+        if evento:
+            evento.wait()
+
+    def profundidade(self):
+        return self.fila.qsize()
+
+    def _coletar_lote(self):
+        lote = [self.fila.get()]
+        # Com `always` cada handler está esperando: grava o que já estiver na
+        # fila sem aguardar a janela de agrupamento
+        limite = time.monotonic() + (0 if self.politica == "always" else self.intervalo)
+        while len(lote) < self.max_registros:
+            restante = limite - time.monotonic()
+            try:
+                if restante <= 0:
+                    lote.append(self.fila.get_nowait())
+                else:
+                    lote.append(self.fila.get(timeout=restante))
+            except queue.Empty:
+                break
+        return lote
+
+    def _executar(self):
+        while True:
+            lote = self._coletar_lote()
+
+            # Coalescer escritas com a mesma chave mantendo a última
+            ultimas = {}
+            for i, (chave, _, _, _) in enumerate(lote):
+                if chave is not None:
+                    ultimas[chave] = i
+
+            alvos = []
+            for i, (chave, funcao, args, _) in enumerate(lote):
+                if funcao is None or (chave is not None and ultimas[chave] != i):
+                    continue
+                try:
+                    alvo = funcao(*args)
+                    if alvo is not None and alvo not in alvos:
+                        alvos.append(alvo)
+                except Exception as e:
+                    logger.exception("Erro na persistencia: %s", e)
+
+            for alvo in alvos:
+                try:
+                    alvo.flush(fsync=self.fsync)
+                except Exception as e:
+                    logger.exception("Erro ao sincronizar: %s", e)
+
+            self.lotes_gravados += 1
+            self.registros_gravados += len(lote)
+            for _, _, _, evento in lote:
+                if evento:
+                    evento.set()
+
+    def fechar(self):
+        """Aguarda a fila esvaziar (usado no encerramento do servidor)"""
+        evento = threading.Event()
+        self.fila.put((None, None, (), evento))
+        evento.wait()
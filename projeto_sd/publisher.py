@@ -1,33 +1,71 @@
+import os
+import time
 import zmq
-from time import sleep
 import msgpack
 
+# Repassa as mensagens dos servidores (PUB 5559) para o proxy (XSUB 5557).
+# Os servidores já enviam [tópico, payload msgpack]: os frames são
+# repassados como estão, sem decodificar nem cópia, e tudo o que estiver
+# disponível é drenado a cada despertar.
+
+RCVHWM = int(os.environ.get("PUBLISHER_RCVHWM", 100000))
+SNDHWM = int(os.environ.get("PUBLISHER_SNDHWM", 100000))
+# Intervalo (s) do relatório de mensagens repassadas (0 desliga)
+RELATORIO_INTERVALO = float(os.environ.get("PUBLISHER_RELATORIO", 10))
+# Máximo de mensagens drenadas por despertar antes de checar o relatório
+MAX_LOTE = 1000
+
 context = zmq.Context()
 
 servidor_sub = context.socket(zmq.SUB)
+servidor_sub.setsockopt(zmq.RCVHWM, RCVHWM)
 servidor_sub.connect("tcp://servidor:5559")
-servidor_sub.setsockopt_string(zmq.SUBSCRIBE, "")
+servidor_sub.setsockopt(zmq.SUBSCRIBE, b"")
 
 proxy_pub = context.socket(zmq.PUB)
+proxy_pub.setsockopt(zmq.SNDHWM, SNDHWM)
 proxy_pub.connect("tcp://proxy:5557")
 
-print("[PUB] Iniciado", flush=True)
+encaminhadas = 0
+legadas = 0  # mensagens num único frame (sem tópico), de servidores antigos
+
+
+def encaminhar(frames):
+    global encaminhadas, legadas
+    if len(frames) == 1:
+        # Formato antigo: o tópico só existe dentro do payload
+        mensagem = msgpack.unpackb(frames[0].bytes, raw=False)
+        frames = [mensagem.get("topic", "").encode(), frames[0]]
+        legadas += 1
+    proxy_pub.send_multipart(frames, copy=False)
+    encaminhadas += 1
 
+
+print(f"[PUB] Iniciado (RCVHWM={RCVHWM}, SNDHWM={SNDHWM})", flush=True)
+
+proximo_relatorio = time.monotonic() + RELATORIO_INTERVALO
+ultimo_relatado = 0
 while True:
     try:
-        mensagem_data = servidor_sub.recv()
-        mensagem = msgpack.unpackb(mensagem_data, raw=False)
-        topic = mensagem.get("topic", "")
-        
-        if topic:
-            proxy_pub.send_string(topic, zmq.SNDMORE)
-            proxy_pub.send(msgpack.packb(mensagem))
-        else:
-            proxy_pub.send(msgpack.packb(mensagem))
-    except:
-        pass
-    sleep(0.1)
+        if servidor_sub.poll(1000, zmq.POLLIN):
+            for _ in range(MAX_LOTE):
+                try:
+                    frames = servidor_sub.recv_multipart(zmq.NOBLOCK, copy=False)
+                except zmq.Again:
+                    break
+                encaminhar(frames)
+    except KeyboardInterrupt:
+        break
+    except Exception as e:
+        print(f"[PUB] Erro ao encaminhar: {e}", flush=True)
+
+    if RELATORIO_INTERVALO > 0 and time.monotonic() >= proximo_relatorio:
+        if encaminhadas != ultimo_relatado:
+            taxa = (encaminhadas - ultimo_relatado) / RELATORIO_INTERVALO
+            print(f"[PUB] Encaminhadas: {encaminhadas} ({taxa:.0f}/s, legadas {legadas})", flush=True)
+            ultimo_relatado = encaminhadas
+        proximo_relatorio = time.monotonic() + RELATORIO_INTERVALO
 
 proxy_pub.close()
 servidor_sub.close()
-context.close()
+context.term()
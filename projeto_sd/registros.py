@@ -0,0 +1,433 @@
+import os
+import sys
+import json
+import zlib
+import time
+import struct
+import tempfile
+import msgpack
+
+# Formato compacto de arquivos de registros (usuários, canais, publicações,
+# mensagens), substituto dos JSON com indent=2:
+#
+#   MAGICO, depois uma sequência de quadros [tipo, tamanho, CRC32] + payload msgpack
+#
+# REGISTRO - lista de registros (elementos de um array no JSON equivalente);
+#            os registros são agrupados em quadros de até REGISTROS_POR_QUADRO
+#            para que a leitura decodifique um quadro inteiro de uma vez
+# SECAO    - início de uma seção com o nome dado; os registros seguintes
+#            pertencem a ela (ex.: "users" e "channels" do data.json)
+# METADADO - [chave, valor] de um campo que não é array no JSON equivalente
+# OBJETO   - o JSON equivalente é um objeto (gravado no início; preserva o
+#            tipo de um objeto vazio)
+#
+# Um arquivo sem seções nem OBJETO equivale a um array JSON; com eles, a um objeto.
+# Como no LogSegmentado, um quadro incompleto ou com CRC inválido encerra a
+# leitura (gravação interrompida no meio).
+MAGICO = b"BBR\x01"
+QUADRO = struct.Struct(">BII")
+REGISTRO, SECAO, METADADO, OBJETO = 0, 1, 2, 3
+
+EXTENSAO = ".bbr"
+BLOCO_LEITURA = 1 << 20
+REGISTROS_POR_QUADRO = 1024
+
+
+class EscritorRegistros:
+    """Grava quadros no formato de registros (anexar=True continua um arquivo existente)"""
+
+    def __init__(self, caminho, anexar=False, registros_por_quadro=REGISTROS_POR_QUADRO):
+        novo = not (anexar and os.path.exists(caminho) and os.path.getsize(caminho) > 0)
+        self.caminho = caminho
+        self.arquivo = open(caminho, "ab" if anexar else "wb")
+        self.packer = msgpack.Packer()
+        self.registros_por_quadro = registros_por_quadro
+        self.pendentes = []
+        if novo:
+            self.arquivo.write(MAGICO)
+
+    def _quadro(self, tipo, valor):
+        payload = self.packer.pack(valor)
+        self.arquivo.write(QUADRO.pack(tipo, len(payload), zlib.crc32(payload)))
+        self.arquivo.write(payload)
+
+    def _descarregar(self):
+        if self.pendentes:
+            self._quadro(REGISTRO, self.pendentes)
+            self.pendentes = []
+
+    def registro(self, registro):
+        self.pendentes.append(registro)
+        if len(self.pendentes) >= self.registros_por_quadro:
+            self._descarregar()
+
+    def registros(self, registros):
+        for registro in registros:
+            self.registro(registro)
+
+    def secao(self, nome):
+        self._descarregar()
+        self._quadro(SECAO, nome)
+
+    def metadado(self, chave, valor):
+        self._descarregar()
+        self._quadro(METADADO, [chave, valor])
+
+    def evento(self, tipo, valor):
+        if tipo == REGISTRO:
+            self.registro(valor)
+        elif tipo == SECAO:
+            self.secao(valor)
+        elif tipo == OBJETO:
+            self._descarregar()
+            self._quadro(OBJETO, None)
+        else:
+            self.metadado(*valor)
+
+    def flush(self, fsync=False):
+        self._descarregar()
+        self.arquivo.flush()
+        if fsync:
+            os.fsync(self.arquivo.fileno())
+
+    def fechar(self, fsync=False):
+        self.flush(fsync)
+        self.arquivo.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excecao):
+        self.fechar()
+
+
+class LeitorRegistros:
+    """Percorre um arquivo de registros como eventos (tipo, valor), um por
+    registro, seção ou metadado
+
+    Depois da iteração, `fim_valido` é o offset logo após o último quadro
+    íntegro (o resto é uma gravação interrompida, ou ainda em andamento num
+    arquivo que continua crescendo). Com `inicio`, a leitura começa nesse
+    offset, que deve ser um `fim_valido` de uma leitura anterior.
+    """
+
+    def __init__(self, caminho, inicio=0):
+        self.caminho = caminho
+        self.inicio = inicio
+        self.fim_valido = inicio
+
+    def __iter__(self):
+        for tipo, valor in self.quadros():
+            if tipo == REGISTRO:
+                for registro in valor:
+                    yield REGISTRO, registro
+            else:
+                yield tipo, valor
+
+    def quadros(self):
+        """Os quadros como (tipo, valor); num quadro REGISTRO o valor é a lista"""
+        with open(self.caminho, "rb", buffering=BLOCO_LEITURA) as f:
+            if self.inicio:
+                f.seek(self.inicio)
+                posicao = self.fim_valido = self.inicio
+            else:
+                if f.read(len(MAGICO)) != MAGICO:
+                    raise ValueError(f"{self.caminho}: não é um arquivo de registros")
+                posicao = self.fim_valido = len(MAGICO)
+            while True:
+                cabecalho = f.read(QUADRO.size)
+                if len(cabecalho) < QUADRO.size:
+                    return
+                tipo, tamanho, crc = QUADRO.unpack(cabecalho)
+                payload = f.read(tamanho)
+                if len(payload) < tamanho or zlib.crc32(payload) != crc:
+                    return
+                posicao += QUADRO.size + tamanho
+                self.fim_valido = posicao
+                valor = msgpack.unpackb(payload, raw=False)
+                yield tipo, tuple(valor) if tipo == METADADO else valor
+
+
+# Caracteres que podem continuar um número JSON depois do que já foi lido
+CARACTERES_NUMERO = "0123456789+-.eE"
+
+
+class LeitorJson:
+    """Lê por partes um JSON com arrays de registros, no topo ou como campos
+    de um objeto, gerando os mesmos eventos (tipo, valor) do LeitorRegistros
+
+    Só um registro por vez fica decodificado na memória.
+    """
+
+    def __init__(self, arquivo, bloco=1 << 16):
+        self.arquivo = arquivo
+        self.bloco = bloco
+        self.buffer = ""
+        self.posicao = 0
+        self.decoder = json.JSONDecoder()
+
+    def _ler_mais(self):
+        parte = self.arquivo.read(self.bloco)
+        if not parte:
+            return False
+        self.buffer = self.buffer[self.posicao:] + parte
+        self.posicao = 0
+        return True
+
+    def _espiar(self):
+        while True:
+            while self.posicao < len(self.buffer) and self.buffer[self.posicao] in " \t\r\n":
+                self.posicao += 1
+            if self.posicao < len(self.buffer):
+                return self.buffer[self.posicao]
+            if not self._ler_mais():
+                return None
+
+    def _esperar(self, caracteres):
+        c = self._espiar()
+        if c is None or c not in caracteres:
+            raise ValueError(f"JSON inválido: esperado um de {caracteres!r}, encontrado {c!r}")
+        self.posicao += 1
+        return c
+
+    def _valor(self):
+        self._espiar()
+        while True:
+            try:
+                valor, fim = self.decoder.raw_decode(self.buffer, self.posicao)
+            except json.JSONDecodeError:
+                # Valor cortado no fim do bloco: lê mais e tenta de novo
+                if self._ler_mais():
+                    continue
+                raise
+            if (not isinstance(valor, (dict, list, str)) and not self.buffer[fim:].strip(CARACTERES_NUMERO)
+                    and self._ler_mais()):
+                continue  # um número pode continuar no próximo bloco (ex.: "2." + "5")
+            self.posicao = fim
+            return valor
+
+    def _array(self):
+        if self._espiar() == "]":
+            self.posicao += 1
+            return
+        while True:
+            yield REGISTRO, self._valor()
+            if self._esperar(",]") == "]":
+                return
+
+    def __iter__(self):
+        inicio = self._esperar("[{")
+        if inicio == "[":
+            yield from self._array()
+            return
+        yield OBJETO, None
+        if self._espiar() == "}":
+            self.posicao += 1
+            return
+        while True:
+            chave = self._valor()
+            self._esperar(":")
+            if self._espiar() == "[":
+                self.posicao += 1
+                yield SECAO, chave
+                yield from self._array()
+            else:
+                yield METADADO, (chave, self._valor())
+            if self._esperar(",}") == "}":
+                return
+
+
+def formato_arquivo(caminho):
+    """"registros" ou "json", pelo início do arquivo"""
+    with open(caminho, "rb") as f:
+        return "registros" if f.read(len(MAGICO)) == MAGICO else "json"
+
+
+def iterar_eventos(caminho):
+    """Eventos (tipo, valor) de um arquivo em qualquer um dos dois formatos"""
+    if formato_arquivo(caminho) == "registros":
+        yield from LeitorRegistros(caminho)
+        return
+    with open(caminho, "r", encoding="utf-8") as f:
+        yield from LeitorJson(f)
+
+
+def carregar_registros(caminho):
+    """Todos os registros de um arquivo (de todas as seções), em ordem"""
+    if formato_arquivo(caminho) == "registros":
+        registros = []
+        for tipo, valor in LeitorRegistros(caminho).quadros():
+            if tipo == REGISTRO:
+                registros.extend(valor)
+        return registros
+    with open(caminho, "r", encoding="utf-8") as f:
+        dados = json.load(f)
+    if isinstance(dados, dict):
+        return [r for valor in dados.values() if isinstance(valor, list) for r in valor]
+    return dados
+
+
+def carregar(caminho):
+    """O arquivo inteiro como o JSON equivalente (lista, ou dict com as seções)"""
+    if formato_arquivo(caminho) == "json":
+        with open(caminho, "r", encoding="utf-8") as f:
+            return json.load(f)
+    resultado = None
+    lista = None
+    for tipo, valor in LeitorRegistros(caminho).quadros():
+        if tipo == REGISTRO:
+            if lista is None:
+                resultado = lista = []
+            lista.extend(valor)
+        elif tipo == SECAO:
+            resultado = {} if resultado is None else resultado
+            lista = resultado[valor] = []
+        elif tipo == OBJETO:
+            resultado = {} if resultado is None else resultado
+        else:
+            resultado = {} if resultado is None else resultado
+            resultado[valor[0]] = valor[1]
+    return [] if resultado is None else resultado
+
+
+def _json_indentado(valor, nivel):
+    return json.dumps(valor, indent=2, ensure_ascii=False).replace("\n", "\n" + "  " * nivel)
+
+
+def escrever_json(eventos, f):
+    """Escreve os eventos como JSON com indent=2 (igual ao dos servidores), por partes"""
+    em_objeto = False  # há OBJETO, seções ou metadados: o topo é um objeto
+    campos = 0
+    em_array = False
+    primeiro_registro = True
+    for tipo, valor in eventos:
+        if tipo == REGISTRO:
+            if not em_array:
+                if em_objeto:
+                    raise ValueError("Registro fora de uma seção depois de uma seção ou metadado")
+                f.write("[")
+                em_array = True
+            f.write("\n" if primeiro_registro else ",\n")
+            nivel = 2 if em_objeto else 1
+            f.write("  " * nivel + _json_indentado(valor, nivel))
+            primeiro_registro = False
+            continue
+        if em_array and not em_objeto:
+            raise ValueError("Seção ou metadado depois de registros sem seção")
+        if tipo == OBJETO:
+            if em_objeto:
+                raise ValueError("Início de objeto depois de uma seção ou metadado")
+            f.write("{")
+            em_objeto = True
+            continue
+        if em_array:
+            f.write("]" if primeiro_registro else "\n  ]")
+            em_array = False
+        if not em_objeto:
+            f.write("{")
+            em_objeto = True
+        f.write("\n" if campos == 0 else ",\n")
+        campos += 1
+        if tipo == SECAO:
+            f.write(f"  {json.dumps(valor, ensure_ascii=False)}: [")
+            em_array = True
+            primeiro_registro = True
+        else:
+            chave, conteudo = valor
+            f.write(f"  {json.dumps(chave, ensure_ascii=False)}: {_json_indentado(conteudo, 1)}")
+    if em_objeto:
+        if em_array:
+            f.write("]" if primeiro_registro else "\n  ]")
+        f.write("\n}" if campos else "}")
+    elif em_array:
+        f.write("\n]")
+    else:
+        f.write("[]")
+
+
+def converter_para_registros(entrada, saida):
+    """JSON (ou registros) -> registros; retorna quantos registros foram gravados"""
+    total = 0
+    temporario = f"{saida}.tmp"
+    with EscritorRegistros(temporario) as escritor:
+        for tipo, valor in iterar_eventos(entrada):
+            escritor.evento(tipo, valor)
+            total += tipo == REGISTRO
+        escritor.flush(fsync=True)
+    os.replace(temporario, saida)
+    return total
+
+
+def converter_para_json(entrada, saida):
+    """Registros (ou JSON) -> JSON com indent=2; retorna quantos registros foram gravados"""
+    total = 0
+
+    def contar(eventos):
+        nonlocal total
+        for tipo, valor in eventos:
+            total += tipo == REGISTRO
+            yield tipo, valor
+
+    temporario = f"{saida}.tmp"
+    with open(temporario, "w", encoding="utf-8") as f:
+        escrever_json(contar(iterar_eventos(entrada)), f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporario, saida)
+    return total
+
+
+def _melhor_tempo(funcao, repeticoes):
+    melhor = None
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        funcao()
+        decorrido = time.perf_counter() - inicio
+        melhor = decorrido if melhor is None else min(melhor, decorrido)
+    return melhor
+
+
+def relatorio(caminhos, repeticoes=5):
+    """Tamanho e tempo de carga de cada JSON contra o equivalente em registros"""
+    linhas = []
+    with tempfile.TemporaryDirectory() as diretorio:
+        for caminho in caminhos:
+            convertido = os.path.join(diretorio, os.path.basename(caminho) + EXTENSAO)
+            total = converter_para_registros(caminho, convertido)
+            if carregar(convertido) != carregar(caminho):
+                raise ValueError(f"{caminho}: conversão não preserva o conteúdo")
+            linhas.append({
+                "arquivo": caminho,
+                "registros": total,
+                "bytes_json": os.path.getsize(caminho),
+                "bytes_registros": os.path.getsize(convertido),
+                "carga_json_ms": _melhor_tempo(lambda: carregar(caminho), repeticoes) * 1000,
+                "carga_registros_ms": _melhor_tempo(lambda: carregar(convertido), repeticoes) * 1000,
+            })
+    return linhas
+
+
+def imprimir_relatorio(linhas):
+    print(f"{'arquivo':<28} {'registros':>9} {'JSON':>10} {'registros':>10} {'tamanho':>8} "
+          f"{'carga JSON':>11} {'carga reg.':>11}")
+    for l in linhas:
+        print(f"{os.path.basename(l['arquivo']):<28} {l['registros']:>9} {l['bytes_json']:>10} "
+              f"{l['bytes_registros']:>10} {l['bytes_registros'] / max(1, l['bytes_json']):>7.0%} "
+              f"{l['carga_json_ms']:>9.2f}ms {l['carga_registros_ms']:>9.2f}ms")
+
+
+if __name__ == "__main__":
+    # Uso:
+    #   python registros.py para-registros <entrada.json> <saida.bbr>
+    #   python registros.py para-json <entrada.bbr> <saida.json>
+    #   python registros.py relatorio <arquivo.json>...
+    comandos = {"para-registros": converter_para_registros, "para-json": converter_para_json}
+    if len(sys.argv) == 4 and sys.argv[1] in comandos:
+        total = comandos[sys.argv[1]](sys.argv[2], sys.argv[3])
+        print(f"{total} registros convertidos para {sys.argv[3]}")
+    elif len(sys.argv) >= 3 and sys.argv[1] == "relatorio":
+        imprimir_relatorio(relatorio(sys.argv[2:]))
+    else:
+        print("Uso: python registros.py para-registros|para-json <entrada> <saida>")
+        print("     python registros.py relatorio <arquivo.json>...")
+        sys.exit(1)
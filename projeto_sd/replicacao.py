@@ -0,0 +1,383 @@
+import time
+import queue
+import logging
+import threading
+import zmq
+import msgpack
+
+from instrumentacao import Histograma
+
+logger = logging.getLogger("servidor")
+
+
+class PoolReplicacao:
+    """Conexões persistentes para replicar operações aos outros servidores.
+
+    Uma única thread consome a fila de operações e mantém um socket REQ por
+    servidor, reaproveitado entre operações. Se um servidor não responde
+    dentro do timeout o socket é descartado e recriado no próximo envio
+    (um REQ sem resposta fica travado no estado de espera).
+    """
+
+    def __init__(self, nome_servidor, porta, obter_servidores, timeout_ms=2000, tamanho_fila=10000):
+        self.nome_servidor = nome_servidor
+        self.porta = porta
+        self.obter_servidores = obter_servidores
+        self.timeout_ms = timeout_ms
+        self.context = zmq.Context.instance()
+        self.fila = queue.Queue(maxsize=tamanho_fila)
+        self.conexoes = {}
+        # Saúde de cada servidor: {nome: {"enviadas", "falhas", "falhas_consecutivas", "ultimo_sucesso"}}
+        self.pares = {}
+        # Atraso de replicação por servidor: do enfileiramento até a confirmação
+        self.atrasos = {}
+        self.reconexoes = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self._executar, daemon=True).start()
+
+    def replicar(self, mensagem):
+        """Enfileira uma operação para ser enviada a todos os outros servidores"""
+        mensagem_copy = mensagem.copy()
+        mensagem_copy["replicated"] = True
+        self.fila.put((mensagem_copy, time.monotonic()))
+
+    def _conexao(self, nome):
+        sock = self.conexoes.get(nome)
+        if sock is None:
+            sock = self.context.socket(zmq.REQ)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.setsockopt(zmq.SNDTIMEO, self.timeout_ms)
+            sock.connect(f"tcp://{nome}:{self.porta}")
+            self.conexoes[nome] = sock
+        return sock
+
+    def _descartar(self, nome):
+        sock = self.conexoes.pop(nome, None)
+        if sock is not None:
+            sock.close()
+            with self.lock:
+                self.reconexoes += 1
+
+    def _enviar(self, nome, payload, enfileirada):
+        sock = self._conexao(nome)
+        with self.lock:
+            par = self.pares.setdefault(nome, {"enviadas": 0, "falhas": 0, "falhas_consecutivas": 0, "ultimo_sucesso": None})
+        try:
+            sock.send(payload)
+            if not sock.poll(self.timeout_ms, zmq.POLLIN):
+                raise zmq.Again()
+            sock.recv()
+            with self.lock:
+                par["enviadas"] += 1
+                par["falhas_consecutivas"] = 0
+                par["ultimo_sucesso"] = time.time()
+                self.atrasos.setdefault(nome, Histograma()).registrar(time.monotonic() - enfileirada)
+            return True
+        except zmq.ZMQError:
+            with self.lock:
+                par["falhas"] += 1
+                par["falhas_consecutivas"] += 1
+            self._descartar(nome)
+            return False
+
+    def _executar(self):
+        while True:
+            # Drena o que estiver pendente e consulta a lista de servidores uma vez por lote
+            lote = [self.fila.get()]
+            while True:
+                try:
+                    lote.append(self.fila.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                nomes = [s.get("name") for s in self.obter_servidores()]
+            except Exception:
+                nomes = []
+            nomes = [n for n in nomes if n and n != self.nome_servidor]
+
+            # Fecha conexões de servidores que saíram do cluster
+            for nome in list(self.conexoes):
+                if nome not in nomes:
+                    self.conexoes.pop(nome).close()
+                    with self.lock:
+                        self.pares.pop(nome, None)
+                        self.atrasos.pop(nome, None)
+
+            # Um servidor que falhou neste lote não recebe o restante dele, para
+            # não acumular um timeout por operação
+            indisponiveis = set()
+            for mensagem, enfileirada in lote:
+                payload = msgpack.packb(mensagem)
+                for nome in nomes:
+                    if nome in indisponiveis:
+                        continue
+                    if not self._enviar(nome, payload, enfileirada):
+                        indisponiveis.add(nome)
+
+    def metricas(self):
+        """Resumo da saúde do pool (conexões abertas, fila, estado e atraso por servidor)"""
+        with self.lock:
+            return {
+                "conexoes": len(self.conexoes),
+                "fila": self.fila.qsize(),
+                "reconexoes": self.reconexoes,
+                "pares": {nome: dict(par) for nome, par in self.pares.items()},
+                "atraso": {nome: h.resumo() for nome, h in self.atrasos.items()},
+            }
+
+
+# Tópicos no proxy de replicação (5570/5571): lotes de dados e confirmações
+TOPICO_LOTES = "rep.dados"
+TOPICO_ACK = "rep.ack."
+
+
+class StreamReplicacao:
+    """Replicação por fluxo de lotes numerados via proxy Pub/Sub.
+
+    Cada servidor publica suas operações em lotes (`tamanho_lote` operações
+    ou `linger_ms` de espera, o que vier primeiro) com número de sequência.
+    Os outros aplicam os lotes de cada origem em ordem, guardando os que
+    chegam adiantados, e confirmam cumulativamente (`ate`: último lote
+    aplicado sem lacunas). Lacunas pedem retransmissão a partir do último
+    lote confirmado; a origem mantém os lotes ainda não confirmados.
+
+    A origem retém no máximo `retencao` lotes. Se o pedido de retransmissão
+    começa antes do lote retido mais antigo, ela publica antes um aviso de
+    salto (`salto_ate`): quem aplica dá os lotes intermediários como
+    perdidos e segue a partir dos retidos, em vez de esperar para sempre.
+    Os lotes adiantados guardados por origem também são limitados
+    (`max_pendentes`); os que passam do limite são pedidos de novo depois.
+    """
+
+    def __init__(self, nome_servidor, aplicar, endereco_pub="tcp://proxy:5570", endereco_sub="tcp://proxy:5571",
+                 tamanho_lote=256, linger_ms=5, retencao=10000, tamanho_fila=100000, max_pendentes=None):
+        self.nome_servidor = nome_servidor
+        self.aplicar = aplicar
+        self.tamanho_lote = tamanho_lote
+        self.linger = linger_ms / 1000.0
+        self.retencao = retencao
+        self.max_pendentes = max_pendentes or retencao
+        # Identifica a "vida" do processo: se a origem reinicia, a sequência recomeça
+        self.epoca = time.time()
+        self.context = zmq.Context.instance()
+        self.fila = queue.Queue(maxsize=tamanho_fila)
+        self.lock = threading.Lock()
+
+        # Lado da origem
+        self.ultimo_lote = 0
+        self.retidos = {}
+        self.confirmados = {}
+        self.ultimo_ack = {}
+        self.lotes_publicados = 0
+        self.operacoes_publicadas = 0
+        self.retransmissoes = 0
+
+        # Lado de quem aplica: {origem: {"epoca", "aplicado", "pendentes"}}
+        self.origens = {}
+        self.lotes_aplicados = 0
+        self.operacoes_aplicadas = 0
+        self.lotes_perdidos = 0
+
+        self.endereco_pub = endereco_pub
+        self.endereco_sub = endereco_sub
+        threading.Thread(target=self._executar_envio, daemon=True).start()
+        threading.Thread(target=self._executar_recepcao, daemon=True).start()
+
+    def replicar(self, mensagem):
+        """Enfileira uma operação ({service, data}) para o próximo lote"""
+        self.fila.put(("op", mensagem))
+
+    # ---- Origem ----
+
+    def _executar_envio(self):
+        pub = self.context.socket(zmq.PUB)
+        pub.setsockopt(zmq.SNDHWM, 0)
+        pub.connect(self.endereco_pub)
+        ultima_verificacao = time.monotonic()
+
+        while True:
+            operacoes = []
+            limite = None
+            while len(operacoes) < self.tamanho_lote:
+                if limite is None:
+                    # Sem lote aberto: acorda periodicamente para checar atrasados
+                    timeout = 1.0
+                else:
+                    timeout = limite - time.monotonic()
+                    if timeout <= 0:
+                        break
+                try:
+                    tipo, item = self.fila.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if tipo == "op":
+                    operacoes.append(item)
+                    if limite is None:
+                        limite = time.monotonic() + self.linger
+                else:
+                    self._retransmitir(pub, item)
+
+            if operacoes:
+                with self.lock:
+                    self.ultimo_lote += 1
+                    lote = {"origem": self.nome_servidor, "epoca": self.epoca, "seq": self.ultimo_lote, "ops": operacoes}
+                    payload = msgpack.packb(lote)
+                    self.retidos[self.ultimo_lote] = payload
+                    self.lotes_publicados += 1
+                    self.operacoes_publicadas += len(operacoes)
+                    self._podar()
+                pub.send_string(TOPICO_LOTES, zmq.SNDMORE)
+                pub.send(payload)
+
+            agora = time.monotonic()
+            if agora - ultima_verificacao >= 1.0:
+                ultima_verificacao = agora
+                # Quem ficou para trás sem pedir (ex.: perdeu o último lote) recebe de novo
+                with self.lock:
+                    atrasados = [c for nome, c in self.confirmados.items()
+                                 if c < self.ultimo_lote and time.time() - self.ultimo_ack.get(nome, 0) < 30]
+                if atrasados:
+                    self._retransmitir(pub, min(atrasados))
+
+    def _retransmitir(self, pub, desde):
+        with self.lock:
+            payloads = [self.retidos[s] for s in sorted(self.retidos) if s > desde]
+            self.retransmissoes += len(payloads)
+            # Lotes já podados: avisa até onde pular em vez de deixar a lacuna aberta
+            primeiro = min(self.retidos) if self.retidos else self.ultimo_lote + 1
+            if desde < primeiro - 1:
+                logger.warning("Replicacao: lotes %d-%d ja descartados, enviando salto", desde + 1, primeiro - 1)
+                payloads.insert(0, msgpack.packb({"origem": self.nome_servidor, "epoca": self.epoca,
+                                                  "salto_ate": primeiro - 1}))
+        for payload in payloads:
+            pub.send_string(TOPICO_LOTES, zmq.SNDMORE)
+            pub.send(payload)
+
+    def _podar(self):
+        """Descarta lotes já confirmados por todos os servidores conhecidos (com lock)
+
+        Quem está parado também segura a poda, até o limite de `retencao`
+        lotes; passando disso, recebe um salto quando pedir retransmissão.
+        """
+        minimo = min(self.confirmados.values()) if self.confirmados else self.ultimo_lote
+        for seq in [s for s in self.retidos if s <= minimo]:
+            del self.retidos[seq]
+        while len(self.retidos) > self.retencao:
+            del self.retidos[min(self.retidos)]
+
+    def _registrar_ack(self, ack):
+        nome = ack.get("servidor")
+        if ack.get("epoca") != self.epoca or not nome:
+            return None
+        with self.lock:
+            self.confirmados[nome] = max(self.confirmados.get(nome, 0), ack.get("ate", 0))
+            self.ultimo_ack[nome] = time.time()
+            self._podar()
+        if ack.get("retransmitir"):
+            self.fila.put(("retransmitir", ack.get("ate", 0)))
+
+    # ---- Quem aplica ----
+
+    def _executar_recepcao(self):
+        sub = self.context.socket(zmq.SUB)
+        sub.setsockopt(zmq.RCVHWM, 0)
+        sub.connect(self.endereco_sub)
+        sub.setsockopt_string(zmq.SUBSCRIBE, TOPICO_LOTES)
+        sub.setsockopt_string(zmq.SUBSCRIBE, TOPICO_ACK + self.nome_servidor)
+
+        pub_ack = self.context.socket(zmq.PUB)
+        pub_ack.connect(self.endereco_pub)
+
+        while True:
+            # Processa tudo o que estiver disponível e confirma uma vez por origem
+            acks = {}
+            if not sub.poll(1000):
+                continue
+            while True:
+                try:
+                    topico, payload = sub.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                try:
+                    mensagem = msgpack.unpackb(payload, raw=False)
+                    if topico.decode() == TOPICO_LOTES:
+                        if mensagem.get("origem") != self.nome_servidor:
+                            ack = self._receber_lote(mensagem)
+                            if ack:
+                                acks[mensagem["origem"]] = ack
+                    else:
+                        self._registrar_ack(mensagem)
+                except Exception as e:
+                    logger.exception("Erro na replicacao: %s", e)
+
+            for origem, ack in acks.items():
+                pub_ack.send_string(TOPICO_ACK + origem, zmq.SNDMORE)
+                pub_ack.send(msgpack.packb(ack))
+
+    def _receber_lote(self, lote):
+        origem = lote["origem"]
+        estado = self.origens.get(origem)
+        if estado is None or estado["epoca"] != lote["epoca"]:
+            # Primeiro lote visto desta origem (ou ela reiniciou): começa daqui
+            inicio = lote["salto_ate"] if "salto_ate" in lote else lote["seq"] - 1
+            estado = {"epoca": lote["epoca"], "aplicado": inicio, "pendentes": {}}
+            self.origens[origem] = estado
+
+        if "salto_ate" in lote:
+            # A origem já descartou os lotes até `salto_ate`: não virão mais
+            salto = lote["salto_ate"]
+            if salto > estado["aplicado"]:
+                logger.warning("Replicacao: %d lotes de %s perdidos (%d-%d)",
+                               salto - estado["aplicado"], origem, estado["aplicado"] + 1, salto)
+                with self.lock:
+                    self.lotes_perdidos += salto - estado["aplicado"]
+                estado["aplicado"] = salto
+                for seq in [s for s in estado["pendentes"] if s <= salto]:
+                    del estado["pendentes"][seq]
+        else:
+            seq = lote["seq"]
+            if seq > estado["aplicado"]:
+                estado["pendentes"][seq] = lote["ops"]
+
+        while estado["aplicado"] + 1 in estado["pendentes"]:
+            proximo = estado["aplicado"] + 1
+            operacoes = estado["pendentes"].pop(proximo)
+            for operacao in operacoes:
+                try:
+                    self.aplicar(operacao.get("service"), operacao.get("data", {}))
+                except Exception as e:
+                    logger.exception("Erro ao aplicar replicacao: %s", e)
+            estado["aplicado"] = proximo
+            with self.lock:
+                self.lotes_aplicados += 1
+                self.operacoes_aplicadas += len(operacoes)
+
+        # Acima do limite descarta os mais adiantados; voltam na próxima retransmissão
+        while len(estado["pendentes"]) > self.max_pendentes:
+            del estado["pendentes"][max(estado["pendentes"])]
+
+        return {
+            "servidor": self.nome_servidor,
+            "epoca": estado["epoca"],
+            "ate": estado["aplicado"],
+            # Há lotes adiantados esperando: falta algum no meio
+            "retransmitir": bool(estado["pendentes"]),
+        }
+
+    def metricas(self):
+        """Sequências, atraso de confirmação por servidor e contadores do fluxo"""
+        with self.lock:
+            return {
+                "ultimo_lote": self.ultimo_lote,
+                "fila": self.fila.qsize(),
+                "retidos": len(self.retidos),
+                "lotes_publicados": self.lotes_publicados,
+                "operacoes_publicadas": self.operacoes_publicadas,
+                "retransmissoes": self.retransmissoes,
+                "lotes_aplicados": self.lotes_aplicados,
+                "operacoes_aplicadas": self.operacoes_aplicadas,
+                "lotes_perdidos": self.lotes_perdidos,
+                "atraso": {nome: self.ultimo_lote - c for nome, c in self.confirmados.items()},
+                "origens": {nome: e["aplicado"] for nome, e in list(self.origens.items())},
+            }
@@ -4,133 +4,353 @@ import msgpack
 import time
 import json
 import os
+import fcntl
+import itertools
+from armazenamento import LogSegmentado, IndiceSecundario, importar_json
+from persistencia import GravadorAssincrono
+from estado import EstadoPersistente
+from registros import carregar_registros, EXTENSAO
+from replicacao import PoolReplicacao, StreamReplicacao
+from logs import logger, log_requisicoes, configurar_logs, encerrar_logs
+from instrumentacao import Instrumentacao
+import logs
 
 # Diretório para persistência de dados
-DATA_DIR = "/app/dados"
-os.makedirs(DATA_DIR, exist_ok=True)
+DATA_DIR = os.environ.get("DATA_DIR", "/app/dados")
+
+# Identidade do servidor no volume de dados: diretório dos logs, arquivos de
+# estado e origem das publicações/mensagens. O hostname (NOME_SERVIDOR) dos
+# contêineres de `replicas: 3` muda a cada `docker compose up`, então não
+# serve para reencontrar os próprios dados. Sem SERVIDOR_ID, o servidor
+# reivindica o primeiro `servidor-<n>` livre (ver reivindicar_identidade).
+SERVIDOR_ID = os.environ.get("SERVIDOR_ID")
+trava_identidade = None
 
 # Porta para receber replicações de outros servidores
 REPLICATION_PORT = 5562
+PUB_PORT = 5559  # Porta para publisher
 
-# Função para salvar mensagens no arquivo de log
-def salvar_log(mensagem):
-    try:
-        with open("log.txt", "a", encoding="utf-8") as f:
-            f.write(f"{mensagem}\n")
-    except Exception as e:
-        print(f"Erro ao salvar no log: {e}", flush=True)
+# Snapshot + WAL de usuários e canais de cada servidor (ver estado.py). O WAL
+# é compactado em background quando passa de COMPACTACAO_WAL_BYTES.
+ESTADO_DIR = os.path.join(DATA_DIR, "estado")
+COMPACTACAO_WAL_BYTES = int(os.environ.get("COMPACTACAO_WAL_BYTES", 4 << 20))
+COMPACTACAO_INTERVALO = float(os.environ.get("COMPACTACAO_INTERVALO", 5))
+HISTORICO_LIMITE_MAX = int(os.environ.get("HISTORICO_LIMITE_MAX", 500))
+LOTE_MAX_OPERACOES = int(os.environ.get("LOTE_MAX_OPERACOES", 1000))
+RECARGA_INTERVALO = float(os.environ.get("RECARGA_INTERVALO", 2))
+
+# Estado do servidor, preenchido por iniciar_armazenamento()/iniciar_replicacao()
+gravador = None
+estado = None
+usuarios = {}
+canais = {}
+publicacoes_log = None
+mensagens_log = None
+indice_canais = None
+indice_destinatarios = None
+replicador = None
+pub_socket = None
+
+recargas = {"realizadas": 0, "ignoradas": 0}
+
+# Arquivos únicos de usuários/canais de versões anteriores, importados na
+# primeira inicialização com snapshot + WAL
+ARQUIVOS_LEGADOS = {
+    "users": ("usuarios" + EXTENSAO, "usuarios.json"),
+    "channels": ("canais" + EXTENSAO, "canais.json"),
+}
+
+def ler_legados():
+    blocos = []
+    for tipo, nomes in ARQUIVOS_LEGADOS.items():
+        for nome in nomes:
+            caminho = os.path.join(DATA_DIR, nome)
+            if os.path.exists(caminho):
+                try:
+                    blocos.append((tipo, carregar_registros(caminho)))
+                except Exception as e:
+                    logger.warning("Falha ao importar %s: %s", caminho, e)
+    return blocos
+
+def reivindicar_identidade():
+    """Define SERVIDOR_ID com um flock em DATA_DIR/identidades/servidor-<n>.lock
+
+    O lock fica com o processo e o sistema o libera quando ele termina, então
+    depois de reiniciar o cluster cada servidor volta a ocupar uma das
+    identidades já usadas e retoma os logs e o estado dela.
+    """
+    global SERVIDOR_ID, trava_identidade
+    if SERVIDOR_ID:
+        return SERVIDOR_ID
+    diretorio = os.path.join(DATA_DIR, "identidades")
+    os.makedirs(diretorio, exist_ok=True)
+    for n in itertools.count(1):
+        arquivo = open(os.path.join(diretorio, f"servidor-{n}.lock"), "a")
+        try:
+            fcntl.flock(arquivo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            arquivo.close()
+            continue
+        trava_identidade = arquivo
+        SERVIDOR_ID = f"servidor-{n}"
+        return SERVIDOR_ID
 
 # Função para carregar dados persistidos
 def carregar_dados():
-    usuarios = []
-    canais = []
-    
-    usuarios_path = os.path.join(DATA_DIR, "usuarios.json")
-    canais_path = os.path.join(DATA_DIR, "canais.json")
-    
-    # Carregar usuários
-    if os.path.exists(usuarios_path):
-        try:
-            with open(usuarios_path, "r", encoding="utf-8") as f:
-                usuarios = json.load(f)
-        except:
-            pass
-    
-    if os.path.exists(canais_path):
-        try:
-            with open(canais_path, "r", encoding="utf-8") as f:
-                canais = json.load(f)
-        except:
-            pass
-    
-    return usuarios, canais
+    """Abre o estado (snapshot + WAL, ver estado.py) e retorna (usuarios, canais)
 
-def salvar_usuarios(usuarios):
-    try:
-        usuarios_path = os.path.join(DATA_DIR, "usuarios.json")
-        with open(usuarios_path, "w", encoding="utf-8") as f:
-            json.dump(usuarios, f, indent=2, ensure_ascii=False)
-    except:
-        pass
+    Retorna também se é preciso compactar logo: primeira inicialização (dados
+    importados dos arquivos legados) ou compactação anterior interrompida.
+    """
+    global estado
+    estado = EstadoPersistente(ESTADO_DIR, SERVIDOR_ID)
+    primeira = not estado.existe()
+    compactar = primeira or estado.precisa_compactar()
+    blocos = estado.carregar()
+    if primeira:
+        legados = ler_legados()
+        if legados:
+            logger.info("Importando %d usuários/canais dos arquivos legados", sum(len(r) for _, r in legados))
+        blocos = legados + blocos
+    usuarios, canais = {}, {}
+    indexar(blocos, usuarios, canais)
+    return usuarios, canais, compactar
 
-def salvar_canais(canais):
-    try:
-        canais_path = os.path.join(DATA_DIR, "canais.json")
-        with open(canais_path, "w", encoding="utf-8") as f:
-            json.dump(canais, f, indent=2, ensure_ascii=False)
-    except:
-        pass
+def indexar(blocos, usuarios, canais):
+    """Indexa blocos (tipo, registros) por nome (dict mantém a ordem de inserção)
+
+    Só acrescenta os nomes que ainda não existem; retorna os tipos alterados
+    e quantos registros entraram.
+    """
+    indices = {"users": (usuarios, "user"), "channels": (canais, "channel")}
+    alterados = set()
+    adicionados = 0
+    for tipo, registros in blocos:
+        indice, campo = indices.get(tipo, (None, None))
+        if indice is None:
+            continue
+        antes = len(indice)
+        for registro in registros:
+            nome = registro.get(campo)
+            if nome not in indice:
+                indice[nome] = registro
+        if len(indice) > antes:
+            alterados.add(tipo)
+            adicionados += len(indice) - antes
+    return alterados, adicionados
+
+def recarregar_se_alterado():
+    """Mescla registros novos gravados por outros servidores no volume compartilhado
+
+    Só lê o que os outros servidores acrescentaram aos WALs desde a última
+    leitura (e os snapshots que mudaram). Nunca substitui os índices em
+    memória, então não perde escritas locais.
+    """
+    blocos, posicoes = estado.ler_outros(estado.posicoes)
+    with lock_estado:
+        alterados, adicionados = indexar(blocos, usuarios, canais)
+        for tipo in alterados:
+            invalidar_listagem(tipo)
+        # Junto com os índices: a compactação copia os dois com lock_estado
+        estado.posicoes = posicoes
+
+    # Só conta como realizada a recarga que trouxe registros novos
+    if not adicionados:
+        recargas["ignoradas"] += 1
+        return 0
+    recargas["realizadas"] += 1
+    logger.info("Recarga: %d novos registros (realizadas %d, ignoradas %d)",
+                adicionados, recargas["realizadas"], recargas["ignoradas"])
+    return adicionados
+
+def compactar_estado():
+    """Grava um snapshot novo do estado e descarta o WAL que ele cobre"""
+    def copiar_estado():
+        with lock_estado:
+            return list(usuarios.values()), list(canais.values()), dict(estado.posicoes)
+
+    inicio = time.perf_counter()
+    total = estado.compactar(copiar_estado, fsync=gravador.fsync)
+    logger.info("Estado compactado: %d registros em %.1f ms", total, (time.perf_counter() - inicio) * 1000)
+
+def compactar_periodicamente():
+    while True:
+        time.sleep(COMPACTACAO_INTERVALO)
+        try:
+            if estado.wal_bytes >= COMPACTACAO_WAL_BYTES:
+                compactar_estado()
+        except Exception as e:
+            logger.exception("Erro na compactação do estado: %s", e)
 
 def salvar_publicacao(publicacao):
-    try:
-        publicacoes_path = os.path.join(DATA_DIR, "publicacoes.json")
-        publicacoes = []
-        if os.path.exists(publicacoes_path):
-            with open(publicacoes_path, "r", encoding="utf-8") as f:
-                publicacoes = json.load(f)
-        publicacoes.append(publicacao)
-        with open(publicacoes_path, "w", encoding="utf-8") as f:
-            json.dump(publicacoes, f, indent=2, ensure_ascii=False)
-    except:
-        pass
+    publicacoes_log.append(publicacao)
+    return publicacoes_log
 
 def salvar_mensagem_privada(mensagem):
-    try:
-        mensagens_path = os.path.join(DATA_DIR, "mensagens.json")
-        mensagens = []
-        if os.path.exists(mensagens_path):
-            with open(mensagens_path, "r", encoding="utf-8") as f:
-                mensagens = json.load(f)
-        mensagens.append(mensagem)
-        with open(mensagens_path, "w", encoding="utf-8") as f:
-            json.dump(mensagens, f, indent=2, ensure_ascii=False)
-    except:
-        pass
+    mensagens_log.append(mensagem)
+    return mensagens_log
 
-# Função para replicar mensagem para outros servidores
+# Dentro de um `batch` as escritas e replicações das operações são acumuladas
+# e enviadas juntas no final (ver executar_lote)
+contexto_lote = threading.local()
+
+def persistir(funcao, *args, chave=None):
+    operacoes = getattr(contexto_lote, "persistencia", None)
+    if operacoes is not None:
+        operacoes.append((funcao, args, chave))
+    else:
+        gravador.persistir(funcao, *args, chave=chave)
+
+# Função para replicar mensagem para outros servidores (ver REPLICACAO_MODO)
 def replicar_para_outros_servidores(mensagem):
-    def enviar_replicacao():
-        try:
-            mensagem_copy = mensagem.copy()
-            mensagem_copy["replicated"] = True
-            lista_servidores = obter_lista_servidores()
-            
-            for servidor in lista_servidores:
-                nome_servidor = servidor.get("name")
-                if nome_servidor == NOME_SERVIDOR:
-                    continue
-                
-                try:
-                    ctx = zmq.Context()
-                    sock = ctx.socket(zmq.REQ)
-                    sock.connect(f"tcp://{nome_servidor}:{REPLICATION_PORT}")
-                    sock.setsockopt(zmq.RCVTIMEO, 2000)
-                    sock.setsockopt(zmq.SNDTIMEO, 2000)
-                    sock.send(msgpack.packb(mensagem_copy))
-                    sock.recv()
-                    sock.close()
-                    ctx.term()
-                except:
-                    pass
-        except:
-            pass
-    
-    threading.Thread(target=enviar_replicacao, daemon=True).start()
+    mensagens = getattr(contexto_lote, "replicacao", None)
+    if mensagens is not None:
+        mensagens.append(mensagem)
+    else:
+        replicador.replicar(mensagem)
 
-# Classe do relógio lógico
+# Classe do relógio lógico (protegida por lock: usada por várias threads)
 class RelogioLogico:
     def __init__(self):
         self.clock = 0
+        self.lock = threading.Lock()
     def tick(self):
-        self.clock += 1
-        return self.clock
+        with self.lock:
+            self.clock += 1
+            return self.clock
     def update(self, clock_recebido):
-        self.clock = max(self.clock, clock_recebido)
-        return self.clock
+        with self.lock:
+            self.clock = max(self.clock, clock_recebido)
+            return self.clock
     def get(self):
         return self.clock
 
 relogio = RelogioLogico()
+instrumentacao = Instrumentacao()
+
+# Protege o estado compartilhado (usuarios, canais) e o socket PUB entre threads
+lock_estado = threading.Lock()
+lock_pub = threading.Lock()
+
+# Cache das listagens (`users` e `channels`): a lista de nomes fica
+# codificada e só é refeita quando a versão muda. A versão sobe (com
+# lock_estado) a cada usuário/canal novo: login, criação de canal,
+# replicação e recarga dos arquivos.
+versoes_listagens = {"users": 0, "channels": 0}
+listagens = {}
+
+class Listagem:
+    """Nomes de uma listagem com as formas codificadas prontas para a resposta"""
+    __slots__ = ("versao", "nomes", "msgpack", "_json")
+
+    def __init__(self, versao, nomes):
+        self.versao = versao
+        self.nomes = nomes
+        self.msgpack = msgpack.packb(nomes)
+        self._json = None
+
+    def json(self):
+        if self._json is None:
+            self._json = json.dumps(self.nomes)
+        return self._json
+
+    def resposta(self, reply, formato_json):
+        """Codifica {service, data: {timestamp, <service>: nomes, clock}} reaproveitando a lista"""
+        service = reply["service"]
+        data = reply["data"]
+        if formato_json:
+            return (f'{{"service": "{service}", "data": {{"timestamp": {json.dumps(data["timestamp"])}, '
+                    f'"{service}": {self.json()}, "clock": {data["clock"]}}}}}').encode('utf-8')
+        packer = codec().packer
+        prefixo, chave = PREFIXOS_LISTAGEM[service]
+        return b"".join((
+            prefixo, packer.pack(data["timestamp"]),
+            chave, self.msgpack,
+            CHAVE_CLOCK, packer.pack(data["clock"]),
+        ))
+
+# Trechos constantes da resposta de listagem em MessagePack:
+# {"service": <service>, "data": {"timestamp": .., <service>: .., "clock": ..}}
+PREFIXOS_LISTAGEM = {
+    service: (
+        b"\x82" + msgpack.packb("service") + msgpack.packb(service)
+        + msgpack.packb("data") + b"\x83" + msgpack.packb("timestamp"),
+        msgpack.packb(service),
+    )
+    for service in ("users", "channels")
+}
+CHAVE_CLOCK = msgpack.packb("clock")
+
+def invalidar_listagem(tipo):
+    # Chamado com lock_estado
+    versoes_listagens[tipo] += 1
+
+def obter_listagem(tipo):
+    listagem = listagens.get(tipo)
+    if listagem is None or listagem.versao != versoes_listagens[tipo]:
+        with lock_estado:
+            versao = versoes_listagens[tipo]
+            nomes = list(usuarios if tipo == "users" else canais)
+        listagem = listagens[tipo] = Listagem(versao, nomes)
+    return listagem
+
+def codificar_objeto(obj):
+    # `default` do msgpack/json para uma Listagem dentro de outra estrutura
+    if isinstance(obj, Listagem):
+        return obj.nomes
+    raise TypeError(f"Tipo nao serializavel: {type(obj).__name__}")
+
+# Formato da requisição pelo primeiro byte: toda requisição é um mapa, que
+# em MessagePack começa por fixmap (0x80-0x8f), map16 (0xde) ou map32
+# (0xdf). Nenhum desses bytes inicia um JSON válido, e um objeto JSON
+# começa por "{" ou espaço, que em MessagePack seriam inteiros, nunca um
+# mapa. Assim um cliente JSON não paga por uma decodificação que falha.
+INICIO_MAPA_MSGPACK = frozenset(range(0x80, 0x90)) | {0xde, 0xdf}
+
+def formato_provavel_json(request_data):
+    """Formato para responder quando a requisição nem pôde ser decodificada"""
+    return bool(request_data) and request_data[0] not in INICIO_MAPA_MSGPACK
+
+class ErroCodec(ValueError):
+    pass
+
+class Codec:
+    """Packer/Unpacker reaproveitados entre requisições (um por thread)"""
+
+    def __init__(self):
+        self.packer = msgpack.Packer(default=codificar_objeto)
+        self.unpacker = msgpack.Unpacker(raw=False)
+
+    def decodificar(self, request_data):
+        """(request, formato_json) de uma requisição de cliente"""
+        if not request_data:
+            raise ErroCodec("Requisicao vazia")
+        if request_data[0] not in INICIO_MAPA_MSGPACK:
+            return json.loads(request_data), True
+        unpacker = self.unpacker
+        inicio = unpacker.tell()
+        unpacker.feed(request_data)
+        try:
+            request = unpacker.unpack()
+        except Exception:
+            # Mensagem truncada ou inválida: descarta o que ficou no buffer
+            self.unpacker = msgpack.Unpacker(raw=False)
+            raise
+        if unpacker.tell() - inicio != len(request_data):
+            self.unpacker = msgpack.Unpacker(raw=False)
+            raise ErroCodec("Bytes extras depois da requisicao")
+        return request, False
+
+    def codificar(self, obj):
+        return self.packer.pack(obj)
+
+codec_local = threading.local()
+
+def codec():
+    atual = getattr(codec_local, "codec", None)
+    if atual is None:
+        atual = codec_local.codec = Codec()
+    return atual
 
 # Variáveis para sincronização e eleição
 import socket as sock
@@ -140,19 +360,29 @@ coordenador_atual = None
 contador_mensagens = 0
 ajuste_relogio = 0.0  # Ajuste do relógio físico (Berkeley)
 
-# Socket para comunicação com servidor de referência
-ref_context = zmq.Context()
-ref_socket = ref_context.socket(zmq.REQ)
-ref_socket.connect("tcp://referencia:5560")
-
-# Socket PUB para eleições (tópico "servers")
-election_pub_socket = ref_context.socket(zmq.PUB)
-election_pub_socket.connect("tcp://proxy:5557")
+# Sockets para o servidor de referência e eleições (ver conectar_referencia)
+ref_socket = None
+election_pub_socket = None
+election_sub_socket = None
 
-# Socket SUB para eleições
-election_sub_socket = ref_context.socket(zmq.SUB)
-election_sub_socket.connect("tcp://proxy:5558")
-election_sub_socket.setsockopt_string(zmq.SUBSCRIBE, "servers")
+def conectar_referencia():
+    """Cria os sockets de comunicação com o servidor de referência e de eleição"""
+    global ref_socket, election_pub_socket, election_sub_socket
+    ref_context = zmq.Context()
+    
+    # Socket para comunicação com servidor de referência
+    ref_socket = ref_context.socket(zmq.REQ)
+    ref_socket.connect("tcp://referencia:5560")
+    
+    # Socket PUB para eleições (tópico "servers")
+    election_pub_socket = ref_context.socket(zmq.PUB)
+    election_pub_socket.connect("tcp://proxy:5557")
+    
+    # Socket SUB para eleições e mudanças na lista de servidores
+    election_sub_socket = ref_context.socket(zmq.SUB)
+    election_sub_socket.connect("tcp://proxy:5558")
+    election_sub_socket.setsockopt_string(zmq.SUBSCRIBE, "servers")
+    election_sub_socket.setsockopt_string(zmq.SUBSCRIBE, TOPICO_MEMBROS)
 
 def registrar_no_servidor_referencia():
     """Registra o servidor e obtém seu rank"""
@@ -177,7 +407,7 @@ def registrar_no_servidor_referencia():
             relogio.update(reply["data"]["clock"])
         
         rank_servidor = reply.get("data", {}).get("rank")
-        print(f"[S] Servidor {NOME_SERVIDOR} registrado com rank {rank_servidor}", flush=True)
+        logger.info("Servidor %s registrado com rank %s", NOME_SERVIDOR, rank_servidor)
     except:
         rank_servidor = None
 
@@ -210,13 +440,52 @@ def enviar_heartbeat():
         except:
             pass
 
+# Os eventos de membros passam pelo proxy dos canais: o tópico leva um prefixo
+# que nomes de usuário/canal não podem ter (ver nomes_validos), senão quem
+# assina um canal com nome parecido receberia esses eventos
+PREFIXO_RESERVADO = "#"
+TOPICO_MEMBROS = PREFIXO_RESERVADO + "membership"
+
+# Cache local da lista de servidores: atualizado pelos eventos "membership"
+# publicados pelo servidor de referência e renovado por consulta após o TTL
+MEMBROS_TTL = float(os.environ.get("MEMBROS_TTL", 30))
+cache_membros = {"lista": [], "versao": -1, "expira": 0.0}
+lock_membros = threading.Lock()
+
+def atualizar_membros(lista, versao=None):
+    with lock_membros:
+        # Ignora eventos mais antigos do que a versão já conhecida
+        if versao is not None and versao < cache_membros["versao"]:
+            return
+        cache_membros["lista"] = lista
+        if versao is not None:
+            cache_membros["versao"] = versao
+        cache_membros["expira"] = time.monotonic() + MEMBROS_TTL
+
 def obter_lista_servidores():
-    """Obtém a lista de servidores do servidor de referência"""
+    """Obtém a lista de servidores (do cache, consultando a referência só após o TTL)"""
+    with lock_membros:
+        if time.monotonic() < cache_membros["expira"]:
+            return cache_membros["lista"]
+        lista_anterior = cache_membros["lista"]
+    
+    reply = consultar_lista_servidores()
+    if reply is None:
+        return lista_anterior
+    atualizar_membros(reply.get("list", []), reply.get("version"))
+    return reply.get("list", [])
+
+def consultar_lista_servidores():
+    """Consulta a lista de servidores no servidor de referência"""
     try:
         ctx = zmq.Context()
         sock = ctx.socket(zmq.REQ)
         sock.connect("tcp://referencia:5560")
         
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.setsockopt(zmq.RCVTIMEO, 5000)
+        sock.setsockopt(zmq.SNDTIMEO, 5000)
+        
         request = {
             "service": "list",
             "data": {
@@ -231,14 +500,12 @@ def obter_lista_servidores():
         if "data" in reply and "clock" in reply["data"]:
             relogio.update(reply["data"]["clock"])
         
-        lista = reply.get("data", {}).get("list", [])
-        
         sock.close()
         ctx.term()
         
-        return lista
+        return reply.get("data", {})
     except:
-        return []
+        return None
 
 def sincronizar_relogio():
     """Sincroniza o relógio com o coordenador usando algoritmo de Berkeley"""
@@ -307,7 +574,7 @@ def iniciar_eleicao():
     """Inicia o processo de eleição (Bully Algorithm)"""
     global coordenador_atual
     
-    print(f"[S] Iniciando eleição...", flush=True)
+    logger.info("Iniciando eleição...")
     
     lista_servidores = obter_lista_servidores()
     meu_rank = rank_servidor
@@ -366,7 +633,13 @@ def monitor_eleicoes():
             msg_data = election_sub_socket.recv()
             msg = msgpack.unpackb(msg_data, raw=False)
             
-            if msg.get("type") == "election":
+            if msg.get("type") == "membership":
+                dados = msg.get("data", {})
+                atualizar_membros(dados.get("list", []), dados.get("version"))
+                if "clock" in dados:
+                    relogio.update(dados["clock"])
+            
+            elif msg.get("type") == "election":
                 novo_coord = msg.get("data", {}).get("coordinator")
                 if novo_coord:
                     coordenador_atual = novo_coord
@@ -375,375 +648,958 @@ def monitor_eleicoes():
         except:
             pass
 
-time.sleep(3)
-registrar_no_servidor_referencia()
-
-if rank_servidor is not None:
-    threading.Thread(target=enviar_heartbeat, daemon=True).start()
-    threading.Thread(target=sincronizar_relogio, daemon=True).start()
-    threading.Thread(target=monitor_eleicoes, daemon=True).start()
-    if rank_servidor == 1:
-        coordenador_atual = NOME_SERVIDOR
-
-PUB_PORT = 5559  # Porta para publisher
-
-context = zmq.Context()
-socket = context.socket(zmq.REP)
-socket.connect("tcp://broker:5556")
-
-# Socket para responder requisições de sincronização e eleição
-sync_socket = context.socket(zmq.REP)
-sync_socket.bind("tcp://*:5561")
-
-replication_socket = context.socket(zmq.REP)
-replication_socket.bind(f"tcp://*:{REPLICATION_PORT}")
+def entrar_no_cluster():
+    """Registra o servidor na referência e inicia heartbeat, sincronização e eleição"""
+    global coordenador_atual
+    time.sleep(3)
+    registrar_no_servidor_referencia()
+    
+    if rank_servidor is not None:
+        threading.Thread(target=enviar_heartbeat, daemon=True).start()
+        threading.Thread(target=sincronizar_relogio, daemon=True).start()
+        threading.Thread(target=monitor_eleicoes, daemon=True).start()
+        if rank_servidor == 1:
+            coordenador_atual = NOME_SERVIDOR
 
-pub_socket = context.socket(zmq.PUB)
-pub_socket.bind(f"tcp://*:{PUB_PORT}")
+def iniciar_armazenamento():
+    """Carrega usuários/canais, abre os logs e inicia a thread de persistência"""
+    global gravador, usuarios, canais, publicacoes_log, mensagens_log, indice_canais, indice_destinatarios
+    os.makedirs(DATA_DIR, exist_ok=True)
+    reivindicar_identidade()
+    logger.info("%s usa os dados de %s", NOME_SERVIDOR, SERVIDOR_ID)
+    
+    # Thread de persistência: as escritas em disco saem do caminho da resposta
+    gravador = GravadorAssincrono(
+        politica=os.environ.get("PERSISTENCIA_FSYNC", "batch"),
+        intervalo_ms=float(os.environ.get("PERSISTENCIA_INTERVALO_MS", 5)),
+        max_registros=int(os.environ.get("PERSISTENCIA_MAX_REGISTROS", 512)),
+        tamanho_fila=int(os.environ.get("PERSISTENCIA_FILA", 10000)),
+    )
+    
+    # Carregar dados persistidos (dicts indexados pelo nome do usuário/canal)
+    usuarios, canais, compactar = carregar_dados()
+    with lock_estado:
+        invalidar_listagem("users")
+        invalidar_listagem("channels")
+    if compactar:
+        compactar_estado()
+    
+    # Publicações e mensagens privadas ficam em logs segmentados próprios de cada
+    # servidor (o volume de dados é compartilhado entre as réplicas)
+    log_dir = os.environ.get("LOG_DIR", os.path.join(DATA_DIR, SERVIDOR_ID))
+    publicacoes_log = LogSegmentado(os.path.join(log_dir, "publicacoes"))
+    mensagens_log = LogSegmentado(os.path.join(log_dir, "mensagens"))
+    for nome, log in (("publicacoes", publicacoes_log), ("mensagens", mensagens_log)):
+        for extensao in (EXTENSAO, ".json"):
+            importar_json(os.path.join(DATA_DIR, nome + extensao), log)
+    
+    # Índice por canal das publicações, usado pelo serviço `history`
+    indice_canais = IndiceSecundario(os.path.join(log_dir, "publicacoes", "por_canal.sidx"), "channel")
+    publicacoes_log.registrar_indice(indice_canais)
+    # Índice por destinatário das mensagens privadas, usado pelo serviço `inbox`
+    indice_destinatarios = IndiceSecundario(os.path.join(log_dir, "mensagens", "por_destinatario.sidx"), "dst")
+    mensagens_log.registrar_indice(indice_destinatarios)
+    # Depois de reiniciar, o relógio continua acima dos clocks já atribuídos:
+    # (clock, origem) identifica a publicação/mensagem no cluster
+    relogio.update(max(indice_canais.maior_clock, indice_destinatarios.maior_clock))
 
-# Carregar dados persistidos
-usuarios, canais = carregar_dados()
+def encerrar_armazenamento():
+    gravador.fechar()
+    estado.fechar()
+    publicacoes_log.fechar()
+    mensagens_log.fechar()
 
 def recarregar_dados_periodicamente():
-    global usuarios, canais
     while True:
-        time.sleep(2)
+        time.sleep(RECARGA_INTERVALO)
         try:
-            usuarios_novos, canais_novos = carregar_dados()
-            usuarios = usuarios_novos
-            canais = canais_novos
+            recarregar_se_alterado()
         except:
             pass
 
-threading.Thread(target=recarregar_dados_periodicamente, daemon=True).start()
+def aplicar_replicacao(service, data):
+    """Aplica localmente uma operação replicada por outro servidor"""
+    if "clock" in data:
+        relogio.update(data["clock"])
+    
+    if service == "batch":
+        # Operações de um `batch` replicadas juntas: uma única ida ao gravador
+        contexto_lote.persistencia = []
+        try:
+            for operacao in data.get("ops", []):
+                aplicar_replicacao(operacao.get("service"), operacao.get("data", {}))
+        finally:
+            escritas = contexto_lote.persistencia
+            contexto_lote.persistencia = None
+            if escritas:
+                gravador.persistir_lote(escritas)
+    
+    elif service == "login":
+        user = data.get("user")
+        with lock_estado:
+            novo = user not in usuarios
+            if novo:
+                registro = usuarios[user] = {"user": user, "timestamp": data.get("timestamp")}
+                invalidar_listagem("users")
+        if novo:
+            persistir(estado.registrar, "users", registro)
+            log_requisicoes.info("Replicado usuario: %s", user)
+    
+    elif service == "channel":
+        channel = data.get("channel", data.get("canal"))
+        with lock_estado:
+            novo = channel not in canais
+            if novo:
+                registro = canais[channel] = {"channel": channel, "timestamp": data.get("timestamp")}
+                invalidar_listagem("channels")
+        if novo:
+            persistir(estado.registrar, "channels", registro)
+            log_requisicoes.info("Replicado canal: %s", channel)
+    
+    elif service == "publish":
+        # clock e origin vêm do servidor de origem (ver armazenamento.ordem_registro)
+        persistir(salvar_publicacao, {
+            "user": data.get("user"),
+            "channel": data.get("channel"),
+            "message": data.get("message"),
+            "timestamp": data.get("timestamp"),
+            "clock": data.get("clock"),
+            "origin": data.get("origin")
+        })
+    
+    elif service == "message":
+        persistir(salvar_mensagem_privada, {
+            "src": data.get("src"),
+            "dst": data.get("dst"),
+            "message": data.get("message"),
+            "timestamp": data.get("timestamp"),
+            "clock": data.get("clock"),
+            "origin": data.get("origin")
+        })
+
+def iniciar_replicacao():
+    """Cria o replicador conforme REPLICACAO_MODO
+
+    "pool": REQ/REP direto na porta 5562, uma conexão por servidor;
+    "stream": lotes numerados pelo proxy de replicação 5570/5571.
+    """
+    global replicador
+    if os.environ.get("REPLICACAO_MODO", "pool") == "stream":
+        replicador = StreamReplicacao(
+            NOME_SERVIDOR,
+            aplicar_replicacao,
+            tamanho_lote=int(os.environ.get("REPLICACAO_LOTE", 256)),
+            linger_ms=float(os.environ.get("REPLICACAO_LINGER_MS", 5)),
+        )
+    else:
+        replicador = PoolReplicacao(NOME_SERVIDOR, REPLICATION_PORT, obter_lista_servidores)
+
+def resposta_erro(service, descricao):
+    return {
+        "service": service,
+        "data": {
+            "status": "erro",
+            "timestamp": time.time(),
+            "description": descricao,
+            "clock": relogio.tick()
+        }
+    }
+
+def nomes_validos(*nomes):
+    """Nomes de usuário/canal vindos do cliente: strings não vazias e fora
+    dos tópicos reservados (PREFIXO_RESERVADO)"""
+    return all(isinstance(nome, str) and nome and not nome.startswith(PREFIXO_RESERVADO) for nome in nomes)
+
+def criar_pub_socket(context):
+    """Socket PUB das mensagens de canais/usuários (ver PUBLICACAO_MODO)
+
+    relay  - bind na PUB_PORT; o publisher.py repassa para o proxy
+    direto - conecta direto no XSUB do proxy, sem o salto pelo publisher
+    """
+    sock = context.socket(zmq.PUB)
+    sock.setsockopt(zmq.SNDHWM, int(os.environ.get("PUBLICACAO_SNDHWM", 100000)))
+    if os.environ.get("PUBLICACAO_MODO", "relay") == "direto":
+        sock.connect("tcp://proxy:5557")
+    else:
+        sock.bind(f"tcp://*:{PUB_PORT}")
+    return sock
+
+def publicar(pub_msg):
+    """Publica [tópico, payload] no socket PUB (compartilhado entre os workers)
+
+    O tópico vai num frame próprio para o publisher repassar sem decodificar.
+    """
+    frames = [str(pub_msg.get("topic") or "").encode(), codec().codificar(pub_msg)]
+    with lock_pub:
+        pub_socket.send_multipart(frames)
 
-poller = zmq.Poller()
-poller.register(socket, zmq.POLLIN)
-poller.register(sync_socket, zmq.POLLIN)
-poller.register(replication_socket, zmq.POLLIN)
+def codificar_resposta(reply, formato_json):
+    service = reply.get("service")
+    listagem = reply["data"].get(service) if service == "users" or service == "channels" else None
+    if isinstance(listagem, Listagem):
+        return listagem.resposta(reply, formato_json)
+    if formato_json:
+        return json.dumps(reply, default=codificar_objeto).encode('utf-8')
+    return codec().codificar(reply)
 
-print(f"[S] {NOME_SERVIDOR} pronto", flush=True)
+def processar_requisicao(request_data):
+    """Processa uma requisição de cliente e retorna a resposta serializada
 
-while True:
+    Mede a latência e conta os erros por serviço (serviço `stats`).
+    """
+    inicio = time.perf_counter()
     try:
-        socks = dict(poller.poll())
-        
-        if socket in socks:
-            request_data = socket.recv()
-            print(f"[S] Recebido {len(request_data)} bytes", flush=True)
-            
-            # Detectar formato: MessagePack ou JSON
-            formato_json = False
+        reply, formato_json = tratar_requisicao(request_data)
+    except Exception:
+        instrumentacao.registrar("interno", time.perf_counter() - inicio, erro=True)
+        raise
+    
+    # Responder no mesmo formato que recebeu
+    resposta = codificar_resposta(reply, formato_json)
+    erro = reply.get("data", {}).get("status") == "erro"
+    servico = reply.get("service")
+    instrumentacao.registrar(servico if isinstance(servico, str) else "unknown", time.perf_counter() - inicio, erro)
+    return resposta
+
+# Handlers dos serviços: recebem o `data` da requisição e retornam o reply
+def servico_login(data):
+    """Cadastra um usuário (falha se o nome já existe)"""
+    user = data.get("user")
+    timestamp = data.get("timestamp")
+    if not nomes_validos(user):
+        return resposta_erro("login", "Dados invalidos")
+    
+    # Verificar se o usuário já existe (e reservar o nome de forma atômica)
+    with lock_estado:
+        usuario_existe = user in usuarios
+        if not usuario_existe:
+            registro = usuarios[user] = {
+                "user": user,
+                "timestamp": timestamp
+            }
+            invalidar_listagem("users")
+    
+    if usuario_existe:
+        reply = {
+            "service": "login",
+            "data": {
+                "status": "erro",
+                "timestamp": time.time(),
+                "description": "Usuário já cadastrado",
+                "clock": relogio.tick()
+            }
+        }
+        log_requisicoes.info("Tentativa de login com usuário existente: %s", user)
+    else:
+        persistir(estado.registrar, "users", registro)
+    
+        reply = {
+            "service": "login",
+            "data": {
+                "status": "sucesso",
+                "timestamp": time.time(),
+                "clock": relogio.tick()
+            }
+        }
+        log_requisicoes.info("Login: %s", user)
+        replicar_para_outros_servidores({"service": "login", "data": data})
+    return reply
+
+def servico_users(data):
+    """Lista os nomes dos usuários cadastrados (do cache de listagens)"""
+    lista_usuarios = obter_listagem("users")
+    log_requisicoes.info("Listando usuarios: %d", len(lista_usuarios.nomes))
+    
+    reply = {
+        "service": "users",
+        "data": {
+            "timestamp": time.time(),
+            "users": lista_usuarios,
+            "clock": relogio.tick()
+        }
+    }
+    return reply
+
+def servico_channel(data):
+    """Cria um canal (falha se já existe)"""
+    channel = data.get("channel", data.get("canal"))
+    timestamp = data.get("timestamp")
+    if not nomes_validos(channel):
+        return resposta_erro("channel", "Dados invalidos")
+    with lock_estado:
+        canal_existe = channel in canais
+        if not canal_existe:
+            registro = canais[channel] = {"channel": channel, "timestamp": timestamp}
+            invalidar_listagem("channels")
+    
+    if canal_existe:
+        reply = {
+            "service": "channel",
+            "data": {
+                "status": "erro",
+                "timestamp": time.time(),
+                "description": "Canal ja existe",
+                "clock": relogio.tick()
+            }
+        }
+    else:
+        persistir(estado.registrar, "channels", registro)
+        reply = {
+            "service": "channel",
+            "data": {
+                "status": "sucesso",
+                "timestamp": time.time(),
+                "clock": relogio.tick()
+            }
+        }
+        log_requisicoes.info("Canal: %s", channel)
+        replicar_para_outros_servidores({"service": "channel", "data": data})
+    return reply
+
+def servico_channels(data):
+    """Lista os nomes dos canais (do cache de listagens)"""
+    lista_canais = obter_listagem("channels")
+    log_requisicoes.info("Listando canais: %d", len(lista_canais.nomes))
+    
+    reply = {
+        "service": "channels",
+        "data": {
+            "timestamp": time.time(),
+            "channels": lista_canais,
+            "clock": relogio.tick()
+        }
+    }
+    return reply
+
+def servico_publish(data):
+    """Publica uma mensagem num canal e persiste no log de publicações"""
+    user = data.get("user")
+    channel = data.get("channel")
+    message = data.get("message")
+    timestamp = data.get("timestamp")
+    if not nomes_validos(user, channel):
+        return resposta_erro("publish", "Dados invalidos")
+    canal_existe = channel in canais
+    
+    if not canal_existe:
+        reply = {
+            "service": "publish",
+            "data": {
+                "status": "erro",
+                "message": f"Canal nao existe",
+                "timestamp": time.time(),
+                "clock": relogio.tick()
+            }
+        }
+    else:
+        pub_msg = {
+            "type": "channel",
+            "topic": channel,
+            "user": user,
+            "channel": channel,
+            "message": message,
+            "timestamp": timestamp,
+            "clock": relogio.tick()
+        }
+        publicar(pub_msg)
+        # O clock atribuído aqui e a origem vão no registro e na replicação:
+        # são a posição da publicação na paginação do `history` em todas as réplicas
+        persistir(salvar_publicacao, {"user": user, "channel": channel, "message": message, "timestamp": timestamp,
+                                      "clock": pub_msg["clock"], "origin": SERVIDOR_ID})
+    
+        reply = {
+            "service": "publish",
+            "data": {
+                "status": "OK",
+                "timestamp": time.time(),
+                "clock": relogio.tick()
+            }
+        }
+        log_requisicoes.info("Publicado: %s", channel)
+        replicar_para_outros_servidores({"service": "publish", "data": dict(data, clock=pub_msg["clock"], origin=SERVIDOR_ID)})
+    return reply
+
+# Antes de qualquer registro na ordem de armazenamento.ordem_registro
+ORDEM_INICIAL = (-1, "", -1)
+
+def ler_cursor(valor, depois=False):
+    """Cursor de paginação de `history`/`inbox` como armazenamento.ordem_registro
+
+    Aceita o `cursor` devolvido com cada mensagem, [clock, origem,
+    desempate], ou só um clock (before: clock menor; after: clock maior).
+    Retorna None sem cursor e levanta ValueError se for inválido.
+    """
+    if valor is None:
+        return None
+    if isinstance(valor, int) and not isinstance(valor, bool):
+        return (valor + 1, "", -1) if depois else (valor, "", -1)
+    if (isinstance(valor, (list, tuple)) and len(valor) == 3 and isinstance(valor[1], str)
+            and all(isinstance(v, int) and not isinstance(v, bool) for v in (valor[0], valor[2]))):
+        return tuple(valor)
+    raise ValueError(f"Cursor invalido: {valor!r}")
+
+def ler_limite(valor):
+    """Tamanho da página de `history`/`inbox`, limitado a HISTORICO_LIMITE_MAX
+
+    Levanta ValueError se não for um inteiro positivo.
+    """
+    if isinstance(valor, bool) or not isinstance(valor, (int, str)):
+        raise ValueError(f"Limite invalido: {valor!r}")
+    limite = int(valor)
+    if limite < 1:
+        raise ValueError(f"Limite invalido: {valor!r}")
+    return min(limite, HISTORICO_LIMITE_MAX)
+
+def servico_history(data):
+    """Histórico paginado de um canal, lido pelo índice secundário"""
+    channel = data.get("channel")
+    if not nomes_validos(channel):
+        return resposta_erro("history", "Dados invalidos")
+    try:
+        limite = ler_limite(data.get("limit", 50))
+    except ValueError:
+        return resposta_erro("history", "Limite invalido")
+    try:
+        antes = ler_cursor(data.get("before"))
+        depois = ler_cursor(data.get("after"), depois=True)
+    except ValueError:
+        return resposta_erro("history", "Cursor invalido")
+    
+    if channel not in canais:
+        reply = {
+            "service": "history",
+            "data": {
+                "status": "erro",
+                "message": f"Canal nao existe",
+                "timestamp": time.time(),
+                "clock": relogio.tick()
+            }
+        }
+    else:
+        # Só lê do log as publicações selecionadas pelo índice do canal
+        mensagens = []
+        for seq, ordem in indice_canais.consultar(channel, antes=antes, depois=depois, limite=limite):
+            publicacao = publicacoes_log.ler(seq)
+            publicacao["cursor"] = list(ordem)
+            mensagens.append(publicacao)
+    
+        reply = {
+            "service": "history",
+            "data": {
+                "status": "OK",
+                "channel": channel,
+                "messages": mensagens,
+                "timestamp": time.time(),
+                "clock": relogio.tick()
+            }
+        }
+    return reply
+
+def servico_inbox(data):
+    """Mensagens privadas recebidas por um usuário após um cursor"""
+    dst = data.get("dst", data.get("user"))
+    if not nomes_validos(dst):
+        return resposta_erro("inbox", "Dados invalidos")
+    try:
+        limite = ler_limite(data.get("limit", 50))
+    except ValueError:
+        return resposta_erro("inbox", "Limite invalido")
+    try:
+        depois = ler_cursor(data.get("after"), depois=True)
+    except ValueError:
+        return resposta_erro("inbox", "Cursor invalido")
+    
+    if dst not in usuarios:
+        reply = {
+            "service": "inbox",
+            "data": {
+                "status": "erro",
+                "message": f"Usuario nao existe",
+                "timestamp": time.time(),
+                "clock": relogio.tick()
+            }
+        }
+    else:
+        # Mensagens do destinatário após o cursor, na ordem do cluster
+        mensagens = []
+        for seq, ordem in indice_destinatarios.consultar(dst, depois=depois or ORDEM_INICIAL, limite=limite):
+            mensagem = mensagens_log.ler(seq)
+            mensagem["cursor"] = list(ordem)
+            mensagens.append(mensagem)
+    
+        reply = {
+            "service": "inbox",
+            "data": {
+                "status": "OK",
+                "dst": dst,
+                "messages": mensagens,
+                "cursor": mensagens[-1]["cursor"] if mensagens else data.get("after"),
+                "timestamp": time.time(),
+                "clock": relogio.tick()
+            }
+        }
+    return reply
+
+def servico_message(data):
+    """Envia uma mensagem privada e persiste no log de mensagens"""
+    src = data.get("src")
+    dst = data.get("dst")
+    message = data.get("message")
+    timestamp = data.get("timestamp")
+    if not nomes_validos(src, dst):
+        return resposta_erro("message", "Dados invalidos")
+    usuario_existe = dst in usuarios
+    
+    if not usuario_existe:
+        reply = {
+            "service": "message",
+            "data": {
+                "status": "erro",
+                "message": f"Usuario nao existe",
+                "timestamp": time.time(),
+                "clock": relogio.tick()
+            }
+        }
+    else:
+        pub_msg = {
+            "type": "user",
+            "topic": dst,
+            "src": src,
+            "dst": dst,
+            "message": message,
+            "timestamp": timestamp,
+            "clock": relogio.tick()
+        }
+        publicar(pub_msg)
+        persistir(salvar_mensagem_privada, {"src": src, "dst": dst, "message": message, "timestamp": timestamp,
+                                            "clock": pub_msg["clock"], "origin": SERVIDOR_ID})
+    
+        reply = {
+            "service": "message",
+            "data": {
+                "status": "OK",
+                "timestamp": time.time(),
+                "clock": relogio.tick()
+            }
+        }
+        log_requisicoes.info("Mensagem: %s -> %s", src, dst)
+        replicar_para_outros_servidores({"service": "message", "data": dict(data, clock=pub_msg["clock"], origin=SERVIDOR_ID)})
+    return reply
+
+def servico_desconhecido(service, data):
+    """Resposta para serviços não reconhecidos"""
+    reply = {
+        "service": service if service else "unknown",
+        "data": {
+            "status": "erro",
+            "timestamp": time.time(),
+            "description": "Serviço não encontrado",
+            "clock": relogio.tick()
+        }
+    }
+    return reply
+
+def tratar_requisicao(request_data):
+    """Interpreta a requisição e executa o serviço; retorna (reply, formato_json)"""
+    global contador_mensagens
+    
+    log_requisicoes.debug("Recebido %d bytes", len(request_data))
+    
+    # Formato pelo primeiro byte (ver INICIO_MAPA_MSGPACK)
+    try:
+        request, formato_json = codec().decodificar(request_data)
+    except Exception as e:
+        logger.warning("Erro ao parsear: %s", e)
+        return resposta_erro("unknown", "Requisicao invalida"), formato_provavel_json(request_data)
+    if not isinstance(request, dict):
+        return resposta_erro("unknown", "Requisicao invalida"), formato_json
+    
+    service, data = campos_requisicao(request)
+    nome_servico = service if isinstance(service, str) else "unknown"
+    if not isinstance(data, dict):
+        return resposta_erro(nome_servico, "Dados invalidos"), formato_json
+    
+    log_requisicoes.info("Requisicao: %s", service)
+    
+    if isinstance(data.get("clock"), int):
+        relogio.update(data["clock"])
+    
+    with lock_estado:
+        contador_mensagens += 1
+    
+    # Erros do handler viram resposta de erro no formato do cliente
+    try:
+        if service == "batch":
+            reply = servico_batch(data)
+        else:
+            reply = executar_servico(service, data)
+    except Exception as e:
+        logger.exception("Erro ao processar %s: %s", nome_servico, e)
+        reply = resposta_erro(nome_servico, "Erro interno")
+    
+    return reply, formato_json
+
+def campos_requisicao(request):
+    """(service, data) aceitando também os nomes antigos `opcao`/`dados`"""
+    service = request.get("service")
+    if service is None:
+        service = request.get("opcao")
+    data = request.get("data")
+    if data is None:
+        data = request.get("dados")
+    return service, {} if data is None else data
+
+# Serviço (e apelidos dos clientes antigos) -> handler
+SERVICOS = {
+    "login": servico_login,
+    "users": servico_users,
+    "listar": servico_users,
+    "channel": servico_channel,
+    "cadastrarCanal": servico_channel,
+    "channels": servico_channels,
+    "listarCanal": servico_channels,
+    "publish": servico_publish,
+    "history": servico_history,
+    "inbox": servico_inbox,
+    "message": servico_message,
+}
+
+def executar_servico(service, data):
+    handler = SERVICOS.get(service) if isinstance(service, str) else None
+    if handler is None:
+        return servico_desconhecido(service, data)
+    return handler(data)
+
+def executar_lote(operacoes):
+    """Executa as operações em ordem; retorna a lista de replies
+
+    As escritas em disco vão para o gravador de uma vez (com fsync `always`
+    espera um único lote) e as replicações seguem numa única mensagem.
+    """
+    contexto_lote.persistencia = []
+    contexto_lote.replicacao = []
+    replies = []
+    try:
+        for operacao in operacoes:
+            if not isinstance(operacao, dict):
+                replies.append(resposta_erro("unknown", "Operacao invalida"))
+                continue
+            service, data = campos_requisicao(operacao)
+            if not isinstance(data, dict):
+                replies.append(resposta_erro(service if isinstance(service, str) else "unknown", "Dados invalidos"))
+                continue
+            if service == "batch":
+                replies.append(resposta_erro("batch", "Lote dentro de lote"))
+                continue
             try:
-                request = msgpack.unpackb(request_data, raw=False)
-                print(f"[S] Formato: MessagePack", flush=True)
-            except:
+                replies.append(executar_servico(service, data))
+            except Exception as e:
+                logger.exception("Erro na operacao %s do lote: %s", service, e)
+                replies.append(resposta_erro(service if isinstance(service, str) else "unknown", "Erro interno"))
+    finally:
+        escritas = contexto_lote.persistencia
+        replicacoes = contexto_lote.replicacao
+        contexto_lote.persistencia = None
+        contexto_lote.replicacao = None
+        if escritas:
+            gravador.persistir_lote(escritas)
+        if len(replicacoes) == 1:
+            replicador.replicar(replicacoes[0])
+        elif replicacoes:
+            replicador.replicar({"service": "batch", "data": {"ops": replicacoes}})
+    return replies
+
+def servico_batch(data):
+    """Várias operações numa única requisição: {"ops": [{service, data}, ...]}"""
+    operacoes = data.get("ops") if isinstance(data, dict) else None
+    if not isinstance(operacoes, list) or len(operacoes) > LOTE_MAX_OPERACOES:
+        return resposta_erro("batch", f"Lote invalido (maximo {LOTE_MAX_OPERACOES} operacoes)")
+    
+    replies = executar_lote(operacoes)
+    log_requisicoes.info("Lote: %d operacoes", len(replies))
+    return {
+        "service": "batch",
+        "data": {
+            "status": "OK",
+            "replies": replies,
+            "timestamp": time.time(),
+            "clock": relogio.tick()
+        }
+    }
+
+def coletar_estatisticas():
+    """Instantâneo das métricas do servidor para o serviço `stats`"""
+    return {
+        "servidor": NOME_SERVIDOR,
+        "identidade": SERVIDOR_ID,
+        "desde": instrumentacao.inicio,
+        "requisicoes": contador_mensagens,
+        "servicos": instrumentacao.resumo(),
+        "persistencia": {
+            "fila": gravador.profundidade() if gravador else 0,
+            "lotes": gravador.lotes_gravados if gravador else 0,
+            "registros": gravador.registros_gravados if gravador else 0,
+        },
+        "replicacao": replicador.metricas() if replicador else {},
+        "recargas": dict(recargas),
+        "estado": estado.metricas() if estado else {},
+        "logs": logs.metricas(),
+    }
+
+def processar_sync(request_data, ao_receber_eleicao=None):
+    """Atende uma requisição de sincronização (clock), eleição ou `stats`"""
+    request = msgpack.unpackb(request_data, raw=False)
+    service = request.get("service")
+    data = request.get("data", {})
+    
+    if "clock" in data:
+        relogio.update(data["clock"])
+    
+    if service == "clock":
+        reply = {
+            "service": "clock",
+            "data": {
+                "time": time.time() + ajuste_relogio,
+                "timestamp": time.time(),
+                "clock": relogio.tick()
+            }
+        }
+    elif service == "election":
+        reply = {
+            "service": "election",
+            "data": {
+                "election": "OK",
+                "timestamp": time.time(),
+                "clock": relogio.tick()
+            }
+        }
+        if ao_receber_eleicao:
+            ao_receber_eleicao()
+        else:
+            threading.Thread(target=iniciar_eleicao, daemon=True).start()
+    elif service == "stats":
+        reply = {
+            "service": "stats",
+            "data": {
+                "stats": coletar_estatisticas(),
+                "timestamp": time.time(),
+                "clock": relogio.tick()
+            }
+        }
+    else:
+        reply = {
+            "service": service,
+            "data": {
+                "status": "erro",
+                "message": "Servico nao reconhecido",
+                "timestamp": time.time(),
+                "clock": relogio.tick()
+            }
+        }
+    
+    return msgpack.packb(reply)
+
+def processar_replicacao(request_data):
+    """Aplica uma operação recebida por REQ/REP na porta de replicação"""
+    request = msgpack.unpackb(request_data, raw=False)
+    
+    if request.get("replicated"):
+        aplicar_replicacao(request.get("service"), request.get("data", {}))
+        ack = {"status": "OK", "clock": relogio.tick()}
+    else:
+        ack = {"status": "ignored"}
+    return msgpack.packb(ack)
+
+def responder_interno(sock, processar):
+    """Recebe no REP de sincronização/replicação e sempre responde
+
+    Um REP que recebeu e não respondeu fica preso esperando o send, e todas
+    as mensagens seguintes falhariam: erros viram resposta de erro.
+    """
+    request_data = sock.recv()
+    try:
+        resposta = processar(request_data)
+    except Exception as e:
+        logger.exception("Erro ao processar mensagem interna: %s", e)
+        resposta = msgpack.packb(resposta_erro("unknown", "Erro interno"))
+    sock.send(resposta)
+
+def executar_worker(worker_id):
+    """Worker que atende requisições distribuídas pelo DEALER inproc"""
+    worker_socket = zmq.Context.instance().socket(zmq.REP)
+    worker_socket.connect("inproc://workers")
+    while True:
+        worker_socket.send(atender_requisicao(worker_socket.recv()))
+
+def atender_requisicao(request_data):
+    """processar_requisicao com as exceções convertidas em resposta de erro"""
+    try:
+        return processar_requisicao(request_data)
+    except Exception as e:
+        logger.exception("Erro ao processar requisicao: %s", e)
+        return codificar_resposta(resposta_erro("unknown", "Erro interno"), formato_provavel_json(request_data))
+
+# Protocolo com o broker no modo balanceado (BROKER_MODO; ver broker.py)
+BROKER_PRONTO = b"PRONTO"
+BROKER_HEARTBEAT = b"HB"
+BROKER_REQUISICAO = b"REQ"
+BROKER_RESPOSTA = b"REP"
+BROKER_HEARTBEAT_INTERVALO = float(os.environ.get("BROKER_HEARTBEAT", 1.0))
+BROKER_HEARTBEAT_TOLERANCIA = 3
+
+class ConexaoBroker:
+    """DEALER com o broker balanceado: anuncia a capacidade e manda heartbeats
+
+    Se o broker some por BROKER_HEARTBEAT_TOLERANCIA intervalos, o socket é
+    recriado e o worker se anuncia de novo.
+    """
+
+    def __init__(self, context, identidade, capacidade):
+        self.context = context
+        self.identidade = identidade
+        self.capacidade = capacidade
+        self.socket = None
+        self.reconexoes = 0
+        self.conectar()
+
+    def conectar(self):
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.setsockopt(zmq.IDENTITY, self.identidade.encode())
+        self.socket.connect("tcp://broker:5556")
+        self.anunciar()
+
+    def anunciar(self):
+        self.socket.send_multipart([BROKER_PRONTO, str(self.capacidade).encode()])
+        agora = time.monotonic()
+        self.ultimo_contato = agora
+        self.proximo_heartbeat = agora + BROKER_HEARTBEAT_INTERVALO
+
+    def receber(self):
+        """Trata uma mensagem do broker; retorna (seq, envelope, payload) se for requisição"""
+        frames = self.socket.recv_multipart(zmq.NOBLOCK)
+        self.ultimo_contato = time.monotonic()
+        if frames[0] == BROKER_REQUISICAO:
+            return frames[1], frames[2:-1], frames[-1]
+        if frames[0] == BROKER_PRONTO:
+            self.anunciar()
+        return None
+
+    def responder(self, seq, envelope, resposta):
+        self.socket.send_multipart([BROKER_RESPOSTA, seq] + envelope + [resposta])
+        self.proximo_heartbeat = time.monotonic() + BROKER_HEARTBEAT_INTERVALO
+
+    def manutencao(self, poller):
+        agora = time.monotonic()
+        if agora - self.ultimo_contato > BROKER_HEARTBEAT_INTERVALO * BROKER_HEARTBEAT_TOLERANCIA:
+            logger.warning("Broker sem resposta; reconectando")
+            poller.unregister(self.socket)
+            self.socket.close(0)
+            self.reconexoes += 1
+            self.conectar()
+            poller.register(self.socket, zmq.POLLIN)
+        elif agora >= self.proximo_heartbeat:
+            self.socket.send(BROKER_HEARTBEAT)
+            self.proximo_heartbeat = agora + BROKER_HEARTBEAT_INTERVALO
+
+def executar_worker_broker(worker_id, capacidade):
+    """Worker que recebe as requisições direto do broker balanceado
+
+    Cada worker é um destino próprio no broker, que vê quantas requisições
+    estão em andamento em cada um. Um worker travado num handler para de
+    mandar heartbeats e deixa de receber requisições.
+    """
+    broker = ConexaoBroker(zmq.Context.instance(), f"{NOME_SERVIDOR}/{worker_id}", capacidade)
+    poller = zmq.Poller()
+    poller.register(broker.socket, zmq.POLLIN)
+    while True:
+        if poller.poll(BROKER_HEARTBEAT_INTERVALO * 1000 / 2):
+            while True:
                 try:
-                    request = json.loads(request_data.decode('utf-8'))
-                    formato_json = True
-                    print(f"[S] Formato: JSON", flush=True)
-                    print(f"[S] Request: {request}", flush=True)
-                except Exception as e:
-                    print(f"[S] Erro ao parsear: {e}", flush=True)
-                    continue
-            
-            service = request.get("service", request.get("opcao"))
-            data = request.get("data", request.get("dados"))
-            
-            salvar_log(f"[{time.time()}] {service}")
-            
-            if data and "clock" in data:
-                relogio.update(data["clock"])
+                    requisicao = broker.receber()
+                except zmq.Again:
+                    break
+                if requisicao is not None:
+                    seq, envelope, payload = requisicao
+                    broker.responder(seq, envelope, atender_requisicao(payload))
+        broker.manutencao(poller)
+
+def executar():
+    """Ponto de entrada do servidor com threads e poll loop"""
+    global pub_socket
+    
+    configurar_logs()
+    conectar_referencia()
+    entrar_no_cluster()
+    
+    context = zmq.Context.instance()
+    
+    # Socket para responder requisições de sincronização e eleição
+    sync_socket = context.socket(zmq.REP)
+    sync_socket.bind("tcp://*:5561")
+    
+    replication_socket = context.socket(zmq.REP)
+    replication_socket.bind(f"tcp://*:{REPLICATION_PORT}")
+    
+    pub_socket = criar_pub_socket(context)
+    
+    iniciar_armazenamento()
+    threading.Thread(target=recarregar_dados_periodicamente, daemon=True).start()
+    threading.Thread(target=compactar_periodicamente, daemon=True).start()
+    iniciar_replicacao()
+    
+    # Com SERVIDOR_WORKERS > 1 as requisições dos clientes chegam por um ROUTER
+    # conectado ao broker e são distribuídas entre N threads por um DEALER inproc.
+    # Com BROKER_MODO=balanceado cada thread conversa direto com o broker.
+    workers = int(os.environ.get("SERVIDOR_WORKERS", 1))
+    socket = None
+    if os.environ.get("BROKER_MODO", "proxy") == "balanceado":
+        # Requisições em andamento por worker: uma a mais que a em execução
+        # evita deixá-lo ocioso enquanto a próxima está a caminho
+        capacidade = int(os.environ.get("SERVIDOR_CAPACIDADE", 2))
+        for worker_id in range(max(workers, 1)):
+            threading.Thread(target=executar_worker_broker, args=(worker_id, capacidade), daemon=True).start()
+    elif workers > 1:
+        frontend = context.socket(zmq.ROUTER)
+        frontend.connect("tcp://broker:5556")
+        backend = context.socket(zmq.DEALER)
+        backend.bind("inproc://workers")
+        for worker_id in range(workers):
+            threading.Thread(target=executar_worker, args=(worker_id,), daemon=True).start()
+        threading.Thread(target=zmq.proxy, args=(frontend, backend), daemon=True).start()
+    else:
+        socket = context.socket(zmq.REP)
+        socket.connect("tcp://broker:5556")
+    
+    poller = zmq.Poller()
+    if socket is not None:
+        poller.register(socket, zmq.POLLIN)
+    poller.register(sync_socket, zmq.POLLIN)
+    poller.register(replication_socket, zmq.POLLIN)
+    
+    logger.info("%s pronto", NOME_SERVIDOR)
+    
+    while True:
+        try:
+            socks = dict(poller.poll())
             
-            contador_mensagens += 1
+            if socket is not None and socket in socks:
+                socket.send(atender_requisicao(socket.recv()))
             
-            match service:
-                case "login":
-                    user = data.get("user")
-                    timestamp = data.get("timestamp")
-                    
-                    # Verificar se o usuário já existe
-                    usuario_existe = any(u.get("user") == user for u in usuarios)
-                    
-                    if usuario_existe:
-                        reply = {
-                            "service": "login",
-                            "data": {
-                                "status": "erro",
-                                "timestamp": time.time(),
-                                "description": "Usuário já cadastrado",
-                                "clock": relogio.tick()
-                            }
-                        }
-                        print(f"[S] - Tentativa de login com usuário existente: {user}", flush=True)
-                    else:
-                        # Adicionar novo usuário
-                        usuarios.append({
-                            "user": user,
-                            "timestamp": timestamp
-                        })
-                        salvar_usuarios(usuarios)  # Persistir em disco
-                        
-                        reply = {
-                            "service": "login",
-                            "data": {
-                                "status": "sucesso",
-                                "timestamp": time.time(),
-                                "clock": relogio.tick()
-                            }
-                        }
-                        print(f"[S] Login: {user}", flush=True)
-                        replicar_para_outros_servidores({"service": "login", "data": data})
-
-                case "users" | "listar":
-                    lista_usuarios = [u.get("user") for u in usuarios]
-                    print(f"[S] Listando usuarios: {len(usuarios)}", flush=True)
-                    
-                    reply = {
-                        "service": "users",
-                        "data": {
-                            "timestamp": time.time(),
-                            "users": lista_usuarios,
-                            "clock": relogio.tick()
-                        }
-                    }
+            if sync_socket in socks:
+                responder_interno(sync_socket, processar_sync)
             
-                case "channel" | "cadastrarCanal":
-                    channel = data.get("channel", data.get("canal"))
-                    timestamp = data.get("timestamp")
-                    canal_existe = any(c.get("channel") == channel for c in canais)
-                    
-                    if canal_existe:
-                        reply = {
-                            "service": "channel",
-                            "data": {
-                                "status": "erro",
-                                "timestamp": time.time(),
-                                "description": "Canal ja existe",
-                                "clock": relogio.tick()
-                            }
-                        }
-                    else:
-                        canais.append({"channel": channel, "timestamp": timestamp})
-                        salvar_canais(canais)
-                        reply = {
-                            "service": "channel",
-                            "data": {
-                                "status": "sucesso",
-                                "timestamp": time.time(),
-                                "clock": relogio.tick()
-                            }
-                        }
-                        print(f"[S] Canal: {channel}", flush=True)
-                        replicar_para_outros_servidores({"service": "channel", "data": data})
-
-                case "channels" | "listarCanal":
-                    lista_canais = [c.get("channel") for c in canais]
-                    print(f"[S] Listando canais: {len(canais)}", flush=True)
-                    
-                    reply = {
-                        "service": "channels",
-                        "data": {
-                            "timestamp": time.time(),
-                            "channels": lista_canais,
-                            "clock": relogio.tick()
-                        }
-                    }
-
-                case "publish":
-                    user = data.get("user")
-                    channel = data.get("channel")
-                    message = data.get("message")
-                    timestamp = data.get("timestamp")
-                    canal_existe = any(c.get("channel") == channel for c in canais)
-                    
-                    if not canal_existe:
-                        reply = {
-                            "service": "publish",
-                            "data": {
-                                "status": "erro",
-                                "message": f"Canal nao existe",
-                                "timestamp": time.time(),
-                                "clock": relogio.tick()
-                            }
-                        }
-                    else:
-                        pub_msg = {
-                            "type": "channel",
-                            "topic": channel,
-                            "user": user,
-                            "channel": channel,
-                            "message": message,
-                            "timestamp": timestamp,
-                            "clock": relogio.get()
-                        }
-                        pub_socket.send(msgpack.packb(pub_msg))
-                        salvar_publicacao({"user": user, "channel": channel, "message": message, "timestamp": timestamp})
-                        
-                        reply = {
-                            "service": "publish",
-                            "data": {
-                                "status": "OK",
-                                "timestamp": time.time(),
-                                "clock": relogio.tick()
-                            }
-                        }
-                        print(f"[S] Publicado: {channel}", flush=True)
-                        replicar_para_outros_servidores({"service": "publish", "data": data})
-
-                case "message":
-                    src = data.get("src")
-                    dst = data.get("dst")
-                    message = data.get("message")
-                    timestamp = data.get("timestamp")
-                    usuario_existe = any(u.get("user") == dst for u in usuarios)
-                    
-                    if not usuario_existe:
-                        reply = {
-                            "service": "message",
-                            "data": {
-                                "status": "erro",
-                                "message": f"Usuario nao existe",
-                                "timestamp": time.time(),
-                                "clock": relogio.tick()
-                            }
-                        }
-                    else:
-                        pub_msg = {
-                            "type": "user",
-                            "topic": dst,
-                            "src": src,
-                            "dst": dst,
-                            "message": message,
-                            "timestamp": timestamp,
-                            "clock": relogio.get()
-                        }
-                        pub_socket.send(msgpack.packb(pub_msg))
-                        salvar_mensagem_privada({"src": src, "dst": dst, "message": message, "timestamp": timestamp})
-                        
-                        reply = {
-                            "service": "message",
-                            "data": {
-                                "status": "OK",
-                                "timestamp": time.time(),
-                                "clock": relogio.tick()
-                            }
-                        }
-                        print(f"[S] Mensagem: {src} -> {dst}", flush=True)
-                        replicar_para_outros_servidores({"service": "message", "data": data})
-            
-                case _ :
-                    reply = {
-                        "service": service if service else "unknown",
-                        "data": {
-                            "status": "erro",
-                            "timestamp": time.time(),
-                            "description": "Serviço não encontrado",
-                            "clock": relogio.tick()
-                        }
-                    }
-
-            # Responder no mesmo formato que recebeu
-            if formato_json:
-                socket.send(json.dumps(reply).encode('utf-8'))
-            else:
-                socket.send(msgpack.packb(reply))
-        
-        if sync_socket in socks:
-            try:
-                request_data = sync_socket.recv()
-                request = msgpack.unpackb(request_data, raw=False)
-                service = request.get("service")
-                data = request.get("data", {})
-                
-                if "clock" in data:
-                    relogio.update(data["clock"])
-                
-                if service == "clock":
-                    reply = {
-                        "service": "clock",
-                        "data": {
-                            "time": time.time() + ajuste_relogio,
-                            "timestamp": time.time(),
-                            "clock": relogio.tick()
-                        }
-                    }
-                elif service == "election":
-                    reply = {
-                        "service": "election",
-                        "data": {
-                            "election": "OK",
-                            "timestamp": time.time(),
-                            "clock": relogio.tick()
-                        }
-                    }
-                    threading.Thread(target=iniciar_eleicao, daemon=True).start()
-                else:
-                    reply = {
-                        "service": service,
-                        "data": {
-                            "status": "erro",
-                            "message": "Servico nao reconhecido",
-                            "timestamp": time.time(),
-                            "clock": relogio.tick()
-                        }
-                    }
-                
-                sync_socket.send(msgpack.packb(reply))
-            except:
-                pass
+            if replication_socket in socks:
+                responder_interno(replication_socket, processar_replicacao)
         
-        if replication_socket in socks:
-            try:
-                request_data = replication_socket.recv()
-                request = msgpack.unpackb(request_data, raw=False)
-                
-                if request.get("replicated"):
-                    service = request.get("service")
-                    data = request.get("data", {})
-                    
-                    if "clock" in data:
-                        relogio.update(data["clock"])
-                    
-                    if service == "login":
-                        user = data.get("user")
-                        if not any(u.get("user") == user for u in usuarios):
-                            usuarios.append({"user": user, "timestamp": data.get("timestamp")})
-                            salvar_usuarios(usuarios)
-                            print(f"[S] Replicado usuario: {user}", flush=True)
-                    
-                    elif service == "channel":
-                        channel = data.get("channel", data.get("canal"))
-                        if not any(c.get("channel") == channel for c in canais):
-                            canais.append({"channel": channel, "timestamp": data.get("timestamp")})
-                            salvar_canais(canais)
-                            print(f"[S] Replicado canal: {channel}", flush=True)
-                    
-                    elif service == "publish":
-                        salvar_publicacao({
-                            "user": data.get("user"),
-                            "channel": data.get("channel"),
-                            "message": data.get("message"),
-                            "timestamp": data.get("timestamp")
-                        })
-                    
-                    elif service == "message":
-                        salvar_mensagem_privada({
-                            "src": data.get("src"),
-                            "dst": data.get("dst"),
-                            "message": data.get("message"),
-                            "timestamp": data.get("timestamp")
-                        })
-                    
-                    ack = {"status": "OK", "clock": relogio.tick()}
-                    replication_socket.send(msgpack.packb(ack))
-                else:
-                    ack = {"status": "ignored"}
-                    replication_socket.send(msgpack.packb(ack))
-            except:
-                pass
+        except KeyboardInterrupt:
+            break
+        except:
+            logger.exception("Erro no loop principal")
+            time.sleep(0.1)
     
-    except KeyboardInterrupt:
-        break
-    except:
-        time.sleep(0.1)
+    encerrar_armazenamento()
+    encerrar_logs()
+
+if __name__ == "__main__":
+    executar()
@@ -0,0 +1,340 @@
+import asyncio
+import threading
+import os
+import time
+import zmq
+import zmq.asyncio
+import msgpack
+import servidor
+from instrumentacao import Histograma
+from logs import logger, configurar_logs, encerrar_logs
+
+# Servidor em modo assíncrono: um único event loop (zmq.asyncio) atende os
+# clientes, a sincronização, a replicação e as tarefas de fundo como
+# corrotinas, no lugar das threads do servidor.py. Os handlers e o estado
+# são os mesmos do servidor.py.
+
+context = zmq.asyncio.Context.instance()
+pub_eleicao = None
+
+
+async def requisitar(endereco, request, timeout_ms=5000):
+    """Ida e volta REQ/REP assíncrona; retorna a resposta ou None em timeout"""
+    sock = context.socket(zmq.REQ)
+    sock.setsockopt(zmq.LINGER, 0)
+    sock.connect(endereco)
+    try:
+        await sock.send(msgpack.packb(request))
+        if not await sock.poll(timeout_ms, zmq.POLLIN):
+            return None
+        reply = msgpack.unpackb(await sock.recv(), raw=False)
+        if "clock" in reply.get("data", {}):
+            servidor.relogio.update(reply["data"]["clock"])
+        return reply
+    finally:
+        sock.close()
+
+
+def requisicao(service, **dados):
+    dados["timestamp"] = time.time()
+    dados["clock"] = servidor.relogio.tick()
+    return {"service": service, "data": dados}
+
+
+async def obter_lista_servidores():
+    """Mesma política de cache do servidor.py, com a consulta não bloqueante"""
+    with servidor.lock_membros:
+        if time.monotonic() < servidor.cache_membros["expira"]:
+            return servidor.cache_membros["lista"]
+        lista_anterior = servidor.cache_membros["lista"]
+
+    reply = await requisitar("tcp://referencia:5560", requisicao("list"))
+    if reply is None:
+        return lista_anterior
+    dados = reply.get("data", {})
+    servidor.atualizar_membros(dados.get("list", []), dados.get("version"))
+    return dados.get("list", [])
+
+
+class ReplicadorAsync:
+    """Replicação REQ/REP com uma conexão por servidor e envio em paralelo"""
+
+    def __init__(self, timeout_ms=2000):
+        # Criado dentro do event loop (ver executar)
+        self.loop = asyncio.get_running_loop()
+        self.timeout_ms = timeout_ms
+        self.fila = asyncio.Queue()
+        self.conexoes = {}
+        self.reconexoes = 0
+        # Atraso de replicação por servidor: do enfileiramento até a confirmação
+        self.atrasos = {}
+
+    def replicar(self, mensagem):
+        mensagem_copy = mensagem.copy()
+        mensagem_copy["replicated"] = True
+        # Com fsync "always" os handlers rodam em threads do executor: a
+        # asyncio.Queue só pode ser usada pela thread do loop
+        try:
+            no_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            no_loop = False
+        item = (mensagem_copy, time.monotonic())
+        if no_loop:
+            self.fila.put_nowait(item)
+        else:
+            self.loop.call_soon_threadsafe(self.fila.put_nowait, item)
+
+    async def _enviar(self, nome, payloads):
+        # Envia em ordem para um servidor; desiste do restante ao primeiro timeout
+        for payload, enfileirada in payloads:
+            sock = self.conexoes.get(nome)
+            if sock is None:
+                sock = context.socket(zmq.REQ)
+                sock.setsockopt(zmq.LINGER, 0)
+                sock.connect(f"tcp://{nome}:{servidor.REPLICATION_PORT}")
+                self.conexoes[nome] = sock
+            try:
+                await sock.send(payload)
+                if not await sock.poll(self.timeout_ms, zmq.POLLIN):
+                    raise zmq.Again()
+                await sock.recv()
+                self.atrasos.setdefault(nome, Histograma()).registrar(time.monotonic() - enfileirada)
+            except zmq.ZMQError:
+                self.conexoes.pop(nome).close()
+                self.reconexoes += 1
+                return
+
+    async def executar(self):
+        while True:
+            lote = [await self.fila.get()]
+            while not self.fila.empty():
+                lote.append(self.fila.get_nowait())
+
+            nomes = [s.get("name") for s in await obter_lista_servidores()]
+            nomes = [n for n in nomes if n and n != servidor.NOME_SERVIDOR]
+            for nome in list(self.conexoes):
+                if nome not in nomes:
+                    self.conexoes.pop(nome).close()
+                    self.atrasos.pop(nome, None)
+
+            payloads = [(msgpack.packb(m), enfileirada) for m, enfileirada in lote]
+            await asyncio.gather(*(self._enviar(nome, payloads) for nome in nomes))
+
+    def metricas(self):
+        return {"conexoes": len(self.conexoes), "fila": self.fila.qsize(), "reconexoes": self.reconexoes,
+                "atraso": {nome: h.resumo() for nome, h in self.atrasos.items()}}
+
+
+async def enviar_heartbeat():
+    while True:
+        await asyncio.sleep(10)
+        await requisitar("tcp://referencia:5560", requisicao("heartbeat", user=servidor.NOME_SERVIDOR))
+
+
+async def sincronizar_relogio():
+    """Berkeley simplificado com o coordenador (ver servidor.sincronizar_relogio)"""
+    while True:
+        await asyncio.sleep(30)
+        coordenador = servidor.coordenador_atual
+        if not coordenador or coordenador == servidor.NOME_SERVIDOR:
+            continue
+        if not any(s.get("name") == coordenador for s in await obter_lista_servidores()):
+            continue
+
+        t1 = time.time()
+        reply = await requisitar(f"tcp://{coordenador}:5561", requisicao("clock"))
+        t2 = time.time()
+        if reply is None:
+            asyncio.ensure_future(iniciar_eleicao())
+            continue
+        tempo_coord = reply.get("data", {}).get("time")
+        if tempo_coord:
+            servidor.ajuste_relogio = tempo_coord + (t2 - t1) / 2 - time.time()
+
+
+async def iniciar_eleicao():
+    """Bully: consulta em paralelo todos os servidores de rank maior"""
+    logger.info("Iniciando eleição...")
+    lista_servidores = await obter_lista_servidores()
+    maiores = [s for s in lista_servidores if s.get("rank", 0) > (servidor.rank_servidor or 0)]
+
+    respostas = await asyncio.gather(*(
+        requisitar(f"tcp://{s['name']}:5561", requisicao("election"), timeout_ms=2000) for s in maiores
+    ))
+    if any(r and r.get("data", {}).get("election") == "OK" for r in respostas):
+        return
+
+    servidor.coordenador_atual = servidor.NOME_SERVIDOR
+    pub_msg = {
+        "type": "election",
+        "topic": "servers",
+        "service": "election",
+        "data": {
+            "coordinator": servidor.NOME_SERVIDOR,
+            "timestamp": time.time(),
+            "clock": servidor.relogio.tick()
+        }
+    }
+    await pub_eleicao.send_multipart([b"servers", msgpack.packb(pub_msg)])
+
+
+async def monitor_eleicoes():
+    sub = context.socket(zmq.SUB)
+    sub.connect("tcp://proxy:5558")
+    sub.setsockopt_string(zmq.SUBSCRIBE, "servers")
+    sub.setsockopt_string(zmq.SUBSCRIBE, servidor.TOPICO_MEMBROS)
+    while True:
+        try:
+            _, msg_data = await sub.recv_multipart()
+            msg = msgpack.unpackb(msg_data, raw=False)
+            dados = msg.get("data", {})
+            if msg.get("type") == "membership":
+                servidor.atualizar_membros(dados.get("list", []), dados.get("version"))
+            elif msg.get("type") == "election" and dados.get("coordinator"):
+                servidor.coordenador_atual = dados["coordinator"]
+            if "clock" in dados:
+                servidor.relogio.update(dados["clock"])
+        except Exception:
+            pass
+
+
+async def recarregar_dados_periodicamente():
+    # Lê os arquivos dos outros servidores: disco, fora do event loop
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(servidor.RECARGA_INTERVALO)
+        try:
+            await loop.run_in_executor(None, servidor.recarregar_se_alterado)
+        except Exception:
+            pass
+
+
+async def atender(sock, processar):
+    """Loop REP genérico: recebe, processa com `processar` e responde
+
+    `processar` roda no executor: a replicação grava pelo gravador, que pode
+    esperar o fsync ou a fila cheia e travaria os sockets dos clientes.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        request_data = await sock.recv()
+        try:
+            resposta = await loop.run_in_executor(None, processar, request_data)
+        except Exception as e:
+            logger.exception("Erro ao processar requisicao: %s", e)
+            resposta = msgpack.packb(servidor.resposta_erro("unknown", "Erro interno"))
+        await sock.send(resposta)
+
+
+async def responder_cliente(request_data):
+    """servidor.atender_requisicao; com fsync "always" o handler espera o
+    disco e roda fora do event loop (a replicação feita por ele passa pelo
+    ReplicadorAsync.replicar, que aceita chamadas de outras threads)"""
+    if servidor.gravador.politica == "always":
+        return await asyncio.get_running_loop().run_in_executor(None, servidor.atender_requisicao, request_data)
+    return servidor.atender_requisicao(request_data)
+
+
+async def atender_clientes(sock):
+    while True:
+        request_data = await sock.recv()
+        await sock.send(await responder_cliente(request_data))
+
+
+async def atender_broker():
+    """Modo balanceado do broker: anuncia capacidade, manda heartbeats e responde
+
+    Mesmo protocolo do servidor.ConexaoBroker, num único destino (o event loop).
+    """
+    capacidade = int(os.environ.get("SERVIDOR_CAPACIDADE", 2))
+    intervalo = servidor.BROKER_HEARTBEAT_INTERVALO
+    while True:
+        sock = context.socket(zmq.DEALER)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.setsockopt(zmq.IDENTITY, f"{servidor.NOME_SERVIDOR}/async".encode())
+        sock.connect("tcp://broker:5556")
+        await sock.send_multipart([servidor.BROKER_PRONTO, str(capacidade).encode()])
+        ultimo_contato = time.monotonic()
+        while time.monotonic() - ultimo_contato <= intervalo * servidor.BROKER_HEARTBEAT_TOLERANCIA:
+            if not await sock.poll(intervalo * 1000, zmq.POLLIN):
+                await sock.send(servidor.BROKER_HEARTBEAT)
+                continue
+            frames = await sock.recv_multipart()
+            ultimo_contato = time.monotonic()
+            if frames[0] == servidor.BROKER_REQUISICAO:
+                resposta = await responder_cliente(frames[-1])
+                await sock.send_multipart([servidor.BROKER_RESPOSTA, frames[1]] + frames[2:-1] + [resposta])
+            elif frames[0] == servidor.BROKER_PRONTO:
+                await sock.send_multipart([servidor.BROKER_PRONTO, str(capacidade).encode()])
+        logger.warning("Broker sem resposta; reconectando")
+        sock.close()
+
+
+async def executar():
+    global pub_eleicao
+    configurar_logs()
+
+    pub_eleicao = context.socket(zmq.PUB)
+    pub_eleicao.connect("tcp://proxy:5557")
+
+    await asyncio.sleep(3)
+    reply = await requisitar("tcp://referencia:5560", requisicao("rank", user=servidor.NOME_SERVIDOR))
+    servidor.rank_servidor = reply.get("data", {}).get("rank") if reply else None
+    logger.info("Servidor %s registrado com rank %s", servidor.NOME_SERVIDOR, servidor.rank_servidor)
+
+    tarefas = []
+    if servidor.rank_servidor is not None:
+        tarefas += [enviar_heartbeat(), sincronizar_relogio(), monitor_eleicoes()]
+        if servidor.rank_servidor == 1:
+            servidor.coordenador_atual = servidor.NOME_SERVIDOR
+
+    sync_socket = context.socket(zmq.REP)
+    sync_socket.bind("tcp://*:5561")
+    replication_socket = context.socket(zmq.REP)
+    replication_socket.bind(f"tcp://*:{servidor.REPLICATION_PORT}")
+
+    # O PUB de canais não bloqueia: usa o socket síncrono do servidor.py
+    servidor.pub_socket = servidor.criar_pub_socket(zmq.Context.instance())
+
+    servidor.iniciar_armazenamento()
+    # A compactação do estado é disco e CPU: fica numa thread, fora do loop
+    threading.Thread(target=servidor.compactar_periodicamente, daemon=True).start()
+    if os.environ.get("REPLICACAO_MODO", "pool") == "stream":
+        servidor.iniciar_replicacao()
+    else:
+        servidor.replicador = ReplicadorAsync()
+        tarefas.append(servidor.replicador.executar())
+
+    if os.environ.get("BROKER_MODO", "proxy") == "balanceado":
+        clientes = atender_broker()
+    else:
+        socket = context.socket(zmq.REP)
+        socket.connect("tcp://broker:5556")
+        clientes = atender_clientes(socket)
+
+    # processar_sync roda no executor: a eleição é agendada de volta no loop
+    loop = asyncio.get_running_loop()
+
+    def processar_sync(request_data):
+        return servidor.processar_sync(request_data, ao_receber_eleicao=lambda: loop.call_soon_threadsafe(
+            lambda: asyncio.ensure_future(iniciar_eleicao())))
+
+    logger.info("%s pronto (asyncio)", servidor.NOME_SERVIDOR)
+    try:
+        await asyncio.gather(
+            clientes,
+            atender(sync_socket, processar_sync),
+            atender(replication_socket, servidor.processar_replicacao),
+            recarregar_dados_periodicamente(),
+            *tarefas,
+        )
+    finally:
+        servidor.encerrar_armazenamento()
+        encerrar_logs()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(executar())
+    except KeyboardInterrupt:
+        pass
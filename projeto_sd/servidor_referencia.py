@@ -31,6 +31,40 @@ lock = threading.Lock()
 # Timeout para heartbeat (em segundos)
 HEARTBEAT_TIMEOUT = 30
 
+# Socket PUB para avisar os servidores de mudanças na lista. Passa pelo mesmo
+# proxy dos canais: o tópico começa com "#", que nomes de usuário e canal não
+# podem ter (mesmo valor de servidor.TOPICO_MEMBROS)
+TOPICO_MEMBROS = "#membership"
+pub_context = zmq.Context()
+membership_pub_socket = pub_context.socket(zmq.PUB)
+membership_pub_socket.connect("tcp://proxy:5557")
+lock_pub = threading.Lock()
+versao_membros = 0
+
+def listar_servidores():
+    return [{"name": nome, "rank": info["rank"]} for nome, info in servidores.items()]
+
+def publicar_membros(evento, nome_servidor):
+    """Publica a lista atualizada de servidores (chamar com `lock`)"""
+    global versao_membros
+    versao_membros += 1
+    msg = {
+        "type": "membership",
+        "topic": TOPICO_MEMBROS,
+        "service": "membership",
+        "data": {
+            "event": evento,
+            "name": nome_servidor,
+            "list": listar_servidores(),
+            "version": versao_membros,
+            "timestamp": time.time(),
+            "clock": relogio.tick()
+        }
+    }
+    with lock_pub:
+        membership_pub_socket.send_string(TOPICO_MEMBROS, zmq.SNDMORE)
+        membership_pub_socket.send(msgpack.packb(msg))
+
 def limpar_servidores_inativos():
     while True:
         time.sleep(10)
@@ -42,6 +76,7 @@ def limpar_servidores_inativos():
                     servidores_inativos.append(nome)
             for nome in servidores_inativos:
                 del servidores[nome]
+                publicar_membros("leave", nome)
 
 threading.Thread(target=limpar_servidores_inativos, daemon=True).start()
 
@@ -53,6 +88,7 @@ def atribuir_rank(nome_servidor):
             proximo_rank += 1
             servidores[nome_servidor] = {"rank": rank, "last_heartbeat": time.time()}
             print(f"[REF] Servidor {nome_servidor} rank {rank}", flush=True)
+            publicar_membros("join", nome_servidor)
         else:
             rank = servidores[nome_servidor]["rank"]
             servidores[nome_servidor]["last_heartbeat"] = time.time()
@@ -91,11 +127,13 @@ while True:
         
         elif service == "list":
             with lock:
-                lista_servidores = [{"name": nome, "rank": info["rank"]} for nome, info in servidores.items()]
+                lista_servidores = listar_servidores()
+                versao = versao_membros
             reply = {
                 "service": "list",
                 "data": {
                     "list": lista_servidores,
+                    "version": versao,
                     "timestamp": time.time(),
                     "clock": relogio.tick()
                 }
@@ -1,41 +1,120 @@
+import os
+import sys
+import time
 import zmq
-from time import sleep
 import msgpack
-import os
 
 usuario = os.environ.get("SUBSCRIBER_USER", "sub_default")
 canais_inscritos = os.environ.get("SUBSCRIBER_CHANNELS", "").split(",")
 canais_inscritos = [c.strip() for c in canais_inscritos if c.strip()]
 
+RCVHWM = int(os.environ.get("SUBSCRIBER_RCVHWM", 100000))
+# Máximo de mensagens drenadas e decodificadas por despertar
+MAX_LOTE = int(os.environ.get("SUBSCRIBER_LOTE", 1000))
+# Imprimir cada mensagem (desligar para medir vazão)
+IMPRIMIR = os.environ.get("SUBSCRIBER_IMPRIMIR", "1") != "0"
+# Intervalo (s) do relatório de contadores (0 desliga)
+RELATORIO_INTERVALO = float(os.environ.get("SUBSCRIBER_RELATORIO", 10))
+
 context = zmq.Context()
 sub = context.socket(zmq.SUB)
+sub.setsockopt(zmq.RCVHWM, RCVHWM)
 sub.connect("tcp://proxy:5558")
 
 sub.setsockopt_string(zmq.SUBSCRIBE, usuario)
 for canal in canais_inscritos:
     sub.setsockopt_string(zmq.SUBSCRIBE, canal)
 
-print(f"[SUB {usuario}] Iniciado", flush=True)
+# Contadores. O clock das mensagens é o relógio lógico do servidor, que não
+# é contíguo: um clock menor que o último já visto no mesmo tópico só indica
+# que a mensagem chegou fora de ordem (ex.: publicações de servidores
+# diferentes no mesmo canal), não que alguma se perdeu; perdas não são
+# detectáveis por aqui. O atraso em clock é a distância até o maior clock já
+# recebido.
+contadores = {"recebidas": 0, "fora_de_ordem": 0, "atraso_clock_max": 0, "atraso_ms_max": 0.0}
+ultimo_clock = {}
+maior_clock = 0
+
+
+def registrar(topic, mensagem, agora):
+    global maior_clock
+    contadores["recebidas"] += 1
+
+    clock = mensagem.get("clock")
+    if isinstance(clock, int):
+        if clock < ultimo_clock.get(topic, -1):
+            contadores["fora_de_ordem"] += 1
+        else:
+            ultimo_clock[topic] = clock
+        if clock > maior_clock:
+            maior_clock = clock
+        contadores["atraso_clock_max"] = max(contadores["atraso_clock_max"], maior_clock - clock)
+
+    timestamp = mensagem.get("timestamp")
+    if isinstance(timestamp, (int, float)):
+        contadores["atraso_ms_max"] = max(contadores["atraso_ms_max"], (agora - timestamp) * 1000.0)
+
 
+def formatar(mensagem):
+    msg_type = mensagem.get("type")
+    if msg_type == "user":
+        return f"[SUB {usuario}] De {mensagem.get('src')}: {mensagem.get('message')}"
+    if msg_type == "channel":
+        return f"[SUB {usuario}] #{mensagem.get('channel')} {mensagem.get('user')}: {mensagem.get('message')}"
+    return None
+
+
+def drenar():
+    """Recebe tudo o que estiver disponível (até MAX_LOTE) sem bloquear"""
+    lote = []
+    for _ in range(MAX_LOTE):
+        try:
+            lote.append(sub.recv_multipart(zmq.NOBLOCK))
+        except zmq.Again:
+            break
+    return lote
+
+
+def processar(lote):
+    agora = time.time()
+    linhas = []
+    for frames in lote:
+        try:
+            topic = frames[0].decode()
+            mensagem = msgpack.unpackb(frames[-1], raw=False)
+        except Exception:
+            continue
+        registrar(topic, mensagem, agora)
+        if IMPRIMIR:
+            linha = formatar(mensagem)
+            if linha:
+                linhas.append(linha)
+    if linhas:
+        sys.stdout.write("\n".join(linhas) + "\n")
+        sys.stdout.flush()
+
+
+print(f"[SUB {usuario}] Iniciado (RCVHWM={RCVHWM})", flush=True)
+
+proximo_relatorio = time.monotonic() + RELATORIO_INTERVALO
+ultimo_relatado = 0
 while True:
     try:
-        topic = sub.recv_string()
-        mensagem_data = sub.recv()
-        mensagem = msgpack.unpackb(mensagem_data, raw=False)
-        
-        msg_type = mensagem.get("type")
-        if msg_type == "user":
-            src = mensagem.get("src")
-            message = mensagem.get("message")
-            print(f"[SUB {usuario}] De {src}: {message}", flush=True)
-        elif msg_type == "channel":
-            user = mensagem.get("user")
-            channel = mensagem.get("channel")
-            message = mensagem.get("message")
-            print(f"[SUB {usuario}] #{channel} {user}: {message}", flush=True)
-    except:
-        pass
-    sleep(0.1)
+        if sub.poll(1000, zmq.POLLIN):
+            processar(drenar())
+    except KeyboardInterrupt:
+        break
+    except Exception as e:
+        print(f"[SUB {usuario}] Erro: {e}", flush=True)
+
+    if RELATORIO_INTERVALO > 0 and time.monotonic() >= proximo_relatorio:
+        if contadores["recebidas"] != ultimo_relatado:
+            taxa = (contadores["recebidas"] - ultimo_relatado) / RELATORIO_INTERVALO
+            print(f"[SUB {usuario}] Recebidas: {contadores['recebidas']} ({taxa:.0f}/s), "
+                  f"fora de ordem: {contadores['fora_de_ordem']}, atraso max: {contadores['atraso_clock_max']} clocks / "
+                  f"{contadores['atraso_ms_max']:.1f} ms", flush=True)
+            ultimo_relatado = contadores["recebidas"]
+        proximo_relatorio = time.monotonic() + RELATORIO_INTERVALO
 
 sub.close()
-context.close()
+context.term()